@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ArenaConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "arena"
+
+    def ready(self):
+        from . import bot, strategy
+
+        # ボットの表はリクエストを受ける前に読む（イベントループ上で読み込み・解き直しをしない）
+        if bot.BOT_AFTER > 0:
+            strategy.load_table()
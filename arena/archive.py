@@ -0,0 +1,124 @@
+"""
+決着した対戦のアーカイブと、ライブテーブルからの削除。
+
+決着から GRACE 以上たった Room を BATCH 件ずつ取り出し、1試合を1行の JSON にして
+gzip のセグメントファイル（ARENA_ARCHIVE_DIR/matches-*.jsonl.gz）へ追記する。
+1試合ごとに独立した gzip メンバーとして書くので、ファイル全体は普通の .jsonl.gz として
+読めるうえ、索引（ArchivedMatch の offset / length）からその1試合だけを読み出せる。
+
+書き込み（fsync まで）が済んでから、索引の登録と Room / Turn の削除を1トランザクションで行う。
+途中で落ちた場合は次回同じ試合をもう一度書く（索引は後勝ちなので読み出しは壊れない）。
+メモリに載るのは1バッチ分だけ。
+
+1行の形:
+    {"code": "123456", "room": {...Room の列...},
+     "turns": [[番号, P1の行動, P2の行動, 締切], ...]}
+
+実行は manage.py archive_matches から。読み出しは load_match / views.replay。
+"""
+import gzip
+import json
+import os
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ArchivedMatch, Room, Turn
+
+ARCHIVE_DIR = Path(getattr(settings, "ARENA_ARCHIVE_DIR", Path(settings.BASE_DIR) / "archive"))
+BATCH = 500
+GRACE = timedelta(minutes=10)   # 決着直後の部屋（フラッシュ・観戦中）は残しておく
+
+ROOM_COLUMNS = ["code", "created_at", "p1_id", "p2_id", "p1_hp", "p2_hp", "p1_tokens", "p2_tokens",
+                "turn", "deadline", "version", "finished", "winner"]
+
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+
+def _batch(after_pk: int, cutoff, size: int) -> list[dict]:
+    rows = list(
+        Room.objects.filter(pk__gt=after_pk, finished=True, deadline__lt=cutoff)
+        .order_by("pk").values("pk", *ROOM_COLUMNS)[:size]
+    )
+    if not rows:
+        return []
+    turns: dict[int, list] = {r["pk"]: [] for r in rows}
+    for room_id, number, a1, a2, deadline in (
+        Turn.objects.filter(room_id__in=list(turns)).order_by("room_id", "number")
+        .values_list("room_id", "number", "p1_action", "p2_action", "deadline").iterator(chunk_size=2000)
+    ):
+        turns[room_id].append([number, a1, a2, _iso(deadline)])
+    for r in rows:
+        r["turns"] = turns[r["pk"]]
+    return rows
+
+
+def _write_segment(path: Path, rows: list[dict]) -> list[tuple[int, int]]:
+    """1試合 = gzip メンバー1つで追記し、各試合の (offset, length) を返す"""
+    spans = []
+    with open(path, "ab") as f:
+        for r in rows:
+            record = {
+                "code": r["code"],
+                "room": {k: _iso(r[k]) if k in ("created_at", "deadline") else r[k] for k in ROOM_COLUMNS},
+                "turns": r["turns"],
+            }
+            blob = gzip.compress(
+                (json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n").encode(),
+                mtime=0,
+            )
+            spans.append((f.tell(), len(blob)))
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    return spans
+
+
+def archive_finished(batch_size: int = BATCH, grace: timedelta = GRACE, limit: int | None = None,
+                     directory: Path | None = None) -> dict:
+    """決着した対戦をアーカイブして消す。処理した件数などを返す"""
+    directory = Path(directory or ARCHIVE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    cutoff = timezone.now() - grace
+    path = directory / f"matches-{timezone.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl.gz"
+    stats = {"matches": 0, "turns": 0, "bytes": 0, "segment": str(path)}
+    after = 0
+    while limit is None or stats["matches"] < limit:
+        size = batch_size if limit is None else min(batch_size, limit - stats["matches"])
+        rows = _batch(after, cutoff, size)
+        if not rows:
+            break
+        after = rows[-1]["pk"]
+        spans = _write_segment(path, rows)
+        pks = [r["pk"] for r in rows]
+        with transaction.atomic():
+            ArchivedMatch.objects.bulk_create([
+                ArchivedMatch(code=r["code"], finished_at=r["deadline"], winner=r["winner"],
+                              turns=len(r["turns"]), segment=path.name, offset=off, length=length)
+                for r, (off, length) in zip(rows, spans)
+            ])
+            Turn.objects.filter(room_id__in=pks).delete()
+            Room.objects.filter(pk__in=pks).delete()
+        stats["matches"] += len(rows)
+        stats["turns"] += sum(len(r["turns"]) for r in rows)
+        stats["bytes"] += sum(length for _, length in spans)
+    return stats
+
+
+def read_match(entry: ArchivedMatch, directory: Path | None = None) -> dict:
+    with open(Path(directory or ARCHIVE_DIR) / entry.segment, "rb") as f:
+        f.seek(entry.offset)
+        return json.loads(gzip.decompress(f.read(entry.length)))
+
+
+def load_match(room_code: str, directory: Path | None = None) -> dict | None:
+    """そのコードで最後にアーカイブされた対戦（無ければ None）"""
+    entry = ArchivedMatch.objects.filter(code=room_code).first()
+    if entry is None:
+        return None
+    return read_match(entry, directory)
@@ -0,0 +1,77 @@
+"""
+ボットの対戦相手。
+
+1P だけが座ったまま BOT_AFTER 秒たっても 2P の席が埋まらない部屋に、ボットが 2P として座る。
+ボットはソケットも締切タイマーも持たない。ターンが始まった時点（座ったとき・前のターンを
+解決したとき・担当ワーカーが部屋を読み込み直したとき）に、その場で今のターンの行動を入れる。
+人間が入力すれば両者入力済みとしてすぐ解決される。
+
+行動は strategy の表（解いておいた最適戦略）を引いて混合戦略から1つ選ぶだけ（O(1)）なので、
+ボットの部屋がいくら増えても CPU はほとんど使わない。表が読み込めていなければ
+（無い・今のルールと合わない）ボットは座らず、座っている部屋でも行動を入れない。
+
+ボットが座る処理・行動を入れる処理は部屋の担当ワーカーで行う（consumers 側）。
+ここはボットの席の予約（タイマー）と、行動の選び方だけを持つ。
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+from . import strategy
+
+logger = logging.getLogger(__name__)
+
+BOT_PID = "bot"
+BOT_AFTER = getattr(settings, "ARENA_BOT_AFTER", 20.0)      # 秒。0 ならボットは座らない
+
+
+def move(state) -> str | None:
+    """ボットが 2P の部屋で、今のターンをまだ入力していなければ、その行動"""
+    table = strategy.table()
+    if table is None or state.p2_id != BOT_PID or state.finished or state.p2_action != "none":
+        return None
+    return table.choose(state.p2_hp, state.p1_hp, state.p2_tokens, state.p1_tokens)
+
+
+class BotSeats:
+    def __init__(self):
+        self._handles: dict[str, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def offer(self, room_code: str, callback):
+        """BOT_AFTER 秒後に callback(room_code) を呼ぶ（予約済みなら何もしない）"""
+        if BOT_AFTER <= 0 or room_code in self._handles or strategy.table() is None:
+            return
+        loop = asyncio.get_running_loop()
+        self._handles[room_code] = loop.call_later(BOT_AFTER, self._fire, room_code, callback)
+
+    def cancel(self, room_code: str):
+        handle = self._handles.pop(room_code, None)
+        if handle is not None:
+            handle.cancel()
+
+    def spawn(self, coro):
+        """ボットの処理をタスクで走らせる（終わるまで参照を持ち、失敗はログに出す）"""
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _fire(self, room_code: str, callback):
+        self._handles.pop(room_code, None)
+        self.spawn(callback(room_code))
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("bot task failed", exc_info=task.exception())
+
+    def clear(self):
+        """テスト用"""
+        for handle in self._handles.values():
+            handle.cancel()
+        self.__init__()
+
+
+# プロセス内で1つだけ
+bots = BotSeats()
@@ -1,41 +1,278 @@
 import asyncio
+import json
 import secrets
-from datetime import timedelta
+import time
+from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from django.utils import timezone
-
-from .models import Room, Turn
-
-# ===== ゲーム定数 =====
-TURN_SECONDS = 30       # 1ターン制限
-DMG_ATTACK = 6          # 通常攻撃
-DMG_CHARGED = 15        # チャージ攻撃
+from channels.layers import get_channel_layer
+
+from .db import db_async
+from .drain import CLOSE_SERVICE_RESTART, drainer, reconnect_hint
+from .engine import ResolvedTurn, RoomState, engine
+from . import bot, identity, matchmaking, metrics
+from .outbox import outbox, room_group_name
+from .scheduler import scheduler
+from .sendqueue import CLOSE_TRY_AGAIN_LATER, SEND_STALL_SECONDS, SendQueue
+from .sharding import cluster
+from .spectators import hub
+from .throttle import INBOUND_MAX_DROPS, TokenBucket
+from . import wire
+from .wire import diff_state, project_state
+
+# このワーカーに繋がっているソケット（部屋コード → consumer）。担当替え時の張り直し用
+_local_sockets: dict[str, set] = {}
+
+
+async def resolve_and_broadcast(room_code: str, force: bool = False, turn: int | None = None):
+    """
+    スケジューラ / 両者入力から呼ばれる。解決できたときだけ部屋に通知し、
+    次ターンの締切でタイマーを張り直す。解決から配信までを部屋ロックの中で行うので、
+    同じターンが二重に解決されることも、配信の順序が入れ替わることもない。
+    """
+    async with engine.lock(room_code):
+        with metrics.resolve_seconds.time():
+            return _resolve_locked(room_code, force, turn)
+
+
+def _resolve_locked(room_code: str, force: bool, turn: int | None) -> bool:
+    state = engine.get(room_code)
+    if state is None:
+        return False
+    done = engine.resolve(state, force=force, turn=turn)
+    if done is None:
+        # 締切が延長されていた等。状態は変わっていないので通知しない
+        if not state.finished:
+            scheduler.arm(room_code, state.deadline, resolve_and_broadcast)
+        return False
+
+    announce_resolved(state, done)
+    return True
+
+
+def announce_resolved(state: RoomState, done: ResolvedTurn):
+    """解決したターンを部屋へ流し、次の締切でタイマーを張り直す"""
+    room_code = state.code
+    if state.finished:
+        scheduler.cancel(room_code)
+    else:
+        scheduler.arm(room_code, state.deadline, resolve_and_broadcast)
+
+    metrics.turns_resolved.inc()
+    publish_log(room_code, f"Turn {done.number} resolved: P1={done.p1_action} / P2={done.p2_action}")
+    # 状態は部屋単位で1回だけ組み立てて配る
+    outbox.publish(room_code, {"type": "state_msg", "state": engine.snapshot(state)})
+    # 次のターンのボットの行動（新しいターンなので人間はまだ入力していない）
+    bot_turn(state)
+
+
+def bot_turn(state: RoomState) -> bool:
+    """ボットの席なら今のターンの行動を入れる。両者入力済みになったら True"""
+    action = bot.move(state)
+    if action is None:
+        return False
+    engine.set_action(state, bot.BOT_PID, action)
+    publish_log(state.code, "Action received.")
+    return state.both_input()
+
+
+def publish_log(room_code: str, text: str):
+    """部屋へのログ。再開用のバッファにも残す"""
+    engine.record(room_code, text)
+    outbox.publish(room_code, {"type": "log_msg", "text": text})
+
+
+# ===== オーナー側の部屋操作 =====
+# 自ワーカーが担当の部屋は直接呼び、そうでなければ inbox 経由で担当ワーカーが呼ぶ。
+async def owner_join(room_code: str, pid: str, announce: bool = True, since: int | None = None,
+                     worker: str = ""):
+    """
+    参加を登録し (席, スナップショット, 取りこぼしたログ) を返す。
+    since（クライアントが持っている版数）付きで、すでに席を持っているなら再開として扱い、
+    入室の告知はせず、since より後のログをバッファから返す（再開でなければ None）。
+    worker はソケットのいるワーカー（"" はこのプロセス）。
+    """
+    # 接続数は await より前に数える（同じソケットの leave が先に走っても数がずれない）
+    scheduler.attach(room_code, worker)
+    # 部屋はメモリ上にあればそれを使い、無ければDBから1回だけ読み込む
+    try:
+        state = await engine.acquire(room_code)
+    except Exception:
+        owner_leave(room_code, worker)
+        raise
+    resumed = since is not None and state.seat_of(pid) != 0
+    seat = engine.join(state, pid)
+
+    # 締切タイマーは部屋に1本だけ（未設定なら張る。leave 済みなら arm が張らない）
+    if not state.finished and not scheduler.is_armed(room_code):
+        scheduler.arm(room_code, state.deadline, resolve_and_broadcast)
+
+    if seat == 1 and not state.p2_id and not state.finished:
+        # 2P が来ないままならボットが座る
+        bot.bots.offer(room_code, _seat_bot)
+    elif bot_turn(state):
+        # 読み込み直した部屋で、人間の入力だけ済んでいた
+        bot.bots.spawn(resolve_and_broadcast(room_code, force=True, turn=state.turn))
+
+    if resumed:
+        return seat, engine.snapshot(state), engine.events_since(room_code, since)
+    if seat and announce:
+        publish_log(room_code, f"Player{seat} joined.")
+    return seat, engine.snapshot(state), None
+
+
+def owner_leave(room_code: str, worker: str = ""):
+    if scheduler.detach(room_code, worker) == 0:
+        _room_emptied(room_code)
+
+
+def _room_emptied(room_code: str):
+    bot.bots.cancel(room_code)
+    engine.release(room_code)
+
+
+async def _seat_bot(room_code: str):
+    """BOT_AFTER 秒たっても 2P が来ない部屋に、ボットを 2P として座らせる"""
+    state = engine.get(room_code)
+    if state is None or state.finished or state.p2_id or not cluster.is_local(room_code):
+        return
+    async with engine.lock(room_code):
+        engine.join(state, bot.BOT_PID)
+        metrics.bots_seated.inc()
+        publish_log(room_code, "Player2 (bot) joined.")
+        turn = state.turn if bot_turn(state) else None
+    if turn is not None:
+        await resolve_and_broadcast(room_code, force=True, turn=turn)
+
+
+async def owner_action(room_code: str, pid: str, action: str):
+    # 担当替え直後でメモリに無い場合もあるので acquire で読む
+    state = await engine.acquire(room_code)
+    async with engine.lock(room_code):
+        engine.set_action(state, pid, action)
+        turn = state.turn if state.both_input() else None
+    publish_log(room_code, "Action received.")
+    # 両者入力済みなら締切を待たずに即解決（このターンがまだ未解決なら）
+    if turn is not None:
+        await resolve_and_broadcast(room_code, force=True, turn=turn)
+
+
+# ===== ワーカー間メッセージ（inbox） =====
+async def _on_room_join(message):
+    seat, snap, missed = await owner_join(
+        message["room"], message["pid"], message.get("announce", True), message.get("since"),
+        message.get("worker", ""),
+    )
+    await get_channel_layer().send(
+        message["reply"], {"type": "room.joined", "seat": seat, "state": snap, "missed": missed}
+    )
+
+
+async def _on_room_leave(message):
+    owner_leave(message["room"], message.get("worker", ""))
+
+
+async def _on_room_action(message):
+    await owner_action(message["room"], message["pid"], message["action"])
+
+
+async def _on_room_handoff(message):
+    state = RoomState.from_wire(message["state"])
+    if engine.install(state) and not state.finished and scheduler.members(state.code):
+        scheduler.arm(state.code, state.deadline, resolve_and_broadcast)
+
+
+async def _on_ring_change(old, new):
+    """
+    担当が外れた部屋は書き出してから新オーナーへ渡し、ソケットは新オーナーに付け直す。
+    リングから外れたワーカーのソケットは数から外す（落ちたワーカーからは leave が来ない）。
+    """
+    for worker in old.workers - new.workers:
+        for code in scheduler.drop_worker(worker):
+            _room_emptied(code)
+    moved = []
+    for code in [c for c in engine.rooms if new.owner(c) != cluster.worker_id]:
+        moved.append(engine.evict(code))
+        scheduler.forget(code)
+    if moved:
+        await engine.flush()
+    for state in moved:
+        await cluster.send_to(new.owner(state.code), {"type": "room.handoff", "state": state.to_wire()})
+    for code, consumers in list(_local_sockets.items()):
+        if old.owner(code) != new.owner(code):
+            for consumer in list(consumers):
+                if drainer.draining:
+                    # すぐ閉じて別のワーカーへ繋ぎ直すので付け直さない（旧担当への leave も不要）
+                    consumer._attached = False
+                    continue
+                await consumer.bind(first=False)
+
+
+cluster.on("room.join", _on_room_join)
+cluster.on("room.leave", _on_room_leave)
+cluster.on("room.action", _on_room_action)
+cluster.on("room.handoff", _on_room_handoff)
+cluster.on_ring_change(_on_ring_change)
 
 
 class BattleConsumer(AsyncJsonWebsocketConsumer):
     """ターン制リアルタイム・バトル"""
 
     async def connect(self):
+        started = time.perf_counter()
+        metrics.ensure_loop_monitor()
+        metrics.active_sockets.inc()
+        self._counted = True
+        # 行動を受け取った時刻（次に状態を送るまでの計測用）
+        self._action_at = None
+        # 部屋から届くログ・状態の送信待ち（書き込みは別タスク。遅いソケットでも consumer を止めない）
+        self.outq = SendQueue(self.send, self._render)
+        self._shedding = None
+        try:
+            await self._connect()
+        finally:
+            metrics.connect_seconds.observe(time.perf_counter() - started)
+
+    async def _connect(self):
         # 部屋コード
         self.room_code = self.scope["url_route"]["kwargs"]["room_code"]
 
-        # セッションが無くても匿名IDで続行
-        session = self.scope.get("session", None)
-        if session is not None:
-            pid = session.get("pid")
-            if not pid:
-                pid = secrets.token_hex(16)
-                session["pid"] = pid
-                await database_sync_to_async(session.save)()
-            self.player_id = pid
-        else:
-            # セッションミドルウェア不在時のフォールバック
-            self.player_id = secrets.token_hex(16)
-
         # ルームごとのWSグループ名
-        self.room_group_name = f"arena_{self.room_code}"
+        self.room_group_name = room_group_name(self.room_code)
+
+        # ワイヤ形式（サブプロトコルで MessagePack を選べる。既定は JSON）
+        self.subprotocol = wire.choose_subprotocol(self.scope.get("subprotocols"))
+        self.binary = self.subprotocol == wire.MSGPACK_SUBPROTOCOL
+
+        if drainer.draining:
+            # 停止準備中のワーカーは新しい接続を受けない（ほかのワーカーへ繋ぎ直してもらう）
+            await self.accept(subprotocol=self.subprotocol)
+            await self.drain_close()
+            return
+        drainer.track(self)
+
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.player_id = await self._identify(query)
+
+        # 受信のレート制限
+        self._bucket = TokenBucket()
+        self._dropped = 0
+
+        # このソケットに最後に送った状態と版数（差分配信の基準）
+        self._view = None
+        self._version = -1
+
+        # 再接続時にクライアントが持っている版数（?since=<版数>）
+        since = query.get("since", [""])[0]
+        self._since = int(since) if since.isdigit() else None
+
+        # ?watch=1 は観戦専用（対戦の経路には乗らない）
+        self.spectator = "watch" in query
+        if self.spectator:
+            await self.accept(subprotocol=self.subprotocol)
+            cluster.ensure_started()
+            await self._watch()
+            return
 
         # まずはRedis(=Channel Layer)に参加を試みる
         try:
@@ -46,7 +283,7 @@ class BattleConsumer(AsyncJsonWebsocketConsumer):
             )
         except Exception as e:
             # 参加に失敗した場合は、いったん受理→理由を返して→閉じる
-            await self.accept()
+            await self.accept(subprotocol=self.subprotocol)
             await self.send_json({
                 "type": "error",
                 "reason": "channel_layer_unavailable",
@@ -56,12 +293,13 @@ class BattleConsumer(AsyncJsonWebsocketConsumer):
             return
 
         # ここまで来たら参加OK
-        await self.accept()
+        await self.accept(subprotocol=self.subprotocol)
 
-        # ロビー参加処理 & 現在ターンの存在保証
+        # ロビー参加処理（部屋の担当ワーカーで行う）
         try:
-            await self.join_room()
-            await self.send_state("joined")
+            cluster.ensure_started()
+            _local_sockets.setdefault(self.room_code, set()).add(self)
+            await self.bind(first=True)
         except Exception as e:
             # 何かあってもグループを掃除して閉じる
             await self.send_json({
@@ -75,254 +313,325 @@ class BattleConsumer(AsyncJsonWebsocketConsumer):
                 await self.close(code=1011)
             return
 
-        # 監視タスク（締切 or 両者入力で解決）
-        self._turn_task = asyncio.create_task(self.turn_watcher())
-
-        # クライアント用の軽い合図
-        await self.send_json({"type": "joined", "room": self.room_code})
-
     async def disconnect(self, code):
+        drainer.untrack(self)
+        self.outq.close()
+        if getattr(self, "_counted", False):
+            self._counted = False
+            metrics.active_sockets.dec()
+        if getattr(self, "spectator", False):
+            await hub.remove(self)
+            return
+        await self._detach()
         try:
             await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
         except Exception:
             pass
 
-    # ===== DBヘルパ =====
-    @database_sync_to_async
-    def _get_room(self):
+    async def drain_close(self):
+        """停止前: 再接続の待ち時間（ずらしたもの）を伝えて閉じる"""
+        await self.send_json(reconnect_hint())
+        await self.close(code=CLOSE_SERVICE_RESTART)
+
+    def shed(self):
+        """送信が追いつかないソケットを切る（再接続すれば ?since からの差分で追いつく）"""
+        if self._shedding is not None:
+            return
+        self.outq.close()
+        metrics.slow_disconnects.inc()
+        self._shedding = asyncio.ensure_future(self._shed())
+
+    async def _shed(self):
         try:
-            return Room.objects.get(code=self.room_code)
-        except Room.DoesNotExist:
-            return None
+            # 詰まっているソケットへの書き込みなので、待つのは上限まで
+            await asyncio.wait_for(self._close_with_hint(), SEND_STALL_SECONDS)
+        except Exception:
+            pass
 
-    @database_sync_to_async
-    def _save_room(self, room: Room):
-        room.save()
-
-    @database_sync_to_async
-    def _get_or_create_turn(self, room: Room):
-        # 現在ターンを常に用意
-        turn, _ = Turn.objects.get_or_create(
-            room=room,
-            number=room.turn,
-            defaults={"deadline": room.deadline or timezone.now() + timedelta(seconds=TURN_SECONDS)},
-        )
-        # 期限が過去なら延長
-        if turn.deadline < timezone.now():
-            turn.deadline = timezone.now() + timedelta(seconds=TURN_SECONDS)
-            turn.save()
-        return turn
-
-    # 注意: 次ターン作成は _resolve() の中から**同期関数**で直接呼ぶため
-    # デコレータを付けない（そこでDB操作をまとめて行う）
-    def _create_next_turn_sync(self, room: Room):
-        room.turn += 1
-        room.deadline = timezone.now() + timedelta(seconds=TURN_SECONDS)
-        room.save()
-        Turn.objects.create(room=room, number=room.turn, deadline=room.deadline)
-
-    @database_sync_to_async
-    def _join_room(self, room: Room, pid: str):
-        changed = False
-        if not room.p1_id:
-            room.p1_id = pid; changed = True
-        elif room.p1_id != pid and not room.p2_id:
-            room.p2_id = pid; changed = True
-        if changed:
-            room.save()
-        return (room.p1_id == pid and 1) or (room.p2_id == pid and 2) or 0
-
-    async def join_room(self):
-        room = await self._get_room()
-        if not room:
-            room = Room(code=self.room_code)
-            room.deadline = timezone.now() + timedelta(seconds=TURN_SECONDS)
-            await self._save_room(room)
-            # 最初のターン
-            await database_sync_to_async(Turn.objects.create)(
-                room=room, number=1, deadline=room.deadline
-            )
+    async def _close_with_hint(self):
+        await self.send_json(reconnect_hint())
+        await self.close(code=CLOSE_TRY_AGAIN_LATER)
+
+    async def _detach(self):
+        """対戦の経路から外れる（担当ワーカーへの参加登録を外し、締切タイマーの接続数を減らす）"""
+        sockets = _local_sockets.get(getattr(self, "room_code", None))
+        if sockets is not None:
+            sockets.discard(self)
+            if not sockets:
+                _local_sockets.pop(self.room_code, None)
+                if not cluster.is_local(self.room_code):
+                    # 他ワーカー担当の部屋は覚えていたスナップショットだけ捨てる
+                    engine.release(self.room_code)
+        if getattr(self, "_attached", False):
+            self._attached = False
+            try:
+                if cluster.is_local(self.room_code):
+                    owner_leave(self.room_code)
+                else:
+                    await cluster.send_to_owner(self.room_code, {
+                        "type": "room.leave", "room": self.room_code, "worker": cluster.worker_id,
+                    })
+            except Exception:
+                pass
+
+    async def _identify(self, query: dict) -> str:
+        if identity.SIGNED_IDENTITY:
+            # 署名の確認だけ（DBもセッションも使わない）。確認できなければ匿名IDで続行
+            return identity.verify(query.get("token", [""])[0]) or identity.new_pid()
 
-        seat = await self._join_room(room, self.player_id)
-        # 現在ターンの存在を担保
-        await self._get_or_create_turn(room)
+        # セッションが無くても匿名IDで続行
+        session = self.scope.get("session", None)
+        if session is None:
+            # セッションミドルウェア不在時のフォールバック
+            return secrets.token_hex(16)
+        pid = session.get("pid")
+        if not pid:
+            pid = secrets.token_hex(16)
+            session["pid"] = pid
+            await db_async(session.save)()
+        return pid
+
+    async def _watch(self):
+        """観戦者として登録する（状態は SpectatorHub から届く）"""
+        self.seat = 0
+        await hub.add(self)
+        await self.send_json({"type": "joined", "room": self.room_code, "spectator": True})
+
+    async def bind(self, first: bool):
+        """
+        部屋の担当ワーカーに参加を登録する。自分が担当ならその場で、
+        そうでなければ inbox に送って room.joined の返事で続きを行う。
+        """
+        self._attached = True
+        # 再接続（?since=<版数>）なら再開として登録する。担当替えの付け直しは再開ではない
+        since = self._since if first else None
+        if cluster.is_local(self.room_code):
+            seat, snap, missed = await owner_join(self.room_code, self.player_id, announce=first, since=since)
+            await self._joined(seat, snap, first, missed)
+        else:
+            self._pending_first = first
+            await cluster.send_to_owner(self.room_code, {
+                "type": "room.join", "room": self.room_code, "pid": self.player_id,
+                "announce": first, "since": since, "reply": self.channel_name, "worker": cluster.worker_id,
+            })
+
+    async def room_joined(self, event):
+        engine.remember(self.room_code, event["state"])
+        await self._joined(event["seat"], event["state"], getattr(self, "_pending_first", False),
+                           event.get("missed"))
 
+    async def _joined(self, seat: int, snap: dict, first: bool, missed: list[str] | None = None):
+        self.seat = seat
+        if not first:
+            # 担当替えによる付け直し。クライアントには差分だけ
+            await self.push_state(snap)
+            return
         if seat == 0:
-            await self.send_json({"type": "log", "text": "満室のため観戦モード（未対応）"})
-        else:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {"type": "log_msg", "text": f"Player{seat} joined."},
-            )
+            # 満室なら対戦の経路から外して観戦者に切り替える
+            await self.send_json({"type": "log", "text": "満室のため観戦モード"})
+            await self._detach()
+            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+            self.spectator = True
+            await self._watch()
+            return
+        if missed is not None:
+            # 再開: 席はそのまま。取りこぼしたログと、手元の版からの差分だけを1フレームで送る
+            self._rebase(self._since)
+            items = [{"type": "log", "text": text} for text in missed]
+            frame = self._state_frame(snap)
+            if frame is not None:
+                items.append(frame)
+            items.append({"type": "joined", "room": self.room_code, "resumed": True})
+            await self.send_json(items[0] if len(items) == 1 else {"type": "batch", "items": items})
+            return
+        # 席を持っていない ?since 付きの接続も、状態は差分だけ送る
+        if self._since is not None:
+            self._rebase(self._since)
+        await self.push_state(snap)
+        # クライアント用の軽い合図
+        await self.send_json({"type": "joined", "room": self.room_code})
 
     # ===== クライアントから受信 =====
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if not self._bucket.allow():
+            # 連打は捨てる（最初の1回だけ知らせ、続くようなら切断）
+            self._dropped += 1
+            if self._dropped == 1:
+                await self.send_json({"type": "error", "reason": "rate_limited"})
+            elif self._dropped >= INBOUND_MAX_DROPS:
+                await self.close(code=1008)  # 1008: policy violation
+            return
+        if bytes_data is not None:
+            try:
+                content = wire.decode_msgpack(bytes_data)
+            except Exception:
+                return  # 壊れたフレームは捨てる
+            await self.receive_json(content, **kwargs)
+        else:
+            await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
     async def receive_json(self, content, **kwargs):
-        if content.get("type") == "action":
-            await self.handle_action(content.get("action", "none"))
-
-    @database_sync_to_async
-    def _set_action(self, pid: str, action: str):
-        room = Room.objects.get(code=self.room_code)
-        turn, _ = Turn.objects.get_or_create(
-            room=room,
-            number=room.turn,
-            defaults={"deadline": room.deadline or timezone.now() + timedelta(seconds=TURN_SECONDS)},
-        )
-
-        # チャージ攻撃の使用可否
-        if action == "charged_attack":
-            if pid == room.p1_id and room.p1_tokens <= 0:
-                action = "none"
-            if pid == room.p2_id and room.p2_tokens <= 0:
-                action = "none"
-
-        # セット
-        if pid == room.p1_id:
-            turn.p1_action = action
-        elif pid == room.p2_id:
-            turn.p2_action = action
-        turn.save()
-        return room, turn
+        kind = content.get("type")
+        if kind == "action":
+            if self._action_at is None:
+                self._action_at = time.perf_counter()
+            await self.handle_action(wire.action_name(content.get("action", "none")))
+        elif kind == "sync" and self.spectator:
+            await hub.resync(self)
+        elif kind == "sync" and hasattr(self, "seat"):
+            # 「版数 since 以降の状態」を要求（取りこぼし・再接続時）
+            since = content.get("since")
+            self._rebase(since if isinstance(since, int) else -1)
+            await self.send_state("sync")
 
     async def handle_action(self, action: str):
-        room, turn = await self._set_action(self.player_id, action)
-        await self.channel_layer.group_send(
-            self.room_group_name, {"type": "log_msg", "text": "Action received."}
-        )
-        # 両者入力済みなら即解決
-        if turn.p1_action != "none" and turn.p2_action != "none":
-            await self.resolve_if_due(force=True)
+        if not getattr(self, "_attached", False):
+            return
+        if cluster.is_local(self.room_code):
+            await owner_action(self.room_code, self.player_id, action)
         else:
-            await self.send_state("picked")
+            await cluster.send_to_owner(self.room_code, {
+                "type": "room.action", "room": self.room_code,
+                "pid": self.player_id, "action": action,
+            })
 
-    # ===== ターン監視 =====
-    async def turn_watcher(self):
-        while True:
-            await asyncio.sleep(1)
-            await self.resolve_if_due()
+    # ===== クライアント送信 =====
+    async def send_json(self, content, close=False):
+        if self.binary:
+            await self.send(bytes_data=wire.encode_msgpack(content), close=close)
+        else:
+            await super().send_json(content, close=close)
 
-    @database_sync_to_async
-    def _resolve(self, force=False):
-        """
-        ターン解決ロジック。
-        - 両者入力済み or 締切到達で解決
-        - ガードは「自分が受ける」ダメージを0にする
-        - 次ターンを**同期的に**必ず作る
-        """
-        now = timezone.now()
-        room = Room.objects.get(code=self.room_code)
-        turn, _ = Turn.objects.get_or_create(
-            room=room,
-            number=room.turn,
-            defaults={"deadline": room.deadline or now + timedelta(seconds=TURN_SECONDS)},
-        )
-
-        if turn.resolved:
-            return room, turn, False
-
-        both_input = (turn.p1_action != "none" and turn.p2_action != "none")
-        if not force and now < turn.deadline and not both_input:
-            # まだ締切前で両者未入力
-            return room, turn, False
-
-        # === 同時ダメージ計算 ===
-        a1, a2 = turn.p1_action, turn.p2_action
-
-        def dmg(action: str) -> int:
-            if action == "attack":
-                return DMG_ATTACK
-            if action == "charged_attack":
-                return DMG_CHARGED
-            return 0
-
-        def guarded(action: str) -> bool:
-            return action == "guard"
-
-        # 相手から受けるダメージ
-        dmg_to_p1 = dmg(a2)
-        dmg_to_p2 = dmg(a1)
-
-        # ★ ガードの向き修正：自分がガードしたら自分が受けるダメージ0
-        if guarded(a1):
-            dmg_to_p1 = 0
-        if guarded(a2):
-            dmg_to_p2 = 0
-
-        # HP反映
-        room.p1_hp = max(0, room.p1_hp - dmg_to_p1)
-        room.p2_hp = max(0, room.p2_hp - dmg_to_p2)
-
-        # チャージトークン
-        if a1 == "charge":
-            room.p1_tokens += 1
-        if a2 == "charge":
-            room.p2_tokens += 1
-        if a1 == "charged_attack" and room.p1_tokens > 0:
-            room.p1_tokens -= 1
-        if a2 == "charged_attack" and room.p2_tokens > 0:
-            room.p2_tokens -= 1
-
-        # 勝敗
-        winner = None
-        if room.p1_hp <= 0 and room.p2_hp <= 0:
-            winner = None
-            room.finished = True
-        elif room.p1_hp <= 0:
-            winner = 2
-            room.finished = True
-        elif room.p2_hp <= 0:
-            winner = 1
-            room.finished = True
-
-        turn.resolved = True
-        room.winner = winner
-        room.save()
-        turn.save()
-
-        # 継続時は次ターンを**ここで確実に作る**
-        if not room.finished:
-            self._create_next_turn_sync(room)
-
-        return room, turn, True
-
-    async def resolve_if_due(self, force: bool = False):
-        room, turn, did = await self._resolve(force=force)
-        if did:
-            msg = f"Turn {turn.number} resolved: P1={turn.p1_action} / P2={turn.p2_action}"
-            await self.channel_layer.group_send(
-                self.room_group_name, {"type": "log_msg", "text": msg}
-            )
-        await self.send_state("update")
+    @classmethod
+    async def encode_json(cls, content):
+        # 区切りの空白を省いて少しでも小さく
+        return json.dumps(content, separators=(",", ":"), ensure_ascii=False)
 
-    # ===== クライアント送信 =====
+    # 部屋から届くものは送信待ちに置くだけ（書き込みを待たない）
     async def log_msg(self, event):
-        await self.send_json({"type": "log", "text": event["text"]})
-
-    @database_sync_to_async
-    def _compose_state(self, pid: str):
-        room = Room.objects.get(code=self.room_code)
-        turn, _ = Turn.objects.get_or_create(
-            room=room,
-            number=room.turn,
-            defaults={"deadline": room.deadline or timezone.now() + timedelta(seconds=TURN_SECONDS)},
-        )
-
-        you_idx = 1 if pid == room.p1_id else 2 if pid == room.p2_id else 0
-        you_hp = room.p1_hp if you_idx == 1 else room.p2_hp if you_idx == 2 else 0
-        op_hp  = room.p2_hp if you_idx == 1 else room.p1_hp if you_idx == 2 else 0
-        you_tk = room.p1_tokens if you_idx == 1 else room.p2_tokens if you_idx == 2 else 0
-        op_tk  = room.p2_tokens if you_idx == 1 else room.p1_tokens if you_idx == 2 else 0
-
-        return {
-            "turn": room.turn,
-            "deadline": (room.deadline or turn.deadline).isoformat(),
-            "finished": room.finished,
-            "winner": room.winner,
-            "you": {"index": you_idx, "hp": you_hp, "tokens": you_tk},
-            "op":  {"hp": op_hp,  "tokens": op_tk},
-        }
+        self._enqueue([event])
+
+    async def state_msg(self, event):
+        self._enqueue([event])
+
+    async def room_batch(self, event):
+        """outbox がまとめたイベント群。書くときにこのソケット向けの1フレームにする"""
+        self._enqueue(event["events"])
+
+    def _enqueue(self, events: list[dict]):
+        if self.outq.stalled():
+            self.shed()
+            return
+        for ev in events:
+            if ev["type"] == "log_msg":
+                self.outq.put_log({"type": "log", "text": ev["text"]})
+            elif ev["type"] == "state_msg":
+                engine.remember(self.room_code, ev["state"])
+                self.outq.put_state(ev["state"])
+
+    def _render(self, logs: list[dict], state: dict | None) -> dict | None:
+        """送信待ちのログと最新の状態を1フレームにする（状態は前回送った版からの差分）"""
+        items = logs
+        if state is not None:
+            frame = self._state_frame(state)
+            if frame is not None:
+                items.append(frame)
+        if not items:
+            return None
+        return wire.encode(items[0] if len(items) == 1 else {"type": "batch", "items": items}, self.binary)
 
     async def send_state(self, reason: str):
-        state = await self._compose_state(self.player_id)
-        await self.send_json({"type": "state", **state})
+        # 自分だけに送る場合（sync）もメモリ上の状態から組み立てる
+        snap = engine.latest(self.room_code)
+        if snap is not None:
+            self.outq.put_state(snap)
+
+    async def push_state(self, room_state: dict):
+        frame = self._state_frame(room_state)
+        if frame is not None:
+            await self.send_json(frame)
+
+    def _state_frame(self, room_state: dict) -> dict | None:
+        """
+        前回送った版からの差分フレーム。
+        版が進んでいない / 自分から見て何も変わっていないときは None（何も送らない）。
+        """
+        version = room_state["version"]
+        if version <= self._version or not hasattr(self, "seat"):
+            return None
+        view = project_state(room_state, self.seat)
+        if self._view is None:
+            frame = {"type": "state", "v": version, **view}
+        else:
+            delta = diff_state(self._view, view)
+            if not delta:
+                return None
+            frame = {"type": "state", "v": version, "base": self._version, "delta": delta}
+        self._view = view
+        self._version = version
+        if self._action_at is not None:
+            metrics.action_to_state_seconds.observe(time.perf_counter() - self._action_at)
+            self._action_at = None
+        return frame
+
+    def _rebase(self, since: int):
+        """クライアントが持っている版 since を差分の基準にする（残っていなければ全量）"""
+        engine.latest(self.room_code)
+        base = engine.snapshot_at(self.room_code, since) if since >= 0 else None
+        if base is None:
+            self._view, self._version = None, -1
+        else:
+            self._view, self._version = project_state(base, self.seat), since
+
+
+class MatchConsumer(AsyncJsonWebsocketConsumer):
+    """マッチメイキングの待ち行列。組めたら部屋コードを送る（クライアントはその部屋へ移る）"""
 
+    async def connect(self):
+        self._ticket = None
+        self._bucket = TokenBucket()
+        await self.accept()
+        if drainer.draining:
+            await self.drain_close()
+            return
+        drainer.track(self)
+        cluster.ensure_started()
+
+    async def drain_close(self):
+        await self.send_json(reconnect_hint())
+        await self.close(code=CLOSE_SERVICE_RESTART)
+
+    async def disconnect(self, code):
+        drainer.untrack(self)
+        if self._ticket is not None:
+            try:
+                await matchmaking.withdraw(self._ticket["region"], self._ticket["id"])
+            except Exception:
+                pass
+
+    async def receive_json(self, content, **kwargs):
+        if not self._bucket.allow():
+            return
+        kind = content.get("type")
+        if kind == "enqueue" and self._ticket is None:
+            rating = content.get("rating")
+            region = content.get("region")
+            self._ticket = {
+                "id": self.channel_name,
+                "reply": self.channel_name,
+                "rating": rating if isinstance(rating, int) and not isinstance(rating, bool) else 1500,
+                "region": region if isinstance(region, str) and region.isalnum() and len(region) <= 16
+                          else matchmaking.DEFAULT_REGION,
+                "since": time.time(),
+            }
+            await matchmaking.submit(self._ticket)
+            await self.send_json({"type": "queued", "region": self._ticket["region"]})
+        elif kind == "cancel" and self._ticket is not None:
+            await matchmaking.withdraw(self._ticket["region"], self._ticket["id"])
+            self._ticket = None
+            await self.send_json({"type": "cancelled"})
+
+    async def match_found(self, event):
+        self._ticket = None
+        await self.send_json({"type": "matched", "room": event["room"]})
+        await self.close()
@@ -0,0 +1,70 @@
+"""
+ホットパス（部屋の読み込み・write-behind のフラッシュ）用のDB実行プール。
+
+database_sync_to_async は thread_sensitive=True のため、全部屋のDB処理が
+1本のスレッドに並んでしまう（Django 5.0 の aget / asave も内部は同じ経路）。
+ここでは件数上限つきの専用スレッドプール（thread_sensitive=False）で実行し、
+コア数に応じて並列に流せるようにする。
+
+各スレッドは自分のDB接続を持ち続けるので、CONN_MAX_AGE / CONN_HEALTH_CHECKS に
+従って使い回す（実行前に close_old_connections で期限切れ・切断済みを捨てる）。
+SQLite は書き込みが直列なので、プールは1本にしておく。
+"""
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+from . import metrics
+
+
+def _default_pool_size() -> int:
+    if settings.DATABASES["default"]["ENGINE"].endswith("sqlite3"):
+        return 1
+    return 8
+
+
+DB_POOL_SIZE = getattr(settings, "ARENA_DB_POOL_SIZE", 0) or _default_pool_size()
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="arena-db")
+
+# プールで走る処理すべてに付ける execute ラッパ（計測用。接続はスレッドごとなので実行のたびに付ける）
+_watchers: list = []
+
+
+def watch_queries(wrapper):
+    _watchers.append(wrapper)
+
+
+def unwatch_queries(wrapper):
+    if wrapper in _watchers:
+        _watchers.remove(wrapper)
+
+
+def _with_fresh_connection(func, *args, **kwargs):
+    close_old_connections()
+    added = [w for w in _watchers if w not in connection.execute_wrappers]
+    connection.execute_wrappers.extend(added)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        for w in added:
+            connection.execute_wrappers.remove(w)
+
+
+def db_async(func):
+    """同期のDB関数を、専用プールで動くコルーチン関数にする"""
+    run = sync_to_async(_with_fresh_connection, thread_sensitive=False, executor=_executor)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+
+    return wrapper
+
+
+metrics.registry.gauge("arena_db_pool_size", "Threads in the arena DB pool", lambda: DB_POOL_SIZE)
+metrics.registry.gauge("arena_db_pool_queue_depth", "DB jobs waiting for a pool thread",
+                       lambda: _executor._work_queue.qsize())
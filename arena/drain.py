@@ -0,0 +1,129 @@
+"""
+停止前の drain（ローリングデプロイ用）。
+
+SIGTERM を受けたら、プロセスを止める前に:
+
+    1. 新しい接続を受けない（来たら再接続の案内を送って閉じる）
+    2. リングから抜ける（cluster.leave）。担当の部屋は書き出してから新しい担当へ
+       room.handoff で渡り、締切タイマーも新しい担当で張り直される
+    3. 開いているソケットに {"type": "reconnect", "after_ms": <ずらした待ち時間>} を送って
+       1012（サービス再起動）で閉じる。クライアントは待ち時間だけ待って ?since つきで
+       再接続するので、全員が同時に戻ってくることはない
+    4. 部屋がメモリから無くなる（引き渡し済み・書き出し済み）まで待つ（上限 DRAIN_TIMEOUT）
+
+終わったら元の SIGTERM ハンドラ（uvicorn の終了処理）を呼ぶ。drain 中にもう一度
+SIGTERM が来たら待たずに元のハンドラへ渡す。
+
+ハンドラはワーカーの起動時（cluster.ensure_started）にメインスレッドで差し込む。
+"""
+import asyncio
+import logging
+import random
+import signal
+
+from django.conf import settings
+
+from .engine import engine
+from .outbox import outbox
+from .sharding import cluster
+
+logger = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT = getattr(settings, "ARENA_DRAIN_TIMEOUT", 30.0)          # 秒
+RECONNECT_JITTER_MS = getattr(settings, "ARENA_RECONNECT_JITTER_MS", 5000)
+RECONNECT_MIN_MS = 250
+CLOSE_SERVICE_RESTART = 1012
+
+
+def reconnect_hint() -> dict:
+    return {"type": "reconnect", "after_ms": random.randint(RECONNECT_MIN_MS, RECONNECT_JITTER_MS)}
+
+
+class Drainer:
+    def __init__(self):
+        self.draining = False
+        # 開いているソケット（drain_close() を持つ consumer）
+        self.sockets: set = set()
+
+    def track(self, consumer):
+        self.sockets.add(consumer)
+
+    def untrack(self, consumer):
+        self.sockets.discard(consumer)
+
+    async def drain(self, timeout: float = DRAIN_TIMEOUT) -> bool:
+        """部屋をすべて手放せたら True（時間切れなら False）"""
+        if self.draining:
+            return False
+        self.draining = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        logger.info("draining: %d rooms, %d sockets", len(engine.rooms), len(self.sockets))
+
+        await cluster.leave()
+        await asyncio.gather(*[c.drain_close() for c in list(self.sockets)], return_exceptions=True)
+        while True:
+            await engine.flush()
+            if not engine.rooms or loop.time() >= deadline:
+                break
+            await asyncio.sleep(0.1)
+        await outbox.drain()
+        if engine.rooms:
+            logger.warning("drain timed out with %d rooms in memory", len(engine.rooms))
+        return not engine.rooms
+
+    def clear(self):
+        """テスト用"""
+        self.__init__()
+
+
+# プロセス内で1つだけ
+drainer = Drainer()
+
+
+# ===== SIGTERM =====
+_loop: asyncio.AbstractEventLoop | None = None
+_previous = None
+
+
+def _on_sigterm(signum, frame):
+    if drainer.draining or _loop is None or _loop.is_closed():
+        _hand_over(signum, frame)
+        return
+    _loop.call_soon_threadsafe(_start_drain, signum)
+
+
+def _start_drain(signum):
+    task = asyncio.ensure_future(drainer.drain())
+    task.add_done_callback(lambda t: _drained(t, signum))
+
+
+def _drained(task: asyncio.Task, signum):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("drain failed", exc_info=task.exception())
+    _hand_over(signum, None)
+
+
+def _hand_over(signum, frame):
+    """元のハンドラ（uvicorn の終了処理など）へ渡す"""
+    if callable(_previous):
+        _previous(signum, frame)
+    else:
+        signal.signal(signum, _previous if _previous is not None else signal.SIG_DFL)
+        signal.raise_signal(signum)
+
+
+async def _install():
+    global _loop, _previous
+    _loop = asyncio.get_running_loop()
+    if _previous is None:
+        try:
+            _previous = signal.getsignal(signal.SIGTERM)
+            signal.signal(signal.SIGTERM, _on_sigterm)
+        except ValueError:
+            _previous = None  # メインスレッド以外（テストなど）では差し込まない
+    # ensure_started が張り直さないよう、ループの間は終わらずに待つ
+    await asyncio.Event().wait()
+
+
+cluster.add_loop(_install)
@@ -0,0 +1,598 @@
+"""
+インメモリのルーム状態エンジン（write-behind 永続化つき）。
+
+対戦中のルームはこのプロセスのメモリ上の RoomState が正（authoritative）で、
+アクション受付・ターン解決・状態表示はDBを待たずにメモリだけで完結する。
+Room / Turn への書き込みは変更点を溜めておき、FLUSH_INTERVAL 秒ごとに
+まとめて（bulk_update / bulk_create の upsert で）非同期に流す。
+
+クラッシュ時に失われうる状態の上限:
+    直近 FLUSH_INTERVAL 秒 + 実行中のフラッシュ1回分の変更。
+    （既定 1 秒。settings.ARENA_FLUSH_INTERVAL で変更可）
+    フラッシュが失敗した分は次回に持ち越して再送する。
+"""
+import asyncio
+import logging
+from collections import deque
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, OuterRef, Q, Subquery, Value, When
+from django.utils import timezone
+
+from . import metrics, rules
+from .db import db_async
+from .models import ACTIONS, Room, Turn
+from .rooms import rooms
+from .rules import START_HP, TURN_SECONDS
+
+logger = logging.getLogger(__name__)
+
+ACTION_NAMES = frozenset(a for a, _ in ACTIONS)
+
+FLUSH_INTERVAL = getattr(settings, "ARENA_FLUSH_INTERVAL", 1.0)
+
+# 差分配信用に部屋ごとに残す過去スナップショット数
+HISTORY_SIZE = 8
+# 再接続（再開）用に部屋ごとに残すログの件数
+EVENT_BUFFER = 32
+
+ROOM_FIELDS = ["p1_id", "p2_id", "p1_hp", "p2_hp", "p1_tokens", "p2_tokens",
+               "turn", "deadline", "version", "finished", "winner"]
+TURN_FIELDS = ["deadline", "resolved", "p1_action", "p2_action"]
+FLUSH_CHUNK = 200       # 1文あたりの行数（SQLite の変数上限対策）
+
+
+@dataclass(slots=True)
+class RoomState:
+    """1ルーム分の最小限の状態（現在ターンの入力を含む）"""
+    code: str
+    room_id: int | None     # DBに行がまだ無い部屋は None
+    p1_id: str | None
+    p2_id: str | None
+    p1_hp: int
+    p2_hp: int
+    p1_tokens: int
+    p2_tokens: int
+    turn: int
+    deadline: datetime
+    version: int
+    finished: bool
+    winner: int | None
+    p1_action: str = "none"
+    p2_action: str = "none"
+
+    def seat_of(self, pid: str) -> int:
+        return 1 if pid == self.p1_id else 2 if pid == self.p2_id else 0
+
+    def both_input(self) -> bool:
+        return self.p1_action != "none" and self.p2_action != "none"
+
+    def to_wire(self) -> dict:
+        """ワーカー間の受け渡し用（チャンネルレイヤで送れる形）"""
+        data = asdict(self)
+        data["deadline"] = self.deadline.isoformat()
+        return data
+
+    @classmethod
+    def from_wire(cls, data: dict) -> "RoomState":
+        return cls(**{**data, "deadline": datetime.fromisoformat(data["deadline"])})
+
+    def snapshot(self) -> dict:
+        """部屋共通の状態（席ごとの見え方は受け手側で組み立てる）"""
+        return {
+            "version": self.version,
+            "turn": self.turn,
+            "deadline": self.deadline.isoformat(),
+            "finished": self.finished,
+            "winner": self.winner,
+            "p1": {"hp": self.p1_hp, "tokens": self.p1_tokens},
+            "p2": {"hp": self.p2_hp, "tokens": self.p2_tokens},
+        }
+
+
+@dataclass(slots=True)
+class ResolvedTurn:
+    number: int
+    p1_action: str
+    p2_action: str
+
+
+# ===== ルール（本体は arena.rules） =====
+def _fighters(state: RoomState) -> rules.Fighters:
+    return rules.Fighters(state.p1_hp, state.p2_hp, state.p1_tokens, state.p2_tokens)
+
+
+def _apply(state: RoomState, f: rules.Fighters):
+    state.p1_hp, state.p2_hp, state.p1_tokens, state.p2_tokens = f.p1_hp, f.p2_hp, f.p1_tokens, f.p2_tokens
+    state.winner = f.winner
+    if f.finished:
+        state.finished = True
+
+
+# ===== DB読み込み / 書き込み（arena.db のプールで実行） =====
+def _load_sync(room_code: str) -> RoomState:
+    now = timezone.now()
+    with metrics.counting_queries(metrics.db_queries_load):
+        # 通常は current_turn の JOIN 1回で部屋と現在ターンがそろう
+        room = Room.objects.select_related("current_turn").filter(code=room_code).first()
+        if room is None:
+            room, _ = Room.objects.get_or_create(
+                code=room_code,
+                defaults={"deadline": now + timedelta(seconds=TURN_SECONDS)},
+            )
+        turn = room.current_turn
+        if turn is None or turn.number != room.turn:
+            # 参照が無い・ずれている（作りたて・古い行）ときだけ引き直して付け替える
+            turn, _ = Turn.objects.get_or_create(
+                room=room,
+                number=room.turn,
+                defaults={"deadline": room.deadline or now + timedelta(seconds=TURN_SECONDS)},
+            )
+            Room.objects.filter(pk=room.pk).update(current_turn=turn)
+    return _state_from(room, turn)
+
+
+def _load_many_sync(codes: list[str]) -> dict[str, RoomState]:
+    """まとめて読み込む（SELECT 1回。現在ターンへの参照が無い古い行だけ1件ずつ読み直す）"""
+    with metrics.counting_queries(metrics.db_queries_load):
+        found = list(Room.objects.select_related("current_turn").filter(code__in=codes))
+    states = {}
+    for room in found:
+        turn = room.current_turn
+        if turn is not None and turn.number == room.turn:
+            states[room.code] = _state_from(room, turn)
+        else:
+            states[room.code] = _load_sync(room.code)
+    return states
+
+
+def _state_from(room: Room, turn: Turn) -> RoomState:
+    return RoomState(
+        code=room.code, room_id=room.pk,
+        p1_id=room.p1_id, p2_id=room.p2_id,
+        p1_hp=room.p1_hp, p2_hp=room.p2_hp,
+        p1_tokens=room.p1_tokens, p2_tokens=room.p2_tokens,
+        turn=room.turn, deadline=turn.deadline, version=room.version,
+        finished=room.finished, winner=room.winner,
+        p1_action=turn.p1_action, p2_action=turn.p2_action,
+    )
+
+
+def _new_state(room_code: str) -> RoomState:
+    """台帳で払い出したばかりの部屋（DBに行はまだ無い。最初のフラッシュで作る）"""
+    return RoomState(
+        code=room_code, room_id=None, p1_id=None, p2_id=None,
+        p1_hp=START_HP, p2_hp=START_HP, p1_tokens=0, p2_tokens=0,
+        turn=1, deadline=timezone.now() + timedelta(seconds=TURN_SECONDS), version=0,
+        finished=False, winner=None,
+    )
+
+
+def _insert_rooms_sync(codes: list[str]) -> dict[str, int]:
+    """
+    新しい部屋の行を作って pk を返す。同じコードの行がすでにあるコードは作らない
+    （返り値に含めない）。既存の行は消さない（アーカイブ前の対戦かもしれない）。
+    """
+    with metrics.counting_queries(metrics.db_queries_flush), transaction.atomic():
+        taken = set(Room.objects.filter(code__in=codes).values_list("code", flat=True))
+        if taken:
+            logger.error("allocated room codes already have rows; keeping the rows: %s", sorted(taken))
+        created = Room.objects.bulk_create([Room(code=c) for c in codes if c not in taken])
+    return {r.code: r.pk for r in created}
+
+
+def _case(keys: list[Q], rows: list[dict], field: str, model):
+    """行ごとの値を1つの UPDATE に詰める CASE WHEN 式（keys[i] が rows[i] の行を指す）"""
+    return Case(
+        *[When(k, then=Value(r[field])) for k, r in zip(keys, rows)],
+        output_field=model._meta.get_field(field),
+    )
+
+
+def _flush_sync(rooms: list[dict], turns: list[dict]):
+    """
+    条件付き UPDATE でまとめて書く（重複・古い書き込みで壊さない）。
+    - Room: 手元より新しい version が既に書かれていれば上書きしない
+    - Turn: 一度 resolved=True になった行は二度と書き換えない
+    - Room.current_turn: 書いた後の Room.turn の行へ付け替える（UPDATE 1回 / チャンク）
+    """
+    with metrics.counting_queries(metrics.db_queries_flush), transaction.atomic():
+        for i in range(0, len(rooms), FLUSH_CHUNK):
+            chunk = rooms[i:i + FLUSH_CHUNK]
+            keys = [Q(pk=r["pk"]) for r in chunk]
+            Room.objects.filter(
+                pk__in=[r["pk"] for r in chunk],
+                version__lt=_case(keys, chunk, "version", Room),
+            ).update(**{f: _case(keys, chunk, f, Room) for f in ROOM_FIELDS})
+
+        for i in range(0, len(turns), FLUSH_CHUNK):
+            chunk = turns[i:i + FLUSH_CHUNK]
+            keys = [Q(room_id=t["room_id"], number=t["number"]) for t in chunk]
+            # 無い行だけ作る（既存行は下の条件付き UPDATE で）
+            Turn.objects.bulk_create([Turn(**t) for t in chunk], ignore_conflicts=True)
+            any_key = Q()
+            for k in keys:
+                any_key |= k
+            Turn.objects.filter(any_key, resolved=False).update(
+                **{f: _case(keys, chunk, f, Turn) for f in TURN_FIELDS}
+            )
+
+        current = Subquery(
+            Turn.objects.filter(room_id=OuterRef("pk"), number=OuterRef("turn")).values("pk")[:1]
+        )
+        for i in range(0, len(rooms), FLUSH_CHUNK):
+            Room.objects.filter(pk__in=[r["pk"] for r in rooms[i:i + FLUSH_CHUNK]]).update(current_turn=current)
+
+
+class RoomEngine:
+    def __init__(self):
+        self.rooms: dict[str, RoomState] = {}
+        self._loading: dict[str, asyncio.Future] = {}
+        self._released: set[str] = set()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._history: dict[str, deque] = {}
+        self._events: dict[str, deque] = {}
+        # write-behind バッファ
+        self._dirty_rooms: set[str] = set()
+        self._evicted: dict[str, RoomState] = {}
+        self._dirty_turns: dict[tuple[str, int], dict] = {}
+        self._flusher: asyncio.Task | None = None
+
+    # ===== ルームの取得 =====
+    def get(self, room_code: str) -> RoomState | None:
+        return self.rooms.get(room_code)
+
+    async def acquire(self, room_code: str) -> RoomState:
+        """メモリに無ければDBから1回だけ読み込む（同時 acquire は待ち合わせ）"""
+        self._ensure_flusher()
+        self._released.discard(room_code)
+        state = self.rooms.get(room_code)
+        if state is not None:
+            return state
+        pending = self._loading.get(room_code)
+        if pending is not None:
+            state = await asyncio.shield(pending)
+            if state is not None:
+                return state
+            # まとめ読み（preload）で見つからなかった部屋。改めて1件で読む
+            return await self.acquire(room_code)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[room_code] = fut
+        try:
+            if await rooms.claim_load(room_code):
+                # 払い出し直後の部屋はDBを見ずに初期状態から（行は最初のフラッシュで作る）
+                state = _new_state(room_code)
+                self._mark_room(state)
+                self._mark_turn(state)
+            else:
+                state = await db_async(_load_sync)(room_code)
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # 待ち手がいなくても警告を出さない
+            raise
+        finally:
+            self._loading.pop(room_code, None)
+        self.rooms[room_code] = state
+        fut.set_result(state)
+        return state
+
+    async def preload(self, codes: list[str]) -> dict[str, RoomState]:
+        """
+        メモリに無い部屋をまとめて1回で読み込み、読めた分を返す（締切の掃除用）。
+        読み込み中に来た acquire はこの結果を待ち合わせる。
+        """
+        self._ensure_flusher()
+        codes = [c for c in dict.fromkeys(codes) if c not in self.rooms and c not in self._loading]
+        if not codes:
+            return {}
+        loop = asyncio.get_running_loop()
+        futures = {c: loop.create_future() for c in codes}
+        self._loading.update(futures)
+        try:
+            states = await db_async(_load_many_sync)(codes)
+        except Exception as e:
+            for fut in futures.values():
+                fut.set_exception(e)
+                fut.exception()
+            raise
+        finally:
+            for c in codes:
+                self._loading.pop(c, None)
+        for code, fut in futures.items():
+            state = states.get(code)
+            if state is not None:
+                self.rooms[code] = state
+            fut.set_result(state)
+        return states
+
+    def snapshot(self, state: RoomState) -> dict:
+        """現在版のスナップショット（同じ版なら使い回す）。直近 HISTORY_SIZE 版を保持する"""
+        hist = self._history.get(state.code)
+        if hist is None:
+            hist = self._history[state.code] = deque(maxlen=HISTORY_SIZE)
+        if hist and hist[-1]["version"] == state.version:
+            return hist[-1]
+        snap = state.snapshot()
+        hist.append(snap)
+        return snap
+
+    def latest(self, room_code: str) -> dict | None:
+        """最新スナップショット。他ワーカー担当の部屋は受け取った最後のもの"""
+        state = self.rooms.get(room_code)
+        if state is not None:
+            return self.snapshot(state)
+        hist = self._history.get(room_code)
+        return hist[-1] if hist else None
+
+    def remember(self, room_code: str, snap: dict):
+        """他ワーカー担当の部屋のスナップショットを差分の基準として覚えておく"""
+        if room_code in self.rooms:
+            return
+        hist = self._history.get(room_code)
+        if hist is None:
+            hist = self._history[room_code] = deque(maxlen=HISTORY_SIZE)
+        if not hist or hist[-1]["version"] < snap["version"]:
+            hist.append(snap)
+
+    def snapshot_at(self, room_code: str, version: int) -> dict | None:
+        """過去版のスナップショット。もう残っていなければ None"""
+        for snap in self._history.get(room_code, ()):
+            if snap["version"] == version:
+                return snap
+        return None
+
+    def record(self, room_code: str, text: str):
+        """部屋のログを再開用に残す（その時点の版数つき。直近 EVENT_BUFFER 件）"""
+        state = self.rooms.get(room_code)
+        if state is None:
+            return
+        events = self._events.get(room_code)
+        if events is None:
+            events = self._events[room_code] = deque(maxlen=EVENT_BUFFER)
+        events.append((state.version, text))
+
+    def events_since(self, room_code: str, version: int) -> list[str]:
+        """版 version より後のログ（バッファから溢れた分は返らない）"""
+        return [text for v, text in self._events.get(room_code, ()) if v > version]
+
+    def lock(self, room_code: str) -> asyncio.Lock:
+        """部屋ごとのロック。入力→解決→配信の一連をこの中で行う"""
+        lock = self._locks.get(room_code)
+        if lock is None:
+            lock = self._locks[room_code] = asyncio.Lock()
+        return lock
+
+    def release(self, room_code: str):
+        """このプロセスに接続が無くなった部屋。次のフラッシュ後にメモリから外す"""
+        if room_code in self.rooms:
+            self._released.add(room_code)
+        else:
+            self._history.pop(room_code, None)
+
+    def evict(self, room_code: str) -> RoomState | None:
+        """
+        担当を外れた部屋をメモリから外す（未書き出しの変更は次のフラッシュで書く）。
+        外した状態を返すので、呼び出し側で新しいオーナーへ渡す。
+        """
+        state = self.rooms.pop(room_code, None)
+        if state is None:
+            return None
+        if room_code in self._dirty_rooms:
+            self._dirty_rooms.discard(room_code)
+            self._evicted[room_code] = state
+        self._released.discard(room_code)
+        self._history.pop(room_code, None)
+        self._events.pop(room_code, None)
+        self._locks.pop(room_code, None)
+        return state
+
+    def install(self, state: RoomState) -> bool:
+        """引き継いだ状態を載せる。手元の方が新しければ何もしない"""
+        current = self.rooms.get(state.code)
+        if current is not None and current.version >= state.version:
+            return False
+        self.rooms[state.code] = state
+        self._history.pop(state.code, None)
+        self._events.pop(state.code, None)
+        return True
+
+    # ===== 操作（すべてメモリ上・await なし） =====
+    def join(self, state: RoomState, pid: str) -> int:
+        if not state.p1_id:
+            state.p1_id = pid
+            self._mark_room(state)
+        elif state.p1_id != pid and not state.p2_id:
+            state.p2_id = pid
+            self._mark_room(state)
+        # 期限が過去なら延長
+        if not state.finished and state.deadline < timezone.now():
+            state.deadline = timezone.now() + timedelta(seconds=TURN_SECONDS)
+            self._mark_room(state)
+            self._mark_turn(state)
+        return state.seat_of(pid)
+
+    def set_action(self, state: RoomState, pid: str, action: str):
+        if state.finished:
+            return
+        if action not in ACTION_NAMES:
+            action = "none"
+        seat = state.seat_of(pid)
+        # チャージ攻撃の使用可否
+        if action == "charged_attack":
+            if seat == 1 and state.p1_tokens <= 0:
+                action = "none"
+            if seat == 2 and state.p2_tokens <= 0:
+                action = "none"
+        if seat == 1:
+            state.p1_action = action
+        elif seat == 2:
+            state.p2_action = action
+        else:
+            return
+        self._mark_turn(state)
+
+    def resolve(self, state: RoomState, force: bool = False, turn: int | None = None) -> ResolvedTurn | None:
+        """
+        両者入力済み or 締切到達で現在ターンを解決し、継続時は次ターンへ進める。
+        turn を渡した場合はそのターンがまだ現在ターンのときだけ解決する
+        （同じターンを二重に解決しないため）。解決しなかったときは None。
+        """
+        now = timezone.now()
+        if not self._due(state, now, force, turn):
+            return None
+        return self._advance(state, rules.resolve(_fighters(state), state.p1_action, state.p2_action), now)
+
+    def resolve_many(self, states: list[RoomState]) -> dict[str, ResolvedTurn]:
+        """締切の来た部屋をまとめて解決する（ルールの計算は resolve_batch の1回）。解決した分を返す"""
+        now = timezone.now()
+        due = [s for s in states if self._due(s, now, False, None)]
+        outcomes = rules.resolve_batch(
+            [_fighters(s) for s in due], [s.p1_action for s in due], [s.p2_action for s in due]
+        )
+        return {s.code: self._advance(s, f, now) for s, f in zip(due, outcomes)}
+
+    @staticmethod
+    def _due(state: RoomState, now: datetime, force: bool, turn: int | None) -> bool:
+        if state.finished or (turn is not None and turn != state.turn):
+            return False
+        # 締切前で両者未入力なら、まだ
+        return force or now >= state.deadline or state.both_input()
+
+    def _advance(self, state: RoomState, outcome: rules.Fighters, now: datetime) -> ResolvedTurn:
+        a1, a2 = state.p1_action, state.p2_action
+        _apply(state, outcome)
+        done = ResolvedTurn(number=state.turn, p1_action=a1, p2_action=a2)
+        self._dirty_turns[(state.code, state.turn)] = {
+            "room_id": state.room_id, "number": state.turn, "deadline": state.deadline,
+            "resolved": True, "p1_action": a1, "p2_action": a2,
+        }
+
+        # 継続時は次ターンを**ここで確実に作る**
+        if not state.finished:
+            state.turn += 1
+            state.deadline = now + timedelta(seconds=TURN_SECONDS)
+            state.p1_action = state.p2_action = "none"
+            self._mark_turn(state)
+        self._mark_room(state)
+        return done
+
+    def abandon(self, state: RoomState):
+        """放置された部屋を勝敗なしで終わらせる（現在ターンは入力なしのまま解決済みにする）"""
+        if state.finished:
+            return
+        self._dirty_turns[(state.code, state.turn)] = {
+            "room_id": state.room_id, "number": state.turn, "deadline": state.deadline,
+            "resolved": True, "p1_action": state.p1_action, "p2_action": state.p2_action,
+        }
+        state.finished = True
+        state.winner = None
+        self._mark_room(state)
+
+    # ===== write-behind =====
+    @staticmethod
+    def _room_row(state: RoomState) -> dict:
+        return {"pk": state.room_id, "code": state.code, **{f: getattr(state, f) for f in ROOM_FIELDS}}
+
+    def _mark_room(self, state: RoomState):
+        state.version += 1
+        self._dirty_rooms.add(state.code)
+
+    def _mark_turn(self, state: RoomState):
+        self._dirty_turns[(state.code, state.turn)] = {
+            "room_id": state.room_id, "number": state.turn, "deadline": state.deadline,
+            "resolved": False, "p1_action": state.p1_action, "p2_action": state.p2_action,
+        }
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("room state flush failed")
+
+    async def flush(self):
+        """溜まった変更を1トランザクションでDBへ書き出す"""
+        await self._insert_new_rooms()
+        rooms = [self._room_row(s) for s in self._evicted.values()]
+        for code in self._dirty_rooms:
+            s = self.rooms.get(code)
+            if s is not None:
+                rooms.append(self._room_row(s))
+        turns = list(self._dirty_turns.values())
+        dirty_rooms, dirty_turns, evicted = self._dirty_rooms, self._dirty_turns, self._evicted
+        self._dirty_rooms, self._dirty_turns, self._evicted = set(), {}, {}
+        try:
+            if rooms or turns:
+                with metrics.flush_seconds.time():
+                    await db_async(_flush_sync)(rooms, turns)
+        except Exception:
+            # 書けなかった分は次回へ持ち越し（新しい変更を優先）
+            self._dirty_rooms |= dirty_rooms
+            for code, s in evicted.items():
+                self._evicted.setdefault(code, s)
+            for key, t in dirty_turns.items():
+                self._dirty_turns.setdefault(key, t)
+            raise
+
+        # 接続の無くなった部屋は書き出し後にメモリから外す
+        for code in list(self._released):
+            if code not in self._dirty_rooms and not any(k[0] == code for k in self._dirty_turns):
+                self.rooms.pop(code, None)
+                self._history.pop(code, None)
+                self._events.pop(code, None)
+                self._locks.pop(code, None)
+                self._released.discard(code)
+
+    async def _insert_new_rooms(self):
+        """まだ行の無い部屋を先に作り、pk を状態と未書き出しの変更に反映する"""
+        new = {c: self.rooms[c] for c in self._dirty_rooms if c in self.rooms}
+        new.update(self._evicted)
+        new = {c: s for c, s in new.items() if s.room_id is None}
+        if not new:
+            return
+        pks = await db_async(_insert_rooms_sync)(list(new))
+        for code, pk in pks.items():
+            new[code].room_id = pk
+        for code in new.keys() - pks.keys():
+            # 行が先にあった: 手元の初期状態は書かずに捨て、次の読み込みでDBの行を使う
+            self._discard(code)
+        for (code, _), t in self._dirty_turns.items():
+            if t["room_id"] is None and code in pks:
+                t["room_id"] = pks[code]
+
+    def _discard(self, room_code: str):
+        """書き出さずにメモリから外す"""
+        self.rooms.pop(room_code, None)
+        self._evicted.pop(room_code, None)
+        self._dirty_rooms.discard(room_code)
+        for key in [k for k in self._dirty_turns if k[0] == room_code]:
+            del self._dirty_turns[key]
+        self._history.pop(room_code, None)
+        self._events.pop(room_code, None)
+        self._released.discard(room_code)
+
+    def clear(self):
+        """テスト用: メモリ上の状態をすべて捨てる"""
+        if self._flusher is not None and not self._flusher.done():
+            try:
+                self._flusher.cancel()
+            except RuntimeError:
+                pass  # ループ終了済み
+        self.__init__()
+
+
+# プロセス内で1つだけ
+engine = RoomEngine()
+
+metrics.registry.gauge("arena_active_rooms", "Rooms held in memory by this worker", lambda: len(engine.rooms))
+metrics.registry.gauge("arena_dirty_rooms", "Rooms with changes waiting for the next flush",
+                       lambda: len(engine._dirty_rooms) + len(engine._evicted))
@@ -0,0 +1,56 @@
+"""
+署名つきのプレイヤーID（セッションDBを使わない本人確認。ARENA_SIGNED_IDENTITY で有効）。
+
+views.room がプレイヤーIDに期限つきの署名をつけたトークンを発行してページに埋め込み、
+ソケットは ?token=<トークン> で接続する。接続時の確認は HMAC の計算だけで、
+セッション・認証のミドルウェアも通さない（asgi.py）ので、障害明けの再接続が
+一斉に来てもDBには何も来ない。
+
+同じブラウザが同じIDを使い続けられるよう、ID自体は署名つき Cookie（arena_pid）に置く。
+静的ページモード（pages.STATIC_PAGES）ではページの本文を全員で共有するので、
+トークンはページに埋めずに JS から読める Cookie（arena_token）で渡す。
+トークンが検証できない（改ざん・期限切れ）接続は、使い捨ての匿名IDで続行する。
+"""
+import secrets
+
+from django.conf import settings
+from django.core import signing
+
+SIGNED_IDENTITY = getattr(settings, "ARENA_SIGNED_IDENTITY", False)
+TOKEN_TTL = getattr(settings, "ARENA_PLAYER_TOKEN_TTL", 24 * 3600)   # 秒
+COOKIE = "arena_pid"
+TOKEN_COOKIE = "arena_token"
+_SALT = "arena.player"
+
+_signer = signing.TimestampSigner(salt=_SALT)
+
+
+def new_pid() -> str:
+    return secrets.token_hex(16)
+
+
+def issue(pid: str) -> str:
+    return _signer.sign(pid)
+
+
+def verify(token: str) -> str | None:
+    """トークンのプレイヤーID（改ざん・期限切れなら None）"""
+    try:
+        return _signer.unsign(token, max_age=TOKEN_TTL)
+    except signing.BadSignature:
+        return None
+
+
+def player_of(request) -> str | None:
+    return request.get_signed_cookie(COOKIE, default=None, salt=_SALT, max_age=TOKEN_TTL)
+
+
+def remember(response, pid: str):
+    response.set_signed_cookie(COOKIE, pid, salt=_SALT, max_age=TOKEN_TTL,
+                               httponly=True, samesite="Lax", secure=settings.SESSION_COOKIE_SECURE)
+
+
+def hand_token(response, pid: str):
+    """トークンを Cookie で渡す（ページの JS が読んで ?token= に付ける）"""
+    response.set_cookie(TOKEN_COOKIE, issue(pid), max_age=TOKEN_TTL,
+                        samesite="Lax", secure=settings.SESSION_COOKIE_SECURE)
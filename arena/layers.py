@@ -0,0 +1,189 @@
+"""
+同じワーカー内の宛先へはメモリで直接届けるチャンネルレイヤ（RedisChannelLayer の拡張）。
+
+部屋の2人が同じワーカーに繋いでいる（よくある）場合、RedisChannelLayer の group_send は
+自分宛てのメッセージを Redis に書いて自分で BRPOP し直す。ここでは:
+
+    - このプロセスのチャンネル（"<prefix>.<client_prefix>!..."）のグループ所属を手元でも持つ
+    - group_send / send でこのプロセスのチャンネル宛ては receive_buffer へ直接入れる
+      （Redis を往復しない。受け手は通常の receive でそのまま受け取る）
+    - グループの所属は従来どおり Redis にも書くので、他ワーカーからの group_send は変わらない
+    - group_send は所属一覧を1往復で読み、他ワーカーの宛先があるときだけ
+      その分を従来の Lua で書く（自分宛てのペイロードは Redis に載せない）
+    - receive はこのプロセスのチャンネルなら自分の receive_buffer を待つだけにする。
+      Redis からの受信はプロセスで1本のタスク（_pull_loop）が BRPOP して各 buffer に
+      振り分ける（RedisChannelLayer.receive では受信ロックを持った1人が BRPOP で待つので、
+      その1人は buffer に直接入れたメッセージに Redis に何か届くまで気づかない）
+
+settings.CHANNEL_LAYERS の BACKEND に "arena.layers.HybridChannelLayer" を指定して使う
+（CONFIG は RedisChannelLayer と同じ）。
+"""
+import asyncio
+import copy
+import logging
+import time
+
+from channels_redis.core import RedisChannelLayer
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_GROUP_SEND_LUA = """
+local over_capacity = 0
+local current_time = ARGV[#ARGV - 1]
+local expiry = ARGV[#ARGV]
+for i=1,#KEYS do
+    if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+        redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+        redis.call('EXPIRE', KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # グループ → このプロセスのチャンネル
+        self._local_groups: dict[str, set[str]] = {}
+        # 受信側のチャンネル（"<prefix>.<client_prefix>!"）→ 待っている receive の数 / Redis の受信タスク
+        self._receivers: dict[str, int] = {}
+        self._pulls: dict[str, asyncio.Task] = {}
+
+    def _is_local(self, channel: str) -> bool:
+        return "!" in channel and self.non_local_name(channel).endswith(self.client_prefix + "!")
+
+    def _deliver(self, channel: str, message: dict):
+        # Redis 経由と同じく、受け手ごとに別のオブジェクトを渡す
+        self.receive_buffer[channel].put_nowait(copy.deepcopy(message))
+        metrics.layer_local_deliveries.inc()
+
+    # ===== チャンネル =====
+    async def send(self, channel, message):
+        if self._is_local(channel):
+            assert isinstance(message, dict), "message is not a dict"
+            assert "__asgi_channel__" not in message
+            self._deliver(channel, message)
+            return
+        await super().send(channel, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        if "!" not in channel:
+            return await super().receive(channel)
+        real_channel = self.non_local_name(channel)
+        assert real_channel.endswith(self.client_prefix + "!"), "Wrong client prefix"
+        self._receivers[real_channel] = self._receivers.get(real_channel, 0) + 1
+        queue = self.receive_buffer[channel]
+        try:
+            self._ensure_pull(real_channel)
+            return await queue.get()
+        finally:
+            self._receivers[real_channel] -= 1
+            if not self._receivers[real_channel]:
+                del self._receivers[real_channel]
+            # 空になった buffer は捨てる（届いていて読まれていないものは残す）
+            if queue.empty() and self.receive_buffer.get(channel) is queue:
+                del self.receive_buffer[channel]
+
+    def _ensure_pull(self, real_channel: str):
+        loop = asyncio.get_running_loop()
+        task = self._pulls.get(real_channel)
+        if task is None or task.done() or task.get_loop() is not loop:
+            self._pulls[real_channel] = loop.create_task(self._pull_loop(real_channel))
+
+    async def _pull_loop(self, real_channel: str):
+        """
+        real_channel 宛ての Redis のメッセージを受けて、チャンネルごとの buffer に入れる
+        （RedisChannelLayer.receive_single と同じ手順）。待っている receive が無くなれば
+        BRPOP のタイムアウトで抜ける。途中で取り消さない（取り出したメッセージを
+        バックアップに移す前に取り消すと、そのメッセージが失われる）。
+        """
+        index = self.consistent_hash(real_channel)
+        channel_key = self.prefix + real_channel
+        while self._receivers.get(real_channel):
+            await self.receive_clean_locks.acquire(channel_key)
+            try:
+                content = await self._brpop_with_clean(index, channel_key, timeout=self.brpop_timeout)
+            except asyncio.CancelledError:
+                self.receive_clean_locks.release(channel_key)
+                raise
+            except Exception:
+                self.receive_clean_locks.release(channel_key)
+                logger.exception("channel layer receive failed; retrying")
+                await asyncio.sleep(1)
+                continue
+            if content is None:
+                self.receive_clean_locks.release(channel_key)
+                continue
+
+            cleaner = asyncio.ensure_future(self._clean_receive_backup(index, channel_key))
+            self.receive_cleaners.append(cleaner)
+
+            def _cleanup_done(cleaner):
+                self.receive_cleaners.remove(cleaner)
+                self.receive_clean_locks.release(channel_key)
+
+            cleaner.add_done_callback(_cleanup_done)
+
+            message = self.deserialize(content)
+            target = message.pop("__asgi_channel__", real_channel)
+            for channel in target if isinstance(target, list) else [target]:
+                self.receive_buffer[channel].put_nowait(message)
+
+    # ===== グループ =====
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        if self._is_local(channel):
+            self._local_groups.setdefault(group, set()).add(channel)
+
+    async def group_discard(self, group, channel):
+        local = self._local_groups.get(group)
+        if local is not None:
+            local.discard(channel)
+            if not local:
+                del self._local_groups[group]
+        await super().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        # 手元の宛先へは Redis を待たずに先に届ける
+        local = self._local_groups.get(group, ())
+        for channel in list(local):
+            self._deliver(channel, message)
+
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+        async with connection.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+            pipe.zrange(key, 0, -1)
+            _, members = await pipe.execute()
+        remote = [m.decode("utf8") for m in members]
+        remote = [c for c in remote if c not in local and not self._is_local(c)]
+        if remote:
+            await self._send_remote(group, remote, message)
+
+    async def _send_remote(self, group: str, channel_names: list[str], message: dict):
+        """他ワーカーの宛先へ（RedisChannelLayer.group_send の書き込み部分と同じ）"""
+        connection_to_keys, key_to_message, key_to_capacity = self._map_channel_keys_to_connection(
+            channel_names, message
+        )
+        for index, keys in connection_to_keys.items():
+            connection = self.connection(index)
+            async with connection.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.zremrangebyscore(key, min=0, max=int(time.time()) - int(self.expiry))
+                await pipe.execute()
+            args = [key_to_message[k] for k in keys] + [key_to_capacity[k] for k in keys]
+            over = await connection.eval(_GROUP_SEND_LUA, len(keys), *keys, *args, time.time(), self.expiry)
+            if over > 0:
+                logger.info("%s of %s channels over capacity in group %s", over, len(channel_names), group)
+        metrics.layer_remote_deliveries.inc(len(channel_names))
+
+    async def flush(self):
+        self._local_groups.clear()
+        await super().flush()
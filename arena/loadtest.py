@@ -0,0 +1,252 @@
+"""
+BattleConsumer の負荷試験ハーネス。
+
+N 組のクライアントを同じプロセス内で ws/arena/<code>/ に接続し、
+ACTIONS からランダムに行動を選んで決着まで対戦させる。ASGI アプリを直接叩くので
+ネットワークやブラウザは不要。チャンネルレイヤは InMemoryChannelLayer か、
+ローカルの Redis（--redis-url）を使う。
+
+計測するもの:
+    - 行動 → 状態受信のレイテンシ（ターンを確定させた2人目の送信から、
+      各クライアントが新しいターンの状態を受け取るまで）の p50 / p95 / p99
+    - クライアントが受け取ったメッセージ数 / 秒
+    - 1ターンあたりのDBクエリ数（フラッシュを含む）
+    - 同時接続1000ソケットあたりの CPU 使用率（コア数）と最大RSSの増分
+
+実行は manage.py loadtest（arena/management/commands/loadtest.py）から。
+"""
+import asyncio
+import json
+import random
+import resource
+import time
+
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from . import routing
+from .db import unwatch_queries, watch_queries
+from .engine import engine
+from .models import ACTIONS, Room
+
+PLAYABLE = [a for a, _ in ACTIONS if a != "none"]
+
+
+# ===== DBクエリ数 =====
+class QueryCounter:
+    """
+    DBプール（db_async）で走るクエリを数える。実行時のDB処理はすべてプールを通る。
+    プールのスレッドはすでに接続を持っていることがあるので、接続の作成時ではなく
+    実行のたびにラッパを付ける（db.watch_queries）。
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        watch_queries(self)
+
+    def uninstall(self):
+        unwatch_queries(self)
+
+
+# ===== クライアント =====
+class LoadClient:
+    """受信はバックグラウンドで読み、受信時刻つきで溜める"""
+
+    def __init__(self, app, code: str, stats: "Stats"):
+        self.comm = ApplicationCommunicator(
+            app, {"type": "websocket", "path": f"/ws/arena/{code}/", "headers": [], "subprotocols": []}
+        )
+        self.stats = stats
+        self.view: dict = {}
+        self.version = -1
+        self.changed = asyncio.Event()
+        self.joined = asyncio.Event()
+        self._reader: asyncio.Task | None = None
+
+    async def connect(self):
+        await self.comm.send_input({"type": "websocket.connect"})
+        msg = await self.comm.receive_output(10)
+        if msg["type"] != "websocket.accept":
+            raise RuntimeError(f"connect rejected: {msg}")
+        self._reader = asyncio.ensure_future(self._read())
+        await asyncio.wait_for(self.joined.wait(), 10)
+
+    async def _read(self):
+        while True:
+            msg = await self.comm.receive_output(None)
+            if msg["type"] == "websocket.close":
+                return
+            received = time.perf_counter()
+            self.stats.messages += 1
+            self.stats.bytes += len(msg.get("text") or msg.get("bytes") or b"")
+            for data in _frames(json.loads(msg["text"])):
+                if data.get("type") == "state":
+                    self._apply(data, received)
+                elif data.get("type") == "joined":
+                    self.joined.set()
+
+    def _apply(self, data: dict, received: float):
+        if "base" in data:
+            for k, v in data["delta"].items():
+                self.view[k] = {**self.view.get(k, {}), **v} if isinstance(v, dict) else v
+        else:
+            self.view = {k: v for k, v in data.items() if k not in ("type", "v")}
+        self.version = data["v"]
+        self.received_at = received
+        self.changed.set()
+
+    async def wait_turn_after(self, turn: int, timeout: float) -> float:
+        """ターン turn より先に進む（または決着する）まで待ち、受信時刻を返す"""
+        async def _wait():
+            while not (self.view.get("turn", 0) > turn or self.view.get("finished")):
+                self.changed.clear()
+                await self.changed.wait()
+        await asyncio.wait_for(_wait(), timeout)
+        return self.received_at
+
+    async def send_action(self, action: str):
+        await self.comm.send_input({"type": "websocket.receive", "text": json.dumps({"type": "action", "action": action})})
+
+    def pick(self) -> str:
+        tokens = self.view.get("you", {}).get("tokens", 0)
+        choices = PLAYABLE if tokens > 0 else [a for a in PLAYABLE if a != "charged_attack"]
+        return random.choice(choices)
+
+    async def close(self):
+        await self.comm.send_input({"type": "websocket.disconnect", "code": 1000})
+        try:
+            await self.comm.wait(5)
+        except Exception:
+            pass
+        if self._reader is not None:
+            self._reader.cancel()
+
+
+def _frames(data: dict):
+    """まとめ送り（batch）も1件ずつにする"""
+    if data.get("type") == "batch":
+        return data["items"]
+    return [data]
+
+
+# ===== 集計 =====
+class Stats:
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.messages = 0
+        self.bytes = 0
+        self.turns = 0
+        self.matches_done = 0
+        self.errors = 0
+        self.last_error = ""
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+async def play_match(app, code: str, stats: Stats, think_ms: int, turn_timeout: float):
+    p1, p2 = LoadClient(app, code, stats), LoadClient(app, code, stats)
+    try:
+        await p1.connect()
+        await p2.connect()
+        while not p1.view.get("finished"):
+            turn = p1.view.get("turn", 1)
+            if think_ms:
+                await asyncio.sleep(random.random() * think_ms / 1000)
+            await p1.send_action(p1.pick())
+            await p2.send_action(p2.pick())
+            sent = time.perf_counter()
+            for client in (p1, p2):
+                received = await client.wait_turn_after(turn, turn_timeout)
+                stats.latencies.append(received - sent)
+            stats.turns += 1
+        stats.matches_done += 1
+    except Exception as e:
+        stats.errors += 1
+        stats.last_error = repr(e)[:200]
+    finally:
+        await p1.close()
+        await p2.close()
+
+
+async def run(matches: int, concurrency: int, think_ms: int = 0, turn_timeout: float = 60,
+              cleanup: bool = True) -> dict:
+    app = URLRouter(routing.websocket_urlpatterns)
+    stats = Stats()
+    counter = QueryCounter()
+    codes = await database_sync_to_async(_free_codes)(matches)
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(code):
+        async with gate:
+            await play_match(app, code, stats, think_ms, turn_timeout)
+
+    rusage0 = resource.getrusage(resource.RUSAGE_SELF)
+    counter.install()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[one(c) for c in codes])
+        await engine.flush()
+    finally:
+        counter.uninstall()
+    duration = time.perf_counter() - started
+    rusage1 = resource.getrusage(resource.RUSAGE_SELF)
+
+    if cleanup:
+        await _delete_rooms(codes)
+
+    sockets = matches * 2
+    per_1k = 1000 / max(1, min(sockets, concurrency * 2))
+    cpu = (rusage1.ru_utime + rusage1.ru_stime) - (rusage0.ru_utime + rusage0.ru_stime)
+    lat = sorted(stats.latencies)
+    return {
+        "matches": matches,
+        "concurrency": concurrency,
+        "sockets": sockets,
+        "matches_finished": stats.matches_done,
+        "errors": stats.errors,
+        "last_error": stats.last_error,
+        "turns": stats.turns,
+        "duration_s": round(duration, 3),
+        "latency_ms": {
+            "p50": round(_percentile(lat, 0.50) * 1000, 3),
+            "p95": round(_percentile(lat, 0.95) * 1000, 3),
+            "p99": round(_percentile(lat, 0.99) * 1000, 3),
+            "max": round((lat[-1] if lat else 0) * 1000, 3),
+        },
+        "messages_per_s": round(stats.messages / duration, 1) if duration else 0,
+        "bytes_per_message": round(stats.bytes / stats.messages, 1) if stats.messages else 0,
+        "turns_per_s": round(stats.turns / duration, 1) if duration else 0,
+        "db_queries": counter.count,
+        "db_queries_per_turn": round(counter.count / stats.turns, 3) if stats.turns else 0,
+        "cpu_s": round(cpu, 3),
+        # 同時接続ソケット1000あたり（CPU は使用コア数換算、ru_maxrss は Linux では KB）
+        "cpu_cores_per_1k_sockets": round(cpu / duration * per_1k, 3) if duration else 0,
+        "rss_mb_per_1k_sockets": round((rusage1.ru_maxrss - rusage0.ru_maxrss) / 1024 * per_1k, 3),
+    }
+
+
+def _free_codes(n: int) -> list[str]:
+    used = set(Room.objects.values_list("code", flat=True))
+    codes: set[str] = set()
+    while len(codes) < n:
+        code = f"{random.randrange(10**6):06d}"
+        if code not in used:
+            codes.add(code)
+    return sorted(codes)
+
+
+async def _delete_rooms(codes: list[str]):
+    for code in codes:
+        engine.evict(code)
+    await database_sync_to_async(Room.objects.filter(code__in=codes).delete)()
@@ -0,0 +1,26 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from arena import archive
+
+
+class Command(BaseCommand):
+    help = "決着した対戦を gzip JSON lines にアーカイブし、Room / Turn から消す（cron 等で定期実行）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=archive.BATCH, help="1回に読み込む対戦数")
+        parser.add_argument("--grace-minutes", type=float, default=archive.GRACE.total_seconds() / 60,
+                            help="決着からこの分数を過ぎた対戦だけを対象にする")
+        parser.add_argument("--limit", type=int, default=0, help="処理する対戦数の上限（0 = 全部）")
+        parser.add_argument("--dir", default="", help="書き出し先（既定は ARENA_ARCHIVE_DIR）")
+
+    def handle(self, *args, **opts):
+        stats = archive.archive_finished(
+            batch_size=opts["batch_size"],
+            grace=timedelta(minutes=opts["grace_minutes"]),
+            limit=opts["limit"] or None,
+            directory=opts["dir"] or None,
+        )
+        self.stdout.write(json.dumps(stats, ensure_ascii=False))
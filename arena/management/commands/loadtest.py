@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from arena import loadtest
+
+
+class Command(BaseCommand):
+    help = "BattleConsumer に N 組の対戦を流して、レイテンシ・スループット・DB負荷を計測する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--matches", type=int, default=100, help="対戦数（ソケット数はこの2倍）")
+        parser.add_argument("--concurrency", type=int, default=0, help="同時に進める対戦数（0 = 全部同時）")
+        parser.add_argument("--think-ms", type=int, default=0, help="各ターンの思考時間の上限（ランダム）")
+        parser.add_argument("--redis-url", default="", help="指定するとそのRedisをチャンネルレイヤに使う")
+        parser.add_argument("--output", default="", help="結果JSONの書き出し先")
+        parser.add_argument("--max-p99-ms", type=float, default=0, help="p99 がこれを超えたら失敗扱い")
+        parser.add_argument("--keep", action="store_true", help="作った Room/Turn を消さずに残す")
+
+    def handle(self, *args, **opts):
+        if opts["redis_url"]:
+            layer = {"BACKEND": "channels_redis.core.RedisChannelLayer",
+                     "CONFIG": {"hosts": [opts["redis_url"]], "capacity": 10000}}
+        else:
+            layer = {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 10000}}
+
+        with override_settings(CHANNEL_LAYERS={"default": layer}):
+            result = asyncio.run(loadtest.run(
+                matches=opts["matches"],
+                concurrency=opts["concurrency"] or opts["matches"],
+                think_ms=opts["think_ms"],
+                cleanup=not opts["keep"],
+            ))
+        result["layer"] = layer["BACKEND"]
+
+        text = json.dumps(result, indent=2, ensure_ascii=False)
+        if opts["output"]:
+            with open(opts["output"], "w") as f:
+                f.write(text + "\n")
+        self.stdout.write(text)
+
+        if result["errors"]:
+            raise CommandError(f"{result['errors']} matches failed: {result['last_error']}")
+        if opts["max_p99_ms"] and result["latency_ms"]["p99"] > opts["max_p99_ms"]:
+            raise CommandError(f"p99 {result['latency_ms']['p99']}ms > {opts['max_p99_ms']}ms")
@@ -0,0 +1,35 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from arena import pages
+
+TEXT_SUFFIXES = {".css", ".js", ".mjs", ".map", ".svg", ".html", ".json", ".txt", ".xml"}
+
+
+class Command(BaseCommand):
+    help = "collectstatic の出力に圧縮済みの .gz / .br を並べて置く（前段のプロキシがそのまま返す）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", default="", help="対象のディレクトリ（既定は STATIC_ROOT）")
+
+    def handle(self, *args, **opts):
+        root = Path(opts["dir"] or settings.STATIC_ROOT)
+        stats = {"files": 0, "written": 0, "bytes_in": 0, "bytes_out": 0}
+        for path in sorted(root.rglob("*")):
+            if not path.is_file() or path.suffix not in TEXT_SUFFIXES:
+                continue
+            body = path.read_bytes()
+            stats["files"] += 1
+            for encoding, blob in pages.compress(body).items():
+                target = path.with_name(path.name + (".br" if encoding == "br" else ".gz"))
+                # 元のファイルより新しければ作り直さない
+                if target.exists() and target.stat().st_mtime >= path.stat().st_mtime:
+                    continue
+                target.write_bytes(blob)
+                stats["written"] += 1
+                stats["bytes_in"] += len(body)
+                stats["bytes_out"] += len(blob)
+        self.stdout.write(json.dumps(stats, ensure_ascii=False))
@@ -0,0 +1,34 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from arena import rules
+
+
+class Command(BaseCommand):
+    help = "ランダムな行動で大量の対戦を回し、ダメージ値ごとの勝率・ターン数を出す（NumPy が必要）"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--matches", type=int, default=1_000_000)
+        parser.add_argument("--attack", type=int, default=rules.DMG_ATTACK, help="通常攻撃のダメージ")
+        parser.add_argument("--charged", type=int, default=rules.DMG_CHARGED, help="チャージ攻撃のダメージ")
+        parser.add_argument("--max-turns", type=int, default=200)
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument("--weights", default="", help='行動の割合（JSON。例: {"attack": 2, "guard": 1}）')
+
+    def handle(self, *args, **opts):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            raise CommandError("simulate_balance needs numpy (pip install numpy)")
+        stats = rules.simulate(
+            opts["matches"],
+            weights=json.loads(opts["weights"]) if opts["weights"] else None,
+            max_turns=opts["max_turns"],
+            seed=opts["seed"],
+            dmg_attack=opts["attack"],
+            dmg_charged=opts["charged"],
+        )
+        # ターン数 × 制限時間 = 両者が毎ターン時間いっぱい使ったときの対戦時間
+        stats["mean_seconds_upper"] = stats["mean_turns"] * rules.TURN_SECONDS
+        self.stdout.write(json.dumps(stats, ensure_ascii=False))
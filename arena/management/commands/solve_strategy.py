@@ -0,0 +1,49 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from arena import rules, strategy
+
+
+class Command(BaseCommand):
+    help = "最適戦略の表を解く（--write で arena/strategy.bin を作り直す）。ダメージ値を変えたときの形勢の分析にも使う"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--attack", type=int, default=rules.DMG_ATTACK, help="通常攻撃のダメージ")
+        parser.add_argument("--charged", type=int, default=rules.DMG_CHARGED, help="チャージ攻撃のダメージ")
+        parser.add_argument("--discount", type=float, default=strategy.DISCOUNT)
+        parser.add_argument("--guard-cost", type=float, default=strategy.GUARD_COST)
+        parser.add_argument("--write", action="store_true", help="解いた表を strategy.bin に保存する")
+
+    def handle(self, *args, **opts):
+        if opts["write"]:
+            # strategy.bin は今のルール用の表。違う値で解いたものを置くと起動時に読み込まれない
+            given = {"dmg_attack": opts["attack"], "dmg_charged": opts["charged"],
+                     "discount": opts["discount"], "guard_cost": opts["guard_cost"]}
+            wanted = strategy.current_params()
+            differ = {k: v for k, v in given.items() if v != wanted[k]}
+            if differ:
+                raise CommandError(f"--write は今のルールの値でだけ使える（違う値: {differ}）")
+        started = time.perf_counter()
+        table = strategy.solve(opts["attack"], opts["charged"], discount=opts["discount"],
+                               guard_cost=opts["guard_cost"])
+        elapsed = time.perf_counter() - started
+        if opts["write"]:
+            table.save()
+
+        hp, atk = rules.START_HP, opts["attack"]
+        live = [(a, b, ta, tb) for a in table.params["hp"] if a for b in table.params["hp"] if b
+                for ta in range(strategy.TOKEN_CAP + 1) for tb in range(strategy.TOKEN_CAP + 1)]
+        mean = {a: round(sum(table.mix(*s)[a] for s in live) / len(live), 3) for a in strategy.ACTIONS}
+        self.stdout.write(json.dumps({
+            "seconds": round(elapsed, 1),
+            "states": len(table.values),
+            # 開始時の最適な混合戦略（両者同じ）
+            "opening": {a: round(w, 3) for a, w in table.mix(hp, hp, 0, 0).items()},
+            # 先に通常攻撃を1回通した側 / トークンを1つ先に持った側の形勢
+            "after_first_hit": round(table.value(hp, hp - atk, 0, 0), 3),
+            "one_token_ahead": round(table.value(hp, hp, 1, 0), 3),
+            # 全状態で平均した行動の割合（使われない行動は弱すぎる）
+            "mean_mix": mean,
+        }, ensure_ascii=False))
@@ -0,0 +1,211 @@
+"""
+マッチメイキング（待ち行列と定期マッチャ）。
+
+ws/arena/queue/ に繋いだプレイヤーの「チケット」を地域（region）ごとの待ち行列に積み、
+MATCH_INTERVAL 秒ごとにまとめて2人ずつ組む。組めたら台帳（arena.rooms）で部屋コードを
+払い出し、両者のソケットへ match.found で知らせる。
+
+地域ごとの待ち行列は部屋と同じくコンシステントハッシュで担当ワーカーを1つに決める
+（キーは "mm:<region>"）。担当でないワーカーに来たチケットは inbox へ転送する。
+
+組み方:
+    地域内をレーティング順に並べ、隣どうしの差が許容幅以内なら組む。
+    許容幅は待ち時間とともに広がり（RATING_WINDOW + RATING_WIDEN/秒）、
+    MAX_WAIT 秒を超えたらレーティングを問わず組む（= 待ち時間の上限）。
+
+metrics() で待ち行列の長さ・マッチまでの時間（直近の p50 / p95 / 最大）を返す。
+/metrics には地域ごとの待ち行列の長さ（arena_matchmaking_queue_depth）と
+マッチまでの時間のヒストグラム（arena_time_to_match_seconds）を出す。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+from .rooms import rooms
+from .sharding import cluster
+
+logger = logging.getLogger(__name__)
+
+MATCH_INTERVAL = getattr(settings, "ARENA_MATCH_INTERVAL", 0.1)   # 秒
+RATING_WINDOW = 100     # 待ち始めの許容レーティング差
+RATING_WIDEN = 50       # 1秒待つごとに広げる幅
+MAX_WAIT = getattr(settings, "ARENA_MATCH_MAX_WAIT", 10.0)       # 秒。これを過ぎたら誰とでも組む
+DEFAULT_REGION = "any"
+SAMPLES = 1000          # マッチまでの時間を覚えておく件数
+
+
+def queue_key(region: str) -> str:
+    return f"mm:{region}"
+
+
+def _tolerance(waited: float) -> float:
+    if waited >= MAX_WAIT:
+        return float("inf")
+    return RATING_WINDOW + RATING_WIDEN * waited
+
+
+def pair_tickets(tickets: list[dict], now: float) -> tuple[list[tuple[dict, dict]], list[dict]]:
+    """チケットを (組めたペア, 残り) に分ける。tickets は到着順"""
+    ordered = sorted(tickets, key=lambda t: t["rating"])
+    pairs, rest = [], []
+    i = 0
+    while i < len(ordered):
+        a = ordered[i]
+        if i + 1 < len(ordered):
+            b = ordered[i + 1]
+            # 長く待っている方の許容幅で判定する
+            waited = now - min(a["since"], b["since"])
+            if abs(a["rating"] - b["rating"]) <= _tolerance(waited):
+                pairs.append((a, b))
+                i += 2
+                continue
+        rest.append(a)
+        i += 1
+    rest.sort(key=lambda t: t["since"])
+    return pairs, rest
+
+
+class Matchmaker:
+    def __init__(self):
+        # 地域 → チケットID → チケット（到着順）
+        self._queues: dict[str, dict[str, dict]] = {}
+        self._waits: deque = deque(maxlen=SAMPLES)
+        self.enqueued = 0
+        self.matched = 0
+        self._loop_task: asyncio.Task | None = None
+
+    # ===== 待ち行列（担当ワーカー側） =====
+    def enqueue(self, ticket: dict):
+        self._ensure_loop()
+        self._queues.setdefault(ticket["region"], {})[ticket["id"]] = ticket
+        self.enqueued += 1
+
+    def cancel(self, region: str, ticket_id: str):
+        queue = self._queues.get(region)
+        if queue is not None:
+            queue.pop(ticket_id, None)
+
+    def depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def depth_by_region(self) -> dict[str, int]:
+        """担当している地域ごとの待ち行列の長さ（空になった地域は 0）"""
+        return {r: len(q) for r, q in self._queues.items()}
+
+    # ===== マッチャ =====
+    def _ensure_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop_task is None or self._loop_task.done() or self._loop_task.get_loop() is not loop:
+            self._loop_task = loop.create_task(self._match_loop())
+
+    async def _match_loop(self):
+        while True:
+            await asyncio.sleep(MATCH_INTERVAL)
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("matchmaking round failed")
+
+    async def run_once(self):
+        """全地域を1回ずつまとめて組む"""
+        now = time.time()
+        for region in list(self._queues):
+            queue = self._queues[region]
+            if len(queue) < 2:
+                continue
+            pairs, rest = pair_tickets(list(queue.values()), now)
+            if not pairs:
+                continue
+            self._queues[region] = {t["id"]: t for t in rest}
+            await asyncio.gather(*[self._found(a, b, now) for a, b in pairs])
+
+    async def _found(self, a: dict, b: dict, now: float):
+        try:
+            code = await rooms.allocate()
+        except Exception:
+            # 払い出せなければ次の回に回す
+            for t in (a, b):
+                self._queues.setdefault(t["region"], {})[t["id"]] = t
+            raise
+        layer = get_channel_layer()
+        for t in (a, b):
+            self._waits.append(now - t["since"])
+            metrics.time_to_match_seconds.observe(now - t["since"])
+            await layer.send(t["reply"], {"type": "match.found", "room": code})
+        self.matched += 2
+
+    # ===== 計測 =====
+    def metrics(self) -> dict:
+        waits = sorted(self._waits)
+
+        def pct(q):
+            return round(waits[min(len(waits) - 1, int(q * (len(waits) - 1)))], 3) if waits else 0.0
+
+        return {
+            "queue_depth": self.depth(),
+            "queue_depth_by_region": {r: len(q) for r, q in self._queues.items() if q},
+            "enqueued_total": self.enqueued,
+            "matched_total": self.matched,
+            "time_to_match_s": {"p50": pct(0.50), "p95": pct(0.95), "max": round(waits[-1], 3) if waits else 0.0},
+        }
+
+    def clear(self):
+        """テスト用"""
+        if self._loop_task is not None and not self._loop_task.done():
+            try:
+                self._loop_task.cancel()
+            except RuntimeError:
+                pass  # ループ終了済み
+        self.__init__()
+
+
+# プロセス内で1つだけ
+matchmaker = Matchmaker()
+
+
+# ===== ソケット側から呼ぶ（担当ワーカーへ振り分け） =====
+async def submit(ticket: dict):
+    key = queue_key(ticket["region"])
+    if cluster.is_local(key):
+        matchmaker.enqueue(ticket)
+    else:
+        await cluster.send_to_owner(key, {"type": "mm.enqueue", "ticket": ticket})
+
+
+async def withdraw(region: str, ticket_id: str):
+    key = queue_key(region)
+    if cluster.is_local(key):
+        matchmaker.cancel(region, ticket_id)
+    else:
+        await cluster.send_to_owner(key, {"type": "mm.cancel", "region": region, "id": ticket_id})
+
+
+async def _on_enqueue(message):
+    matchmaker.enqueue(message["ticket"])
+
+
+async def _on_cancel(message):
+    matchmaker.cancel(message["region"], message["id"])
+
+
+async def _on_ring_change(old, new):
+    """担当を外れた地域の待ち行列は、チケットごと新しい担当へ渡す"""
+    for region in list(matchmaker._queues):
+        owner = new.owner(queue_key(region))
+        if owner is None or owner == cluster.worker_id:
+            continue
+        for ticket in matchmaker._queues.pop(region).values():
+            await cluster.send_to(owner, {"type": "mm.enqueue", "ticket": ticket})
+
+
+metrics.registry.gauge_vec("arena_matchmaking_queue_depth", "Tickets waiting per region on this worker",
+                           "region", lambda: matchmaker.depth_by_region())
+
+cluster.on("mm.enqueue", _on_enqueue)
+cluster.on("mm.cancel", _on_cancel)
+cluster.on_ring_change(_on_ring_change)
@@ -0,0 +1,252 @@
+"""
+計測（Prometheus のテキスト形式で /metrics に出す）。
+
+ホットパスに置くのは perf_counter 2回とバケットの二分探索くらいで、ロックも
+I/O もしない（1プロセス1イベントループなので、加算はそのままで競合しない）。
+DBスレッドから加算するのはカウンタだけ（GIL 下の += で十分）。
+
+ゲージのうち部屋数・DBプールの待ち行列などは、スクレイプ時に読むコールバックで持つ。
+
+エンドポイントは asgi.py の ProtocolTypeRouter の http 側に MetricsEndpoint として挟み、
+GET /metrics だけを Django を通さずに返す。ワーカーが複数なら各プロセスが自分の分を返す
+（arena_worker_info の worker ラベルで区別する）。
+"""
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+# 秒。ソケット1往復〜DB1回くらいの幅
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# 秒。マッチまでの待ち時間（マッチャの周期〜待ち時間の上限を超えるくらいまで）
+WAIT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 15.0, 30.0, 60.0)
+LOOP_LAG_INTERVAL = 0.5
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: dict | None = None):
+        self.name, self.help, self.labels = name, help, labels
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+
+class Gauge:
+    """値を直接持つか、スクレイプ時に func() を読む"""
+
+    def __init__(self, name: str, help: str, func=None, labels: dict | None = None):
+        self.name, self.help, self.func, self.labels = name, help, func, labels
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def samples(self):
+        yield self.name, self.labels, self.func() if self.func is not None else self.value
+
+
+class GaugeVec:
+    """ラベルの値ごとのゲージ。スクレイプ時に func() が返す {ラベルの値: 値} を読む"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, label: str, func):
+        self.name, self.help, self.label, self.func = name, help, label, func
+
+    def samples(self):
+        for key, value in sorted(self.func().items()):
+            yield self.name, {self.label: key}, value
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name, self.help = name, help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        acc = 0
+        for bound, n in zip(self.buckets, self.counts):
+            acc += n
+            yield f"{self.name}_bucket", {"le": repr(bound)}, acc
+        yield f"{self.name}_bucket", {"le": "+Inf"}, self.count
+        yield f"{self.name}_sum", None, self.sum
+        yield f"{self.name}_count", None, self.count
+
+
+class _Timer:
+    __slots__ = ("hist", "started")
+
+    def __init__(self, hist: Histogram):
+        self.hist = hist
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.started)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=None) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, func=None, labels=None) -> Gauge:
+        return self.register(Gauge(name, help, func, labels))
+
+    def gauge_vec(self, name, help, label, func) -> GaugeVec:
+        return self.register(GaugeVec(name, help, label, func))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        lines = []
+        described = set()
+        for metric in self._metrics:
+            kind = getattr(metric, "kind", type(metric).__name__.lower())
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: dict | None) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{str(v)}"' for k, v in labels.items())
+    return "{" + inner + "}"
+
+
+def _number(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+# プロセス内で1つだけ
+registry = Registry()
+
+connect_seconds = registry.histogram("arena_connect_seconds", "BattleConsumer.connect duration")
+action_to_state_seconds = registry.histogram(
+    "arena_action_to_state_seconds", "Time from receiving an action to sending the next state frame on that socket")
+resolve_seconds = registry.histogram("arena_resolve_seconds", "Turn resolution (under the room lock) duration")
+group_send_seconds = registry.histogram("arena_group_send_seconds", "Room broadcast group_send latency")
+flush_seconds = registry.histogram("arena_flush_seconds", "Write-behind flush duration")
+turns_resolved = registry.counter("arena_turns_resolved_total", "Turns resolved")
+turns_swept = registry.counter("arena_turns_swept_total", "Overdue turns resolved by the global sweeper")
+rooms_abandoned = registry.counter("arena_rooms_abandoned_total", "Rooms closed by the sweeper after nobody acted")
+db_queries_flush = registry.counter("arena_db_queries_total", "DB queries issued by the arena engine", {"op": "flush"})
+db_queries_load = registry.counter("arena_db_queries_total", "DB queries issued by the arena engine", {"op": "load"})
+layer_local_deliveries = registry.counter(
+    "arena_layer_deliveries_total", "Channel layer deliveries", {"path": "local"})
+layer_remote_deliveries = registry.counter(
+    "arena_layer_deliveries_total", "Channel layer deliveries", {"path": "redis"})
+send_superseded = registry.counter(
+    "arena_send_superseded_total", "Queued outbound frames replaced by a newer state before being written")
+send_dropped_logs = registry.counter("arena_send_dropped_logs_total", "Queued log lines dropped for slow sockets")
+slow_disconnects = registry.counter("arena_slow_disconnects_total", "Sockets closed for not keeping up with sends")
+time_to_match_seconds = registry.histogram(
+    "arena_time_to_match_seconds", "Time from enqueue to match.found per ticket", WAIT_BUCKETS)
+bots_seated = registry.counter("arena_bots_seated_total", "Rooms where the bot took the empty seat 2")
+active_sockets = registry.gauge("arena_active_sockets", "Open arena WebSockets")
+loop_lag = registry.gauge("arena_event_loop_lag_seconds", "Last measured event-loop scheduling lag")
+loop_lag_seconds = registry.histogram("arena_event_loop_lag_hist_seconds", "Event-loop scheduling lag")
+
+
+def count_queries(counter: Counter):
+    """connection.execute_wrappers に付ける、クエリ数を数えるラッパ"""
+    def wrapper(execute, sql, params, many, context):
+        counter.inc()
+        return execute(sql, params, many, context)
+    return wrapper
+
+
+@contextmanager
+def counting_queries(counter: Counter):
+    """
+    この間の（このスレッドの接続の）クエリを counter で数える。
+    connection.execute_wrapper は抜けるときに最後のラッパを pop するので、途中で
+    別のラッパ（loadtest の QueryCounter など）が足されるとそちらを外してしまう。
+    ここでは自分のラッパだけを外す。
+    """
+    wrapper = count_queries(counter)
+    connection.execute_wrappers.append(wrapper)
+    try:
+        yield
+    finally:
+        connection.execute_wrappers.remove(wrapper)
+
+
+# ===== イベントループの遅延 =====
+_lag_task: asyncio.Task | None = None
+
+
+def ensure_loop_monitor():
+    """LOOP_LAG_INTERVAL ごとに眠り、予定より遅れて起きた分をループの遅延として記録する"""
+    global _lag_task
+    loop = asyncio.get_running_loop()
+    if _lag_task is None or _lag_task.done() or _lag_task.get_loop() is not loop:
+        _lag_task = loop.create_task(_monitor_loop())
+
+
+async def _monitor_loop():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        loop_lag.set(lag)
+        loop_lag_seconds.observe(lag)
+
+
+# ===== HTTP =====
+class MetricsEndpoint:
+    """GET /metrics だけを受け持ち、それ以外は app（Django）へ渡す ASGI アプリ"""
+
+    def __init__(self, app, path: str = "/metrics"):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.app(scope, receive, send)
+        ensure_loop_monitor()
+        body = registry.render().encode()
+        await send({
+            "type": "http.response.start", "status": 200,
+            "headers": [(b"content-type", b"text/plain; version=0.0.4; charset=utf-8"),
+                        (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
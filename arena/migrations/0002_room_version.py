@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-17 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("arena", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="version",
+            field=models.IntegerField(default=0),
+        ),
+    ]
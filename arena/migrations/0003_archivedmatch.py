@@ -0,0 +1,29 @@
+# Generated by Django 5.0.7 on 2026-10-17 19:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("arena", "0002_room_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedMatch",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("code", models.CharField(db_index=True, max_length=6)),
+                ("finished_at", models.DateTimeField()),
+                ("winner", models.IntegerField(blank=True, null=True)),
+                ("turns", models.IntegerField()),
+                ("segment", models.CharField(max_length=255)),
+                ("offset", models.BigIntegerField()),
+                ("length", models.IntegerField()),
+            ],
+            options={
+                "ordering": ["-finished_at"],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-17 19:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("arena", "0003_archivedmatch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="current_turn",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to="arena.turn"),
+        ),
+        migrations.AddIndex(
+            model_name="turn",
+            index=models.Index(condition=models.Q(("resolved", False)), fields=["deadline"], name="arena_turn_due_idx"),
+        ),
+    ]
@@ -28,10 +28,18 @@ class Room(models.Model):
     turn = models.IntegerField(default=1)
     deadline = models.DateTimeField(default=timezone.now)
 
+    # 状態の版数（変化のたびに+1。差分配信・再接続時の基準）
+    version = models.IntegerField(default=0)
+
     # 決着
     finished = models.BooleanField(default=False)
     winner = models.IntegerField(blank=True, null=True)  # 1 or 2
 
+    # 現在ターンへの直接参照（非正規化）。select_related で部屋とターンを1クエリで読む
+    current_turn = models.ForeignKey(
+        "Turn", on_delete=models.SET_NULL, blank=True, null=True, related_name="+"
+    )
+
     def __str__(self):
         return f"Room {self.code}"
 
@@ -49,8 +57,32 @@ class Turn(models.Model):
     class Meta:
         unique_together = ("room", "number")
         ordering = ["number"]
+        indexes = [
+            # 締切の来た未解決ターンを範囲スキャン1回で拾う（全体スケジューラ用）。
+            # resolved=False の部分インデックスにして、解決済みの行は索引に載せない
+            models.Index(fields=["deadline"], name="arena_turn_due_idx", condition=models.Q(resolved=False)),
+        ]
 
     def __str__(self):
         return f"Turn {self.number} in {self.room.code}"
 
+class ArchivedMatch(models.Model):
+    """
+    アーカイブ済みの対戦の索引（本体は gzip JSON lines のセグメントファイル側）。
+    1試合 = セグメント内の gzip メンバー1つなので、offset / length だけ読めば復元できる。
+    """
+    code = models.CharField(max_length=6, db_index=True)
+    finished_at = models.DateTimeField()
+    winner = models.IntegerField(blank=True, null=True)
+    turns = models.IntegerField()
+    segment = models.CharField(max_length=255)
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
+
+    class Meta:
+        ordering = ["-finished_at"]
+
+    def __str__(self):
+        return f"Archived match {self.code} ({self.finished_at:%Y-%m-%d %H:%M})"
+
 # Create your models here.
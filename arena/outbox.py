@@ -0,0 +1,148 @@
+"""
+部屋ごとの送信まとめ（outbound batcher）。
+
+ログや状態のイベントを部屋単位で BATCH_WINDOW 秒だけ溜め、1回の group_send
+（= Redis の publish 1回）で配る。受け手の consumer はそれを1フレームにまとめて
+ソケットへ書くので、1ターンあたりの Redis 操作とソケット書き込みが減る。
+
+同じ窓の中の状態（state_msg）は最後の1つだけを残す（最新版だけが意味を持つ）。
+部屋ごとの送信は発行順を保つ。
+
+観戦者のいる部屋（watched）には、同じイベントを SPECTATOR_WINDOW 秒ごとに間引いて
+観戦グループ（spectators.watch_group_name）へも送る。宛先は観戦者のソケットではなく
+観戦者を抱えるワーカーの inbox なので、観客数が増えてもここの負荷は変わらない。
+"""
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_WINDOW = getattr(settings, "ARENA_BATCH_WINDOW_MS", 15) / 1000
+SPECTATOR_WINDOW = getattr(settings, "ARENA_SPECTATOR_WINDOW_MS", 500) / 1000
+SPECTATOR_LOGS = 5      # 観戦向けの1回分に残すログの件数
+
+
+def room_group_name(room_code: str) -> str:
+    return f"arena_{room_code}"
+
+
+def watch_group_name(room_code: str) -> str:
+    return f"arena_{room_code}_watch"
+
+
+class RoomOutbox:
+    def __init__(self):
+        self._pending: dict[str, list[dict]] = {}
+        self._last: dict[str, asyncio.Task] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # 部屋 → 観戦者を抱えるワーカー数（担当ワーカー側で数える）
+        self.watched: dict[str, int] = {}
+        self._watch_pending: dict[str, list[dict]] = {}
+
+    def publish(self, room_code: str, event: dict):
+        """部屋のグループへ event を送る予約をする（待たない）"""
+        if self.watched.get(room_code):
+            self._publish_watch(room_code, event)
+        batch = self._pending.get(room_code)
+        if batch is not None:
+            batch.append(event)
+            return
+        self._pending[room_code] = [event]
+        loop = asyncio.get_running_loop()
+        if BATCH_WINDOW > 0:
+            loop.call_later(BATCH_WINDOW, self._start, room_code)
+        else:
+            self._start(room_code)
+
+    def _start(self, room_code: str):
+        events = self._pending.pop(room_code, None)
+        if not events:
+            return
+        # 窓ごとの送信が前後しないよう、部屋ごとに前の送信の後ろにつなぐ
+        prev = self._last.get(room_code)
+        task = asyncio.ensure_future(self._send(room_code, _collapse(events), prev))
+        self._last[room_code] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    async def _send(self, room_code: str, events: list[dict], prev: asyncio.Task | None):
+        if prev is not None and not prev.done():
+            await asyncio.wait([prev])
+        try:
+            with metrics.group_send_seconds.time():
+                await get_channel_layer().group_send(
+                    room_group_name(room_code), {"type": "room_batch", "events": events}
+                )
+        finally:
+            if self._last.get(room_code) is asyncio.current_task():
+                del self._last[room_code]
+
+    def _publish_watch(self, room_code: str, event: dict):
+        batch = self._watch_pending.get(room_code)
+        if batch is not None:
+            batch.append(event)
+            return
+        self._watch_pending[room_code] = [event]
+        asyncio.get_running_loop().call_later(SPECTATOR_WINDOW, self._start_watch, room_code)
+
+    def _start_watch(self, room_code: str):
+        events = self._watch_pending.pop(room_code, None)
+        if not events:
+            return
+        task = asyncio.ensure_future(get_channel_layer().group_send(
+            watch_group_name(room_code),
+            {"type": "room.watch_batch", "room": room_code, "events": _sample(events)},
+        ))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def watch(self, room_code: str, delta: int):
+        """観戦者を抱えるワーカーの増減（0 になったら観戦向けの送信をやめる）"""
+        count = self.watched.get(room_code, 0) + delta
+        if count > 0:
+            self.watched[room_code] = count
+        else:
+            self.watched.pop(room_code, None)
+
+    async def drain(self):
+        """溜まっている分をすぐに送る（テスト・終了時用）"""
+        for room_code in list(self._pending):
+            self._start(room_code)
+        for room_code in list(self._watch_pending):
+            self._start_watch(room_code)
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def clear(self):
+        """テスト用: 未送信分を捨てる"""
+        self.__init__()
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("room broadcast failed", exc_info=task.exception())
+
+
+def _collapse(events: list[dict]) -> list[dict]:
+    """状態は最後の1つだけ残し、その位置に置く（ログの順序はそのまま）"""
+    last_state = None
+    for i, ev in enumerate(events):
+        if ev["type"] == "state_msg":
+            last_state = i
+    return [ev for i, ev in enumerate(events) if ev["type"] != "state_msg" or i == last_state]
+
+
+def _sample(events: list[dict]) -> list[dict]:
+    """観戦向け: 最新の状態と、直近 SPECTATOR_LOGS 件のログだけにする"""
+    events = _collapse(events)
+    logs = set([i for i, ev in enumerate(events) if ev["type"] == "log_msg"][-SPECTATOR_LOGS:])
+    return [ev for i, ev in enumerate(events) if ev["type"] != "log_msg" or i in logs]
+
+
+# プロセス内で1つだけ
+outbox = RoomOutbox()
@@ -0,0 +1,104 @@
+"""
+ページの配信（静的ページモード。ARENA_STATIC_PAGES で有効）。
+
+ロビー・部屋のページは、中身がリクエストごとに変わる部分を外に出して
+テンプレートを1回だけ描画し、その場で gzip（brotli があれば br も）に圧縮して
+メモリに持つ。リクエストごとの処理は:
+
+    - If-None-Match が ETag と合えば 304（本文なし）
+    - Accept-Encoding に合わせて、圧縮済みの本文をそのまま返す
+
+リクエストごとに変わっていた部分は:
+
+    - 部屋コード       ページの URL（/room/<コード>/）から JS で読む
+    - 署名つきトークン  Cookie（arena_token）で渡して JS で読む
+    - CSRF トークン     csrftoken Cookie から JS でフォームに入れる
+    - 対戦中の部屋数    /api/rooms/live/ から JS で読む
+
+ETag は本文のハッシュ（圧縮の種類ごとに別の値）。デプロイで本文が変われば変わる。
+静的ファイル（collectstatic の出力）は manage.py precompress_static で
+.gz / .br を並べて置き、前段のプロキシにそのまま返させる。
+"""
+import gzip
+import hashlib
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.template.loader import render_to_string
+
+try:
+    import brotli
+except ImportError:  # 任意。無ければ gzip だけ
+    brotli = None
+
+STATIC_PAGES = getattr(settings, "ARENA_STATIC_PAGES", False)
+ENCODINGS = ("br", "gzip")      # 両方使えるときは前のものを選ぶ
+
+
+def compress(body: bytes) -> dict[str, bytes]:
+    """圧縮の種類 → 圧縮した本文（元より小さくならないものは含めない）"""
+    variants = {"gzip": gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return {k: v for k, v in variants.items() if len(v) < len(body)}
+
+
+class Page:
+    __slots__ = ("body", "variants", "tag")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.variants = compress(body)
+        self.tag = hashlib.sha256(body).hexdigest()[:32]
+
+    def etag(self, encoding: str | None) -> str:
+        return f'"{self.tag}-{encoding}"' if encoding else f'"{self.tag}"'
+
+    def etags(self) -> set[str]:
+        return {self.etag(None), *(self.etag(e) for e in self.variants)}
+
+
+_pages: dict[str, Page] = {}
+
+
+def page(template: str) -> Page:
+    """template を1回だけ描画して圧縮したもの（プロセス内で使い回す）"""
+    cached = _pages.get(template)
+    if cached is None:
+        cached = _pages[template] = Page(render_to_string(template, {"static_page": True}).encode())
+    return cached
+
+
+def clear():
+    """テスト用"""
+    _pages.clear()
+
+
+def _accepted(header: str) -> set[str]:
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q=") and q[2:].strip() in ("0", "0.0", "0.00", "0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def respond(request, p: Page) -> HttpResponse:
+    """条件つき GET と圧縮の選択だけをして返す"""
+    accepted = _accepted(request.headers.get("Accept-Encoding", ""))
+    encoding = next((e for e in ENCODINGS if e in accepted and e in p.variants), None)
+    if_none_match = request.headers.get("If-None-Match", "")
+    if if_none_match == "*" or any(t.strip().removeprefix("W/") in p.etags() for t in if_none_match.split(",")):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(p.variants[encoding] if encoding else p.body,
+                                content_type="text/html; charset=utf-8")
+        if encoding:
+            response["Content-Encoding"] = encoding
+    response["ETag"] = p.etag(encoding)
+    response["Vary"] = "Accept-Encoding"
+    # 毎回確かめさせる（変わっていなければ 304 で本文は送らない）
+    response["Cache-Control"] = "no-cache"
+    return response
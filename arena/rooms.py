@@ -0,0 +1,205 @@
+"""
+部屋コードの台帳（ルームレジストリ）。
+
+ロビーの「新規作成」「入室」とソケット接続の経路から Room テーブルを外すための、
+O(1) の軽い台帳。部屋コードの払い出し・存在確認・生存中の部屋数を扱う。
+
+    - RedisRoomRegistry : 複数ワーカー/ノード用。部屋ごとのハッシュ
+                          arena:room:<code>（TTL つき）と、生存部屋の
+                          sorted set arena:rooms（score = 期限）を使う
+    - LocalRoomRegistry : 単一プロセス用（ARENA_ROOM_REGISTRY_URL 未設定時）
+
+コードの払い出しは「ランダムに選んで、まだ無ければ作る」を1操作（Lua / 同一ループ内）
+で行うので、同時に大量に作っても重複しない。台帳は期限切れ・再起動で忘れるので、
+押さえたコードに Room 行が残っていれば（アーカイブ前の対戦・台帳より古い部屋）
+手放して選び直す（一意インデックスの存在確認1回）。
+
+台帳で払い出した部屋は、最初の読み込み（claim_load）だけDBを見ずに初期状態から
+始める。Room 行は write-behind の最初のフラッシュで作られる（engine.flush）。
+台帳に無いコード（URL 直打ちなど）は従来どおりDBから読む。
+"""
+import asyncio
+import random
+import time
+
+from django.conf import settings
+
+from .db import db_async
+from .models import Room
+
+ROOM_TTL = getattr(settings, "ARENA_ROOM_TTL", 6 * 3600)   # 秒。払い出し・読み込みのたびに延長
+CODE_DIGITS = 6
+ALLOCATE_ATTEMPTS = 32
+CHECK_CHUNK = 500       # Room 行の存在確認1クエリあたりのコード数
+ROOMS_KEY = "arena:rooms"
+
+
+def _random_code() -> str:
+    return f"{random.randrange(10 ** CODE_DIGITS):0{CODE_DIGITS}d}"
+
+
+def _room_key(room_code: str) -> str:
+    return f"arena:room:{room_code}"
+
+
+class RoomCodesExhausted(Exception):
+    """空きコードが見つからない（生存部屋がコード空間を埋めかけている）"""
+
+
+def _in_database_sync(codes: list[str]) -> set[str]:
+    found = set()
+    for i in range(0, len(codes), CHECK_CHUNK):
+        found.update(Room.objects.filter(code__in=codes[i:i + CHECK_CHUNK]).values_list("code", flat=True))
+    return found
+
+
+# 次の確認でまとめて引くコード → 結果を待つ Future
+_checks: dict[str, list[asyncio.Future]] = {}
+_check_task: asyncio.Task | None = None
+
+
+async def in_database(room_code: str) -> bool:
+    """
+    Room 行があるか（台帳に無い古い部屋の確認用）。同じ周回に来た確認は
+    まとめて1クエリで引く（マッチャが一度に大量に払い出すとき、DBを1件ずつ待たない）。
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    if not _checks:
+        loop.call_soon(_start_checks, loop)
+    _checks.setdefault(room_code, []).append(future)
+    return await future
+
+
+def _start_checks(loop):
+    global _check_task
+    _check_task = loop.create_task(_run_checks())
+
+
+async def _run_checks():
+    global _checks
+    batch, _checks = _checks, {}
+    try:
+        found = await db_async(_in_database_sync)(list(batch))
+    except Exception as e:
+        for futures in batch.values():
+            for f in futures:
+                if not f.done():
+                    f.set_exception(e)
+        return
+    for code, futures in batch.items():
+        for f in futures:
+            if not f.done():
+                f.set_result(code in found)
+
+
+class LocalRoomRegistry:
+    """単一プロセス用。期限つきの dict で持つ"""
+
+    def __init__(self):
+        self._rooms: dict[str, dict] = {}
+
+    def _live(self, room_code: str) -> dict | None:
+        room = self._rooms.get(room_code)
+        if room is not None and room["expires"] <= time.time():
+            del self._rooms[room_code]
+            return None
+        return room
+
+    async def allocate(self) -> str:
+        for _ in range(ALLOCATE_ATTEMPTS):
+            code = _random_code()
+            if self._live(code) is None:
+                self._rooms[code] = {"loaded": False, "expires": time.time() + ROOM_TTL}
+                if not await in_database(code):
+                    return code
+                del self._rooms[code]
+        raise RoomCodesExhausted()
+
+    async def exists(self, room_code: str) -> bool:
+        return self._live(room_code) is not None
+
+    async def claim_load(self, room_code: str) -> bool:
+        """払い出し済みで、まだ一度も読み込まれていなければ True（= 初期状態から始めてよい）"""
+        room = self._live(room_code)
+        if room is None:
+            return False
+        room["expires"] = time.time() + ROOM_TTL
+        first, room["loaded"] = not room["loaded"], True
+        return first
+
+    async def live_count(self) -> int:
+        now = time.time()
+        return sum(1 for r in self._rooms.values() if r["expires"] > now)
+
+    async def remove(self, room_code: str):
+        self._rooms.pop(room_code, None)
+
+    def clear(self):
+        """テスト用"""
+        self._rooms.clear()
+
+
+# KEYS[1]=部屋ハッシュ KEYS[2]=生存部屋 ARGV=(作成時刻, TTL, 期限, コード)
+_ALLOCATE_LUA = """
+if redis.call('HSETNX', KEYS[1], 'created', ARGV[1]) == 0 then return 0 end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+return 1
+"""
+
+# KEYS[1]=部屋ハッシュ KEYS[2]=生存部屋 ARGV=(TTL, 期限, コード)
+_CLAIM_LOAD_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+return redis.call('HSETNX', KEYS[1], 'loaded', '1')
+"""
+
+
+class RedisRoomRegistry:
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+        self._allocate = self._redis.register_script(_ALLOCATE_LUA)
+        self._claim_load = self._redis.register_script(_CLAIM_LOAD_LUA)
+
+    async def allocate(self) -> str:
+        for _ in range(ALLOCATE_ATTEMPTS):
+            code = _random_code()
+            now = time.time()
+            if await self._allocate(keys=[_room_key(code), ROOMS_KEY],
+                                    args=[int(now), ROOM_TTL, now + ROOM_TTL, code]):
+                if not await in_database(code):
+                    return code
+                await self.remove(code)
+        raise RoomCodesExhausted()
+
+    async def exists(self, room_code: str) -> bool:
+        return bool(await self._redis.exists(_room_key(room_code)))
+
+    async def claim_load(self, room_code: str) -> bool:
+        return bool(await self._claim_load(keys=[_room_key(room_code), ROOMS_KEY],
+                                           args=[ROOM_TTL, time.time() + ROOM_TTL, room_code]))
+
+    async def live_count(self) -> int:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(ROOMS_KEY, "-inf", time.time())
+            pipe.zcard(ROOMS_KEY)
+            _, count = await pipe.execute()
+        return count
+
+    async def remove(self, room_code: str):
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(_room_key(room_code))
+            pipe.zrem(ROOMS_KEY, room_code)
+            await pipe.execute()
+
+
+def _make_registry():
+    url = getattr(settings, "ARENA_ROOM_REGISTRY_URL", "")
+    return RedisRoomRegistry(url) if url else LocalRoomRegistry()
+
+
+# プロセス内で1つだけ
+rooms = _make_registry()
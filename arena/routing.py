@@ -1,6 +1,7 @@
 from django.urls import re_path
-from . import consumers
+from . import consumers, sweeper  # noqa: F401  sweeper は inbox ハンドラと掃除ループの登録
 
 websocket_urlpatterns = [
     re_path(r"ws/arena/(?P<room_code>\d{6})/$", consumers.BattleConsumer.as_asgi()),
+    re_path(r"ws/arena/queue/$", consumers.MatchConsumer.as_asgi()),
 ]
@@ -0,0 +1,152 @@
+"""
+対戦ルール（DB・部屋の状態管理に依存しない純粋関数）。
+
+    resolve(fighters, a1, a2)        1部屋・1ターン分。新しい Fighters を返す
+    resolve_batch(fighters, a1, a2)  複数部屋を1回で（NumPy があればベクトル化）
+    resolve_arrays(...)              NumPy 配列のまま解決する下回り（シミュレーション用）
+    simulate(matches, ...)           ランダムな行動で大量の対戦を回し、勝率・ターン数を集計する
+
+NumPy は任意。無ければ resolve_batch は resolve を1件ずつ呼ぶ（結果は同じ）。
+resolve_arrays / simulate は NumPy が必要。
+
+ダメージ値は resolve / resolve_arrays / simulate の引数で差し替えられるので、
+DMG_ATTACK / DMG_CHARGED の調整はサーバを触らずにオフラインで試せる。
+"""
+from typing import NamedTuple
+
+TURN_SECONDS = 30       # 1ターン制限
+DMG_ATTACK = 6          # 通常攻撃
+DMG_CHARGED = 15        # チャージ攻撃
+START_HP = 40
+
+# 配列で扱うときの行動の番号
+ACTION_CODES = {"none": 0, "attack": 1, "guard": 2, "charge": 3, "charged_attack": 4}
+NONE, ATTACK, GUARD, CHARGE, CHARGED_ATTACK = range(5)
+
+
+class Fighters(NamedTuple):
+    """両者の HP・トークンと勝敗（winner は 1 / 2、相打ち・継続中は None）"""
+    p1_hp: int = START_HP
+    p2_hp: int = START_HP
+    p1_tokens: int = 0
+    p2_tokens: int = 0
+    finished: bool = False
+    winner: int | None = None
+
+
+def _dmg(action: str, dmg_attack: int, dmg_charged: int) -> int:
+    if action == "attack":
+        return dmg_attack
+    if action == "charged_attack":
+        return dmg_charged
+    return 0
+
+
+def resolve(f: Fighters, a1: str, a2: str,
+            dmg_attack: int = DMG_ATTACK, dmg_charged: int = DMG_CHARGED) -> Fighters:
+    """
+    同時行動を1ターン分適用する。
+    - ガードは「自分が受ける」ダメージを0にする
+    - チャージでトークン+1、チャージ攻撃でトークン-1
+    """
+    dmg_to_p1 = 0 if a1 == "guard" else _dmg(a2, dmg_attack, dmg_charged)
+    dmg_to_p2 = 0 if a2 == "guard" else _dmg(a1, dmg_attack, dmg_charged)
+    p1_hp = max(0, f.p1_hp - dmg_to_p1)
+    p2_hp = max(0, f.p2_hp - dmg_to_p2)
+
+    p1_tokens = f.p1_tokens + (a1 == "charge") - (a1 == "charged_attack" and f.p1_tokens > 0)
+    p2_tokens = f.p2_tokens + (a2 == "charge") - (a2 == "charged_attack" and f.p2_tokens > 0)
+
+    finished = p1_hp <= 0 or p2_hp <= 0
+    winner = None
+    if p1_hp <= 0 < p2_hp:
+        winner = 2
+    elif p2_hp <= 0 < p1_hp:
+        winner = 1
+    return Fighters(p1_hp, p2_hp, p1_tokens, p2_tokens, finished, winner)
+
+
+def resolve_batch(fighters: list[Fighters], a1: list[str], a2: list[str]) -> list[Fighters]:
+    """resolve を部屋の数だけまとめて行う（NumPy があれば1回のベクトル演算で）"""
+    try:
+        import numpy as np
+    except ImportError:
+        return [resolve(f, x, y) for f, x, y in zip(fighters, a1, a2)]
+    if not fighters:
+        return []
+    cols = np.array([f[:4] for f in fighters], dtype=np.int64).T
+    hp1, hp2, tok1, tok2, finished, winner = resolve_arrays(
+        *cols,
+        np.fromiter((ACTION_CODES[a] for a in a1), np.int8, len(a1)),
+        np.fromiter((ACTION_CODES[a] for a in a2), np.int8, len(a2)),
+    )
+    return [
+        Fighters(int(h1), int(h2), int(t1), int(t2), bool(fin), int(w) or None)
+        for h1, h2, t1, t2, fin, w in zip(hp1, hp2, tok1, tok2, finished, winner)
+    ]
+
+
+def resolve_arrays(p1_hp, p2_hp, p1_tokens, p2_tokens, a1, a2,
+                   dmg_attack: int = DMG_ATTACK, dmg_charged: int = DMG_CHARGED):
+    """
+    resolve の NumPy 版。行動は ACTION_CODES の番号の配列で渡す。
+    (p1_hp, p2_hp, p1_tokens, p2_tokens, finished, winner) の配列を返す（winner の 0 は勝者なし）。
+    """
+    import numpy as np
+
+    a1, a2 = np.asarray(a1), np.asarray(a2)
+    damage = np.array([0, dmg_attack, 0, 0, dmg_charged], dtype=np.int64)
+    p1_hp = np.maximum(0, p1_hp - np.where(a1 == GUARD, 0, damage[a2]))
+    p2_hp = np.maximum(0, p2_hp - np.where(a2 == GUARD, 0, damage[a1]))
+    p1_tokens = p1_tokens + (a1 == CHARGE) - ((a1 == CHARGED_ATTACK) & (p1_tokens > 0))
+    p2_tokens = p2_tokens + (a2 == CHARGE) - ((a2 == CHARGED_ATTACK) & (p2_tokens > 0))
+
+    p1_down, p2_down = p1_hp <= 0, p2_hp <= 0
+    winner = np.where(p1_down & ~p2_down, 2, np.where(p2_down & ~p1_down, 1, 0))
+    return p1_hp, p2_hp, p1_tokens, p2_tokens, p1_down | p2_down, winner
+
+
+def simulate(matches: int, weights: dict[str, float] | None = None, max_turns: int = 200,
+             seed: int | None = None, dmg_attack: int = DMG_ATTACK, dmg_charged: int = DMG_CHARGED) -> dict:
+    """
+    両者が weights の割合でランダムに行動する対戦を matches 件まとめて回す。
+    トークンの無いチャージ攻撃はサーバと同じく「何もしない」に置き換える。
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    weights = weights or {a: 1.0 for a in ACTION_CODES if a != "none"}
+    codes = np.array([ACTION_CODES[a] for a in weights])
+    p = np.array(list(weights.values()), dtype=float)
+    p /= p.sum()
+
+    hp1 = np.full(matches, START_HP, dtype=np.int64)
+    hp2 = hp1.copy()
+    tok1 = np.zeros(matches, dtype=np.int64)
+    tok2 = tok1.copy()
+    turns = np.zeros(matches, dtype=np.int64)
+    winner = np.zeros(matches, dtype=np.int64)
+    live = np.arange(matches)
+    for _ in range(max_turns):
+        if not live.size:
+            break
+        a1 = rng.choice(codes, size=live.size, p=p)
+        a2 = rng.choice(codes, size=live.size, p=p)
+        a1 = np.where((a1 == CHARGED_ATTACK) & (tok1[live] <= 0), NONE, a1)
+        a2 = np.where((a2 == CHARGED_ATTACK) & (tok2[live] <= 0), NONE, a2)
+        hp1[live], hp2[live], tok1[live], tok2[live], finished, winner[live] = resolve_arrays(
+            hp1[live], hp2[live], tok1[live], tok2[live], a1, a2, dmg_attack, dmg_charged,
+        )
+        turns[live] += 1
+        live = live[~finished]
+
+    done = matches - live.size
+    return {
+        "matches": matches,
+        "p1_wins": int((winner == 1).sum()),
+        "p2_wins": int((winner == 2).sum()),
+        "draws": int(done - (winner > 0).sum()),
+        "unfinished": int(live.size),
+        "mean_turns": float(turns.mean()) if matches else 0.0,
+        "p95_turns": float(np.percentile(turns, 95)) if matches else 0.0,
+    }
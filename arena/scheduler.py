@@ -0,0 +1,97 @@
+"""
+ルーム単位の締切スケジューラ。
+
+1ルームにつきタイマーを1本だけ持ち、Turn.deadline ちょうどに解決処理を1回だけ呼ぶ。
+以前は接続ごとの turn_watcher が毎秒DBを叩いていたが、こちらは待機中のルームでは
+DBに一切触れない。タイマーは部屋の接続数で管理し、最後の接続が抜けたら止める。
+接続数は部屋ごと・ソケットのいるワーカーごとに数える（"" はこのプロセス）。
+ワーカーが落ちて leave が届かなくても、リングから外れた時点でその分を捨てられる。
+"""
+import asyncio
+import logging
+
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class RoomScheduler:
+    def __init__(self):
+        self._handles: dict[str, asyncio.TimerHandle] = {}
+        # 部屋 → ワーカー → 接続数
+        self._members: dict[str, dict[str, int]] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    # ===== 接続数の管理 =====
+    def attach(self, room_code: str, worker: str = ""):
+        counts = self._members.setdefault(room_code, {})
+        counts[worker] = counts.get(worker, 0) + 1
+
+    def detach(self, room_code: str, worker: str = "") -> int:
+        """worker の接続を1つ減らし、部屋に残る接続数を返す"""
+        counts = self._members.get(room_code, {})
+        left = counts.get(worker, 0) - 1
+        if left > 0:
+            counts[worker] = left
+        else:
+            counts.pop(worker, None)
+        if counts:
+            return sum(counts.values())
+        # 誰もいない部屋はタイマーごと止める（再入室時に張り直す）
+        self._members.pop(room_code, None)
+        self.cancel(room_code)
+        return 0
+
+    def members(self, room_code: str) -> int:
+        return sum(self._members.get(room_code, {}).values())
+
+    def drop_worker(self, worker: str) -> list[str]:
+        """
+        いなくなったワーカーの接続を数から外す（そのワーカーからの leave はもう届かない）。
+        それで誰もいなくなった部屋（タイマーは止めた）を返す。
+        """
+        emptied = []
+        for room_code, counts in list(self._members.items()):
+            if counts.pop(worker, None) is not None and not counts:
+                del self._members[room_code]
+                self.cancel(room_code)
+                emptied.append(room_code)
+        return emptied
+
+    def forget(self, room_code: str):
+        """担当を外れた部屋のタイマーと接続数を捨てる"""
+        self._members.pop(room_code, None)
+        self.cancel(room_code)
+
+    # ===== タイマー =====
+    def arm(self, room_code: str, deadline, callback):
+        """締切 deadline に callback(room_code) を1回だけ呼ぶ。既存のタイマーは置き換える。"""
+        self.cancel(room_code)
+        if not self._members.get(room_code):
+            return
+        loop = asyncio.get_running_loop()
+        delay = max(0.0, (deadline - timezone.now()).total_seconds())
+        self._handles[room_code] = loop.call_later(delay, self._fire, room_code, callback)
+
+    def cancel(self, room_code: str):
+        handle = self._handles.pop(room_code, None)
+        if handle is not None:
+            handle.cancel()
+
+    def is_armed(self, room_code: str) -> bool:
+        return room_code in self._handles
+
+    def _fire(self, room_code: str, callback):
+        self._handles.pop(room_code, None)
+        task = asyncio.ensure_future(callback(room_code))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("turn resolution failed", exc_info=task.exception())
+
+
+# プロセス内で1つだけ
+scheduler = RoomScheduler()
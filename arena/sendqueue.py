@@ -0,0 +1,113 @@
+"""
+送信のバックプレッシャ（ソケットごとの上限つき送信待ち）。
+
+consumer がチャンネルレイヤから受けたログ・状態をその場で await して書くと、
+回線の遅いクライアントの分だけ consumer が止まり、届けられないグループメッセージが
+チャンネルレイヤに溜まる（capacity を超えた分は黙って捨てられる）。ここでは:
+
+    - 書き込みはソケットごとの書き込みタスク1本で行い、consumer は待たない
+    - 書き込み中に来た状態は最新の1つだけ残す（古い版は送る意味がない）
+    - ログは SEND_QUEUE_LOGS 行まで。超えたら古いものから捨てる
+      （取りこぼしは再開時に engine のバッファから ?since で取り戻せる）
+    - 1回の書き込みが SEND_STALL_SECONDS 以上終わらないソケットは、
+      再接続の案内を付けて 1013 で切る（クライアントは ?since 付きで繋ぎ直して差分で追いつく）
+
+1ソケットが持つのは、ログ数行と状態1つ（またはエンコード済みフレーム1つ）だけ。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SEND_QUEUE_LOGS = getattr(settings, "ARENA_SEND_QUEUE_LOGS", 50)              # 送信待ちのログ行の上限
+SEND_STALL_SECONDS = getattr(settings, "ARENA_SEND_STALL_SECONDS", 10.0)     # これ以上書けないソケットは切る
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+class SendQueue:
+    __slots__ = ("_send", "_render", "logs", "state", "frame", "closed", "_task", "_since")
+
+    def __init__(self, send, render=None):
+        self._send = send           # consumer.send
+        self._render = render       # (ログ, 状態) -> send の引数（送るものが無ければ None）
+        self.logs: deque = deque()
+        self.state: dict | None = None
+        self.frame: dict | None = None
+        self.closed = False
+        self._task: asyncio.Task | None = None
+        self._since: float | None = None     # 書き込み中のフレームを書き始めた時刻
+
+    @property
+    def pending(self) -> bool:
+        """まだ書いていないものがある"""
+        return bool(self.logs) or self.state is not None or self.frame is not None
+
+    def put_log(self, item: dict):
+        if self.closed:
+            return
+        if len(self.logs) >= SEND_QUEUE_LOGS:
+            self.logs.popleft()
+            metrics.send_dropped_logs.inc()
+        self.logs.append(item)
+        self._kick()
+
+    def put_state(self, state: dict):
+        """部屋の状態（スナップショット）。フレームにするのは書く直前"""
+        if self.closed:
+            return
+        if self.state is not None:
+            if state["version"] <= self.state["version"]:
+                return
+            metrics.send_superseded.inc()
+        self.state = state
+        self._kick()
+
+    def put_frame(self, frame: dict):
+        """エンコード済みのフレーム（send の引数）。書き込み待ちのものがあれば置き換える"""
+        if self.closed:
+            return
+        if self.frame is not None:
+            metrics.send_superseded.inc()
+        self.frame = frame
+        self._kick()
+
+    def stalled(self) -> bool:
+        return self._since is not None and time.monotonic() - self._since >= SEND_STALL_SECONDS
+
+    def close(self):
+        self.closed = True
+        self.logs.clear()
+        self.state = self.frame = None
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    def _kick(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        try:
+            while not self.closed and self.pending:
+                frame, self.frame = self.frame, None
+                if frame is None:
+                    logs, self.logs = list(self.logs), deque()
+                    state, self.state = self.state, None
+                    frame = self._render(logs, state)
+                    if frame is None:
+                        continue
+                self._since = time.monotonic()
+                await self._send(**frame)
+                self._since = None
+        except Exception:
+            # 切断済みのソケットなど。以降は何も書かない
+            logger.debug("send queue closed", exc_info=True)
+            self.close()
+        finally:
+            self._task = None
+            self._since = None
@@ -0,0 +1,265 @@
+"""
+ルームのオーナー（担当ワーカー）決定とワーカー間の転送。
+
+部屋コードごとにゲームループ（RoomEngine 上の状態と締切タイマー）を持つワーカーを
+ちょうど1つに決める。生存ワーカーをレジストリに登録し、コンシステントハッシュで
+部屋コード → ワーカーを引く。オーナー以外のワーカーに来たソケットは、
+チャンネルレイヤ経由でオーナーの受信チャンネル（inbox）へ操作を転送し、
+状態は部屋グループへのブロードキャストで受け取る。
+
+ワーカーが落ちるとハートビートが WORKER_TTL 秒で切れて一覧から外れ、
+リングが組み直される。その部屋は次のオーナーがDBの最新フラッシュから読み直して
+引き継ぐ。生きたまま担当が移る場合（ワーカー追加など）は、旧オーナーが
+状態を書き出してから room.handoff で新オーナーへ渡す。
+
+ハートビート・inbox・add_loop で登録した処理（掃除役など）は、ワーカーの起動時に
+WorkerStartup（asgi.py で application を包む）が始める。ASGI lifespan を送るサーバ
+（uvicorn）なら起動の時点で、送らないサーバでも最初のリクエスト（種類を問わない）で始まる。
+ソケットが1本も来ないワーカーでも掃除役は動く。
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import re
+import secrets
+import socket
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+VNODES = 64             # 1ワーカーあたりの仮想ノード数
+HEARTBEAT_INTERVAL = getattr(settings, "ARENA_HEARTBEAT_INTERVAL", 2.0)
+WORKER_TTL = getattr(settings, "ARENA_WORKER_TTL", 6.0)
+REGISTRY_KEY = "arena:workers"
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """部屋コード → ワーカーID のコンシステントハッシュ"""
+
+    def __init__(self, workers=(), vnodes: int = VNODES):
+        self.workers = frozenset(workers)
+        points = sorted((_hash(f"{w}#{i}"), w) for w in self.workers for i in range(vnodes))
+        self._keys = [p for p, _ in points]
+        self._owners = [w for _, w in points]
+
+    def owner(self, key: str) -> str | None:
+        if not self._keys:
+            return None
+        i = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._owners[i]
+
+
+# ===== 生存ワーカーの一覧 =====
+class LocalRegistry:
+    """単一プロセス用（ARENA_REGISTRY_URL 未設定時）。自分だけが生存ワーカー"""
+
+    def __init__(self):
+        self._alive: set[str] = set()
+
+    async def heartbeat(self, worker_id: str):
+        self._alive.add(worker_id)
+
+    async def alive(self) -> set[str]:
+        return set(self._alive)
+
+    async def remove(self, worker_id: str):
+        self._alive.discard(worker_id)
+
+
+class RedisRegistry:
+    """Redis の sorted set（score = 最終ハートビート時刻）で生存ワーカーを管理する"""
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+        self._redis = redis.from_url(url)
+
+    async def heartbeat(self, worker_id: str):
+        now = time.time()
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(REGISTRY_KEY, {worker_id: now})
+            pipe.zremrangebyscore(REGISTRY_KEY, "-inf", now - WORKER_TTL)
+            await pipe.execute()
+
+    async def alive(self) -> set[str]:
+        members = await self._redis.zrangebyscore(REGISTRY_KEY, time.time() - WORKER_TTL, "+inf")
+        return {m.decode() for m in members}
+
+    async def remove(self, worker_id: str):
+        await self._redis.zrem(REGISTRY_KEY, worker_id)
+
+
+def _make_registry():
+    url = getattr(settings, "ARENA_REGISTRY_URL", "")
+    return RedisRegistry(url) if url else LocalRegistry()
+
+
+# ===== クラスタ =====
+class Cluster:
+    def __init__(self):
+        host = re.sub(r"[^\w\-.]", "-", socket.gethostname())[:40]
+        self.worker_id = f"{host}-{os.getpid()}-{secrets.token_hex(3)}"
+        self.inbox = self.inbox_of(self.worker_id)
+        self.ring = HashRing([self.worker_id])
+        self.registry = _make_registry()
+        self.leaving = False
+        self._handlers: dict[str, object] = {}
+        self._ring_listeners: list = []
+        self._loops: list = []
+        self._tasks: list[asyncio.Task] = []
+        self._running: set[asyncio.Task] = set()
+
+    @staticmethod
+    def inbox_of(worker_id: str) -> str:
+        return f"arena.worker.{worker_id}"
+
+    # ===== 登録 =====
+    def on(self, msg_type: str, handler):
+        """inbox に届いた msg_type のメッセージを handler(message) で処理する"""
+        self._handlers[msg_type] = handler
+
+    def on_ring_change(self, callback):
+        """リングが組み直されたら callback(old_ring, new_ring) を呼ぶ"""
+        self._ring_listeners.append(callback)
+
+    def add_loop(self, factory):
+        """ワーカーの起動（ensure_started）と一緒に factory() のコルーチンを回し続ける"""
+        self._loops.append(factory)
+
+    # ===== 問い合わせ =====
+    def owner(self, room_code: str) -> str:
+        return self.ring.owner(room_code) or self.worker_id
+
+    def is_local(self, room_code: str) -> bool:
+        return self.owner(room_code) == self.worker_id
+
+    def is_leader(self) -> bool:
+        """
+        全体で1つだけ動かす処理の担当か。リング上で ID が最小の生存ワーカーをリーダーとする
+        （リングの組み直し中は一時的に2つになりうるので、処理側は重複に耐えること）。
+        """
+        return min(self.ring.workers, default=self.worker_id) == self.worker_id
+
+    async def send_to_owner(self, room_code: str, message: dict):
+        await self.send_to(self.owner(room_code), message)
+
+    async def send_to(self, worker_id: str, message: dict):
+        await get_channel_layer().send(self.inbox_of(worker_id), message)
+
+    # ===== 起動 =====
+    def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._tasks and all(not t.done() and t.get_loop() is loop for t in self._tasks):
+            return
+        for t in self._tasks:
+            if not t.done():
+                try:
+                    t.cancel()
+                except RuntimeError:
+                    pass  # ループ終了済み
+        self._tasks = [
+            loop.create_task(self._heartbeat_loop()),
+            loop.create_task(self._inbox_loop()),
+            *[loop.create_task(factory()) for factory in self._loops],
+        ]
+
+    async def _heartbeat_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("worker heartbeat failed")
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def refresh(self):
+        """ハートビートを打ち、生存ワーカーが変わっていればリングを組み直す"""
+        if not self.leaving:
+            await self.registry.heartbeat(self.worker_id)
+        alive = await self.registry.alive()
+        if self.leaving:
+            alive.discard(self.worker_id)
+            if not alive:
+                return  # 引き渡せる先がいない（担当は自分のまま）
+        else:
+            alive.add(self.worker_id)
+        if alive == self.ring.workers:
+            return
+        old, self.ring = self.ring, HashRing(alive)
+        logger.info("worker ring changed: %d workers", len(alive))
+        for callback in self._ring_listeners:
+            try:
+                await callback(old, self.ring)
+            except Exception:
+                logger.exception("ring change handler failed")
+
+    async def leave(self):
+        """
+        リングから抜ける（停止前の drain 用）。担当の部屋はリング変更の処理で
+        ほかのワーカーへ引き渡される。ほかに生存ワーカーがいなければ担当は自分のまま。
+        """
+        self.leaving = True
+        await self.registry.remove(self.worker_id)
+        await self.refresh()
+
+    async def _inbox_loop(self):
+        layer = get_channel_layer()
+        while True:
+            message = await layer.receive(self.inbox)
+            handler = self._handlers.get(message.get("type"))
+            if handler is None:
+                logger.warning("unknown worker message: %s", message.get("type"))
+                continue
+            # 部屋ごとの処理で受信ループを止めない
+            task = asyncio.ensure_future(handler(message))
+            self._running.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("worker message failed", exc_info=task.exception())
+
+
+# プロセス内で1つだけ
+cluster = Cluster()
+
+
+class WorkerStartup:
+    """
+    ワーカーの起動時にクラスタの処理を始める ASGI アプリ（app を包む）。
+    lifespan はここで受け、それ以外のリクエストは始まっていることを確かめてから app へ渡す。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "lifespan":
+            cluster.ensure_started()
+            return await self.app(scope, receive, send)
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    cluster.ensure_started()
+                except Exception as e:
+                    logger.exception("worker startup failed")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+metrics.registry.gauge("arena_worker_info", "This worker's id", labels={"worker": cluster.worker_id}).set(1)
+metrics.registry.gauge("arena_ring_workers", "Workers on the room ownership ring", lambda: len(cluster.ring.workers))
@@ -0,0 +1,170 @@
+"""
+観戦（読み取り専用の配信ツリー）。
+
+観戦ソケットは対戦の経路（部屋グループ・担当ワーカーの参加処理・締切タイマー）に
+一切乗らない。配信は2段:
+
+    担当ワーカー --(観戦グループ, SPECTATOR_WINDOW ごとに間引き)--> 各ワーカーの inbox
+    各ワーカーの SpectatorHub --(プロセス内)--> そのワーカーの観戦ソケット
+
+観戦グループに入るのはソケットではなくワーカーの inbox なので、グループの大きさは
+ワーカー数で頭打ちになる。ワーカー内では部屋ごとに1回だけフレームを組み立てて
+エンコードし、同じバイト列を全観戦者の送信待ち（sendqueue.SendQueue）へ置く。
+書き込みが追いつかない観戦者の分は最新のフレームに置き換わる。
+DBアクセスもソケットごとのタイマーも無い。
+
+ワーカーで最初の観戦者が来たときだけ、担当ワーカーへ room.watch を送って
+現在のスナップショットを1回もらう（最後の観戦者が抜けたら room.unwatch）。
+"""
+from channels.layers import get_channel_layer
+
+from .engine import engine
+from .outbox import outbox, watch_group_name
+from .scheduler import scheduler
+from .sharding import cluster
+from . import wire
+
+
+class SpectatorHub:
+    def __init__(self):
+        self._sockets: dict[str, set] = {}
+        # 部屋 → (版数, 観戦者から見た状態)。差分の基準（ワーカー内の観戦者で共有）
+        self._views: dict[str, tuple[int, dict]] = {}
+
+    def watchers(self, room_code: str) -> int:
+        return len(self._sockets.get(room_code, ()))
+
+    async def add(self, consumer):
+        code = consumer.room_code
+        consumer._version = -1
+        sockets = self._sockets.get(code)
+        if sockets is None:
+            sockets = self._sockets[code] = set()
+            sockets.add(consumer)
+            await get_channel_layer().group_add(watch_group_name(code), cluster.inbox)
+            await self._subscribe(code)
+            return
+        sockets.add(consumer)
+        # 途中から来た観戦者には全量を1回だけ
+        await self.resync(consumer)
+
+    async def remove(self, consumer):
+        code = consumer.room_code
+        sockets = self._sockets.get(code)
+        if sockets is None or consumer not in sockets:
+            return
+        sockets.discard(consumer)
+        if sockets:
+            return
+        del self._sockets[code]
+        self._views.pop(code, None)
+        await get_channel_layer().group_discard(watch_group_name(code), cluster.inbox)
+        await cluster.send_to_owner(code, {"type": "room.unwatch", "room": code})
+
+    async def _subscribe(self, room_code: str):
+        await cluster.send_to_owner(room_code, {
+            "type": "room.watch", "room": room_code, "reply": cluster.inbox,
+        })
+
+    async def deliver(self, room_code: str, events: list[dict]):
+        """観戦グループから届いた分を、このワーカーの観戦者へ書く"""
+        sockets = self._sockets.get(room_code)
+        if not sockets:
+            return
+        logs = [{"type": "log", "text": ev["text"]} for ev in events if ev["type"] == "log_msg"]
+        states = [ev["state"] for ev in events if ev["type"] == "state_msg"]
+
+        prev = self._views.get(room_code)
+        full = delta = None
+        if states and (prev is None or states[-1]["version"] > prev[0]):
+            snap = states[-1]
+            view = wire.project_state(snap, 0)
+            changes = wire.diff_state(prev[1], view) if prev is not None else None
+            # 見た目が変わらない版は送らない（基準も据え置き。対戦側の _state_frame と同じ）
+            if prev is None or changes:
+                self._views[room_code] = (snap["version"], view)
+                full = {"type": "state", "v": snap["version"], **view}
+                if prev is not None:
+                    delta = {"type": "state", "v": snap["version"], "base": prev[0], "delta": changes}
+
+        # フレームはワイヤ形式ごとに1回だけエンコードする
+        encoded: dict[tuple, dict] = {}
+        for consumer in list(sockets):
+            queue = consumer.outq
+            if queue.stalled():
+                consumer.shed()
+                continue
+            if full is None:
+                state, kind = None, "none"
+            elif delta is not None and consumer._version == prev[0] and queue.frame is None:
+                # 書き込み待ちのフレームは置き換わる（届いていない版を基準にした差分は送れない）
+                state, kind = delta, "delta"
+            else:
+                state, kind = full, "full"
+            items = logs + ([state] if state is not None else [])
+            if not items:
+                continue
+            key = (consumer.binary, kind)
+            frame = encoded.get(key)
+            if frame is None:
+                content = items[0] if len(items) == 1 else {"type": "batch", "items": items}
+                frame = encoded[key] = wire.encode(content, consumer.binary)
+            # 書き込みはソケットごとの送信待ちへ（遅い観戦者がいても他の観戦者を待たせない）
+            queue.put_frame(frame)
+            if state is not None:
+                consumer._version = state["v"]
+
+    async def resync(self, consumer):
+        """観戦者からの sync 要求: 手元の最新を全量で送り直す"""
+        current = self._views.get(consumer.room_code)
+        if current is not None:
+            version, view = current
+            consumer.outq.put_frame(wire.encode({"type": "state", "v": version, **view}, consumer.binary))
+            consumer._version = version
+
+    def clear(self):
+        """テスト用"""
+        self.__init__()
+
+
+# プロセス内で1つだけ
+hub = SpectatorHub()
+
+
+# ===== ワーカー間メッセージ（inbox） =====
+async def _on_room_watch(message):
+    """担当ワーカー側: 観戦者を抱えるワーカーを数え、現在の状態を1回返す"""
+    code = message["room"]
+    outbox.watch(code, +1)
+    state = await engine.acquire(code)
+    snap = engine.snapshot(state)
+    if not scheduler.members(code):
+        # 対戦者のいない部屋を観戦のためにメモリへ置き続けない
+        engine.release(code)
+    await get_channel_layer().send(message["reply"], {
+        "type": "room.watch_batch", "room": code,
+        "events": [{"type": "state_msg", "state": snap}],
+    })
+
+
+async def _on_room_unwatch(message):
+    outbox.watch(message["room"], -1)
+
+
+async def _on_watch_batch(message):
+    await hub.deliver(message["room"], message["events"])
+
+
+async def _on_ring_change(old, new):
+    # 担当を外れた部屋の観戦数は捨て、担当が変わった部屋は新しい担当へ登録し直す
+    for code in [c for c in outbox.watched if new.owner(c) != cluster.worker_id]:
+        del outbox.watched[code]
+    for code in list(hub._sockets):
+        if old.owner(code) != new.owner(code):
+            await hub._subscribe(code)
+
+
+cluster.on("room.watch", _on_room_watch)
+cluster.on("room.unwatch", _on_room_unwatch)
+cluster.on("room.watch_batch", _on_watch_batch)
+cluster.on_ring_change(_on_ring_change)
@@ -0,0 +1,276 @@
+"""
+最適戦略の表（ボット用。バランス調整の分析にも使う）。
+
+対戦を同時手番のゼロサムゲームとして、オフラインで解いておく:
+
+    状態   (自分の HP, 相手の HP, 自分のトークン, 相手のトークン)
+    値     自分が勝つ確率（相打ちは 0.5）
+    方策   その状態で自分が選ぶ行動の混合戦略（相手も最適に打つ前提）
+
+HP は START_HP から DMG_ATTACK / DMG_CHARGED を引いて届く値だけを持つ（40, 34, 28, 25, ...）。
+トークンは TOKEN_CAP で頭打ちにして数える（それ以上は同じ状態とみなす）。
+"none" は "guard" に常に負けるので候補に入れない。
+
+ダメージが入ると両者の HP の合計が必ず減るので、HP の組を合計の小さい順に解けば、
+行き先はすでに解いた状態か、同じ HP の組（ガード・チャージでトークンだけ変わる）になる。
+同じ HP の組の中だけは値の反復で収束させる。各状態の行列ゲームは小さい（4×4 まで）ので
+サポートの列挙で厳密に解く。
+
+ループ（ガードの打ち合いなど）で決着しない手順を選ばないよう、先の値は DISCOUNT で
+その場の形勢（HP の取り分）の側へ割り引き、ガードには GUARD_COST の手番の損を付ける
+（どちらも両者の値の和は 1 のまま）。
+
+解いた表は strategy.bin に置き、起動時（AppConfig.ready）に1回だけ読み込む（load_table()）。
+表が無い・今のルールの値と前提が違うときはエラーを出し、ボットは座らない。
+プロセス内では解き直さない（1分以上かかり、その間イベントループが止まる）。
+作り直しは manage.py solve_strategy --write。
+"""
+import itertools
+import json
+import logging
+import random
+import sys
+from array import array
+from pathlib import Path
+
+from . import rules
+
+logger = logging.getLogger(__name__)
+
+ACTIONS = ("attack", "guard", "charge", "charged_attack")
+TOKEN_CAP = 3
+DISCOUNT = 0.9
+GUARD_COST = 0.01
+GUARD = ACTIONS.index("guard")
+TABLE_PATH = Path(__file__).with_name("strategy.bin")
+
+_EPS = 1e-9
+_TOL = 1e-6     # 同じ HP の組の値の反復を止める変化量（表の値の刻み 1/65535 より細かく）
+
+
+# ===== 行列ゲーム =====
+def _solve_square(a: list[list[float]], rows, cols):
+    """
+    行 rows の混合で列 cols の利得を等しくする（行の戦略, 値）。解けなければ None。
+    未知数 p_rows と v、式は「列 j で sum p_i a_ij - v = 0」と「sum p_i = 1」。
+    """
+    k = len(rows)
+    m = [[a[i][j] for i in rows] + [-1.0, 0.0] for j in cols]
+    m.append([1.0] * k + [0.0, 1.0])
+    n = k + 1
+    for c in range(n):
+        pivot = max(range(c, n), key=lambda r: abs(m[r][c]))
+        if abs(m[pivot][c]) < _EPS:
+            return None
+        m[c], m[pivot] = m[pivot], m[c]
+        row = m[c]
+        for r in range(n):
+            if r != c and m[r][c]:
+                f = m[r][c] / row[c]
+                m[r] = [x - f * y for x, y in zip(m[r], row)]
+    x = [m[r][n] / m[r][r] for r in range(n)]
+    return x[:k], x[k]
+
+
+def solve_matrix(a: list[list[float]]) -> tuple[float, list[float]]:
+    """行の側（最大化）から見たゼロサムゲームの値と、行の最適な混合戦略"""
+    nr, nc = len(a), len(a[0])
+    t = [list(col) for col in zip(*a)]
+    lower = [min(r) for r in a]
+    best = max(range(nr), key=lower.__getitem__)
+    value, strategy = lower[best], [1.0 if i == best else 0.0 for i in range(nr)]
+    # 鞍点（純粋戦略で決まる）なら列挙しない
+    if min(max(col) for col in t) - value < _EPS:
+        return value, strategy
+
+    for k in range(2, min(nr, nc) + 1):
+        for rows in itertools.combinations(range(nr), k):
+            for cols in itertools.combinations(range(nc), k):
+                found = _solve_square(a, rows, cols)
+                if found is None:
+                    continue
+                p, v = found
+                if min(p) < -_EPS or v <= value + _EPS:
+                    continue
+                if any(sum(pi * a[i][j] for pi, i in zip(p, rows)) < v - 1e-7 for j in range(nc)):
+                    continue
+                value = v
+                strategy = [0.0] * nr
+                for pi, i in zip(p, rows):
+                    strategy[i] = max(0.0, pi)
+                # 列の側も同じ値を保証できれば均衡（それ以上は探さない）
+                dual = _solve_square(t, cols, rows)
+                if dual is not None and min(dual[0]) >= -_EPS and abs(dual[1] - v) < 1e-7 and all(
+                    sum(qj * a[i][j] for qj, j in zip(dual[0], cols)) <= v + 1e-7 for i in range(nr)
+                ):
+                    return value, strategy
+    return value, strategy
+
+
+# ===== 全状態を解く =====
+def hp_values(start_hp: int, dmg_attack: int, dmg_charged: int) -> list[int]:
+    """START_HP から届く HP の値（0 を含む。小さい順）"""
+    seen, todo = {start_hp}, [start_hp]
+    while todo:
+        hp = todo.pop()
+        for d in (dmg_attack, dmg_charged):
+            nxt = max(0, hp - d)
+            if d > 0 and nxt not in seen:
+                seen.add(nxt)
+                todo.append(nxt)
+    return sorted(seen)
+
+
+def _legal(tokens: int) -> list[int]:
+    return [0, 1, 2, 3] if tokens > 0 else [0, 1, 2]
+
+
+def solve(dmg_attack: int = rules.DMG_ATTACK, dmg_charged: int = rules.DMG_CHARGED,
+          start_hp: int = rules.START_HP, token_cap: int = TOKEN_CAP, discount: float = DISCOUNT,
+          guard_cost: float = GUARD_COST) -> "Table":
+    hps = hp_values(start_hp, dmg_attack, dmg_charged)
+    t = token_cap + 1
+    n = len(hps) * len(hps) * t * t
+    values = [0.5] * n
+    policy = [(0.0,) * len(ACTIONS)] * n
+    index = {hp: i for i, hp in enumerate(hps)}
+
+    def at(a, b, ta, tb):
+        return ((index[a] * len(hps) + index[b]) * t + ta) * t + tb
+
+    def payoff(a, b, ta, tb, x, y):
+        f = rules.resolve(rules.Fighters(a, b, ta, tb), ACTIONS[x], ACTIONS[y], dmg_attack, dmg_charged)
+        if f.finished:
+            return 1.0 if f.winner == 1 else 0.0 if f.winner == 2 else 0.5
+        # ガードしたほうが相手へ少し渡す（ガードの打ち続けで膠着させない。和は 1 のまま）
+        tempo = guard_cost * ((y == GUARD) - (x == GUARD))
+        # 続きの値は、その場の形勢（HP の取り分）の側へ割り引く
+        rest = values[at(f.p1_hp, f.p2_hp, min(f.p1_tokens, token_cap), min(f.p2_tokens, token_cap))]
+        return discount * rest + (1 - discount) * f.p1_hp / (f.p1_hp + f.p2_hp) + tempo
+
+    live = [hp for hp in hps if hp > 0]
+    for a, b in sorted(itertools.product(live, live), key=sum):
+        block = [(ta, tb) for ta in range(t) for tb in range(t)]
+        for _ in range(1000):
+            change = 0.0
+            for ta, tb in block:
+                mine, theirs = _legal(ta), _legal(tb)
+                v, p = solve_matrix([[payoff(a, b, ta, tb, x, y) for y in theirs] for x in mine])
+                i = at(a, b, ta, tb)
+                change = max(change, abs(values[i] - v))
+                values[i] = v
+                policy[i] = tuple(p) + (0.0,) * (len(ACTIONS) - len(p))
+            if change < _TOL:
+                break
+    return Table(
+        {"start_hp": start_hp, "dmg_attack": dmg_attack, "dmg_charged": dmg_charged,
+         "token_cap": token_cap, "discount": discount, "guard_cost": guard_cost, "hp": hps, "actions": list(ACTIONS)},
+        array("B", _quantize(policy)), array("H", (round(v * 65535) for v in values)),
+    )
+
+
+def _quantize(policy) -> list[int]:
+    """確率を 0..255 の整数に（合計がちょうど 255 になるよう端数を配る）"""
+    out = []
+    for p in policy:
+        if not any(p):
+            out.extend([0] * len(p))
+            continue
+        raw = [x * 255 for x in p]
+        q = [int(x) for x in raw]
+        for i in sorted(range(len(p)), key=lambda i: q[i] - raw[i])[:255 - sum(q)]:
+            q[i] += 1
+        out.extend(q)
+    return out
+
+
+# ===== 表 =====
+class Table:
+    """解いた表。引くのは添字の計算1回（O(1)）"""
+
+    def __init__(self, params: dict, policy: array, values: array):
+        self.params = params
+        self.policy = policy
+        self.values = values
+        hps = params["hp"]
+        self._width = len(hps)
+        self._tokens = params["token_cap"] + 1
+        # HP → 添字（表に無い HP は、それ以上で一番近い値の添字）
+        self._hp_index = [next(i for i, v in enumerate(hps) if v >= hp) for hp in range(hps[-1] + 1)]
+
+    def _at(self, me_hp: int, op_hp: int, me_tokens: int, op_tokens: int) -> int:
+        last, cap = len(self._hp_index) - 1, self._tokens - 1
+        a = self._hp_index[min(max(me_hp, 0), last)]
+        b = self._hp_index[min(max(op_hp, 0), last)]
+        return ((a * self._width + b) * self._tokens + min(me_tokens, cap)) * self._tokens + min(op_tokens, cap)
+
+    def mix(self, me_hp: int, op_hp: int, me_tokens: int, op_tokens: int) -> dict[str, float]:
+        i = self._at(me_hp, op_hp, me_tokens, op_tokens) * len(ACTIONS)
+        return {a: w / 255 for a, w in zip(ACTIONS, self.policy[i:i + len(ACTIONS)])}
+
+    def value(self, me_hp: int, op_hp: int, me_tokens: int, op_tokens: int) -> float:
+        return self.values[self._at(me_hp, op_hp, me_tokens, op_tokens)] / 65535
+
+    def choose(self, me_hp: int, op_hp: int, me_tokens: int, op_tokens: int, rng=random) -> str:
+        i = self._at(me_hp, op_hp, me_tokens, op_tokens) * len(ACTIONS)
+        weights = self.policy[i:i + len(ACTIONS)]
+        if not any(weights):
+            return "guard"
+        return rng.choices(ACTIONS, weights)[0]
+
+    def save(self, path: Path = TABLE_PATH):
+        values = array("H", self.values)
+        if sys.byteorder != "little":
+            values.byteswap()
+        with open(path, "wb") as f:
+            f.write(json.dumps(self.params, separators=(",", ":")).encode() + b"\n")
+            f.write(self.policy.tobytes())
+            f.write(values.tobytes())
+
+    @classmethod
+    def load(cls, path: Path = TABLE_PATH) -> "Table":
+        with open(path, "rb") as f:
+            params = json.loads(f.readline())
+            n = len(params["hp"]) ** 2 * (params["token_cap"] + 1) ** 2
+            policy = array("B")
+            policy.frombytes(f.read(n * len(ACTIONS)))
+            values = array("H")
+            values.frombytes(f.read(n * 2))
+        if sys.byteorder != "little":
+            values.byteswap()
+        return cls(params, policy, values)
+
+
+def current_params() -> dict:
+    return {"start_hp": rules.START_HP, "dmg_attack": rules.DMG_ATTACK, "dmg_charged": rules.DMG_CHARGED,
+            "token_cap": TOKEN_CAP, "discount": DISCOUNT, "guard_cost": GUARD_COST}
+
+
+_table: Table | None = None
+
+
+def load_table(path: Path = TABLE_PATH) -> Table | None:
+    """
+    起動時に表を読み込む。無い・壊れている・今のルールと前提が違うときは
+    エラーを出して None（ボットは座らない）。
+    """
+    global _table
+    _table = None
+    try:
+        loaded = Table.load(path)
+    except (OSError, ValueError):
+        logger.error("strategy table %s unreadable; bots disabled (run manage.py solve_strategy --write)",
+                     path, exc_info=True)
+        return None
+    stale = {k: (loaded.params.get(k), v) for k, v in current_params().items() if loaded.params.get(k) != v}
+    if stale:
+        logger.error("strategy table %s is stale %s; bots disabled (run manage.py solve_strategy --write)",
+                     path, stale)
+        return None
+    _table = loaded
+    return _table
+
+
+def table() -> Table | None:
+    """起動時に読み込んだ表（使えなければ None。ここで解くことはしない）"""
+    return _table
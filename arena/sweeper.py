@@ -0,0 +1,116 @@
+"""
+締切を過ぎたまま放置されたターンの掃除（全体スケジューラ）。
+
+ルームの締切タイマー（scheduler）は接続のある部屋にしか張られないので、
+両者が抜けた部屋は途中のターンのまま止まってしまう。ここでは全体で1つの掃除役
+（リーダーのワーカー）が SWEEP_INTERVAL ごとに:
+
+    1. 締切を SWEEP_GRACE 以上過ぎた未解決の現在ターンを1クエリで拾い
+       （Turn の部分インデックス arena_turn_due_idx を使う）
+    2. 部屋の担当ワーカーごとにまとめて room.sweep で渡す
+
+担当ワーカーは、メモリに載っていない部屋だけをまとめて1クエリで読み込み（engine.preload）、
+まとめて解決して（engine.resolve_many。ルールの計算は rules.resolve_batch の1回）、
+write-behind の1回のフラッシュでまとめて書く。
+メモリに載っている部屋は接続がある＝締切タイマーが動いているので触らない。
+
+どちらの側も入力していないターンは解決せず、締切から ABANDON_AFTER 過ぎたら
+放置された部屋として勝敗なしで終わらせる。
+
+掃除役はリングの組み直し中に一時的に2つになりうるが、解決するのは担当ワーカーが
+メモリ上の状態に対してだけで、締切前のターンは解決しないので、同じターンが二重に解決されることはない。
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics
+from .consumers import announce_resolved, publish_log
+from .db import db_async
+from .engine import engine
+from .models import Turn
+from .outbox import outbox
+from .scheduler import scheduler
+from .sharding import cluster
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = getattr(settings, "ARENA_SWEEP_INTERVAL", 5.0)        # 秒
+SWEEP_GRACE = timedelta(seconds=getattr(settings, "ARENA_SWEEP_GRACE", 5.0))   # フラッシュの遅れより長く
+ABANDON_AFTER = timedelta(seconds=getattr(settings, "ARENA_ABANDON_AFTER", 300.0))
+SWEEP_BATCH = 500       # 1回に拾う部屋数の上限
+
+
+def _due_sync(now, limit: int) -> list[str]:
+    """締切を過ぎた未解決の現在ターンを持つ部屋のコード（締切の古い順）"""
+    return list(
+        Turn.objects.filter(resolved=False, deadline__lte=now - SWEEP_GRACE,
+                            room__finished=False, number=F("room__turn"))
+        # 入力なしのターンは放置とみなせるまで待つ
+        .exclude(p1_action="none", p2_action="none", deadline__gt=now - ABANDON_AFTER)
+        .order_by("deadline").values_list("room__code", flat=True)[:limit]
+    )
+
+
+async def run_once(now=None) -> int:
+    """1回分の掃除。担当ワーカーへ渡した部屋数を返す"""
+    now = now or timezone.now()
+    codes = await db_async(_due_sync)(now, SWEEP_BATCH)
+    by_owner: dict[str, list[str]] = {}
+    for code in codes:
+        by_owner.setdefault(cluster.owner(code), []).append(code)
+    for owner, batch in by_owner.items():
+        if owner == cluster.worker_id:
+            await sweep_rooms(batch, now)
+        else:
+            await cluster.send_to(owner, {"type": "room.sweep", "rooms": batch, "now": now.isoformat()})
+    return len(codes)
+
+
+async def sweep_rooms(codes: list[str], now=None):
+    """担当ワーカー側: メモリに無い部屋をまとめて読み、締切の来たターンをまとめて解決する"""
+    now = now or timezone.now()
+    states = await engine.preload([c for c in codes if cluster.is_local(c)])
+    # ここから先は await しない。部屋ロックの中でも await はしないので、
+    # ロックを取らずに一気に解決しても他の解決処理と交ざらない
+    acting = [s for s in states.values() if s.p1_action != "none" or s.p2_action != "none"]
+    for code, done in engine.resolve_many(acting).items():
+        metrics.turns_swept.inc()
+        announce_resolved(states[code], done)
+    for code, state in states.items():
+        if state.p1_action == "none" and state.p2_action == "none" and not state.finished:
+            if not scheduler.members(code) and state.deadline <= now - ABANDON_AFTER:
+                _abandon(state)
+        if not scheduler.members(code):
+            engine.release(code)
+
+
+def _abandon(state):
+    code = state.code
+    engine.abandon(state)
+    metrics.rooms_abandoned.inc()
+    publish_log(code, "Match abandoned.")
+    outbox.publish(code, {"type": "state_msg", "state": engine.snapshot(state)})
+
+
+async def _sweep_loop():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        if not cluster.is_leader():
+            continue
+        try:
+            await run_once()
+        except Exception:
+            logger.exception("turn sweep failed")
+
+
+async def _on_sweep(message):
+    await sweep_rooms(message["rooms"], datetime.fromisoformat(message["now"]))
+
+
+cluster.on("room.sweep", _on_sweep)
+cluster.add_loop(_sweep_loop)
@@ -1,3 +1,1322 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import random
+import re
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.routing import URLRouter
+from django.test import Client, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import metrics, pages, routing, strategy
+from .bot import bots
+from .consumers import owner_action, owner_join, owner_leave, resolve_and_broadcast, room_group_name
+from .drain import drainer
+from .engine import _flush_sync, engine
+from .models import Room, Turn
+from .matchmaking import matchmaker, pair_tickets
+from .outbox import outbox
+from .rooms import rooms
+from .scheduler import scheduler
+from .sendqueue import SEND_QUEUE_LOGS, SendQueue
+from .sharding import HashRing, cluster
+from .spectators import hub
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+application = URLRouter(routing.websocket_urlpatterns)
+
+
+class WsClient(ApplicationCommunicator):
+    """channels.testing は daphne 依存のため、asgiref だけで組んだ最小クライアント"""
+
+    def __init__(self, path: str, subprotocols=()):
+        super().__init__(application, {
+            "type": "websocket", "path": path, "headers": [], "subprotocols": list(subprotocols),
+        })
+        self._frames: list[dict] = []
+
+    async def connect(self):
+        await self.send_input({"type": "websocket.connect"})
+        msg = await self.receive_output(2)
+        assert msg["type"] == "websocket.accept", msg
+        return msg
+
+    async def send_json_to(self, data):
+        await self.send_input({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive_json_from(self, timeout: float = 2):
+        """1件ずつ返す（まとめ送りの batch はばらして順に返す）"""
+        if not self._frames:
+            msg = await self.receive_output(timeout)
+            if "bytes" in msg and msg["bytes"] is not None:
+                import msgpack
+                data = msgpack.unpackb(msg["bytes"])
+            else:
+                data = json.loads(msg["text"])
+            self._frames.extend(data["items"] if data.get("type") == "batch" else [data])
+        return self._frames.pop(0)
+
+    async def disconnect(self):
+        await self.send_input({"type": "websocket.disconnect", "code": 1000})
+        await self.wait(1)
+
+
+async def _connect(code: str):
+    comm = WsClient(f"/ws/arena/{code}/")
+    await comm.connect()
+    return comm
+
+
+async def _drain(comm, until_type: str, timeout: float = 2):
+    """until_type のメッセージが来るまで読み捨てる"""
+    while True:
+        msg = await comm.receive_json_from(timeout=timeout)
+        if msg.get("type") == until_type:
+            return msg
+
+
+def _reset():
+    engine.clear()
+    outbox.clear()
+    rooms.clear()
+    matchmaker.clear()
+    hub.clear()
+    drainer.clear()
+    bots.clear()
+    cluster.leaving = False
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class TurnSchedulingTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_both_actions_resolve_immediately(self):
+        async def scenario():
+            p1 = await _connect("100001")
+            await _drain(p1, "joined")
+            p2 = await _connect("100001")
+            await _drain(p2, "joined")
+
+            await p1.send_json_to({"type": "action", "action": "attack"})
+            await p2.send_json_to({"type": "action", "action": "guard"})
+            state = await _drain(p1, "state")
+            # ガードされたのでHPは変わらず、ターンだけが進む
+            self.assertEqual(state["delta"]["turn"], 2)
+            self.assertNotIn("you", state["delta"])
+            self.assertNotIn("op", state["delta"])
+            await p1.disconnect()
+            await p2.disconnect()
+            await engine.flush()
+
+        async_to_sync(scenario)()
+        self.assertTrue(Turn.objects.get(room__code="100001", number=1).resolved)
+
+    def test_deadline_timer_resolves_once_and_stops_when_empty(self):
+        room = Room.objects.create(code="100002", deadline=timezone.now() + timedelta(seconds=0.3))
+        Turn.objects.create(room=room, number=1, deadline=room.deadline)
+
+        async def scenario():
+            p1 = await _connect("100002")
+            await _drain(p1, "joined")
+            self.assertTrue(scheduler.is_armed("100002"))
+            state = await _drain(p1, "state")
+            self.assertEqual(state["delta"]["turn"], 2)
+            await p1.disconnect()
+            self.assertFalse(scheduler.is_armed("100002"))
+            await engine.flush()
+
+        async_to_sync(scenario)()
+        self.assertEqual(Turn.objects.filter(room__code="100002", resolved=True).count(), 1)
+
+
+class EngineWriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_resolved_turns_are_flushed_in_one_batch(self):
+        async def scenario():
+            state = await engine.acquire("200001")
+            engine.join(state, "a")
+            engine.join(state, "b")
+            for _ in range(2):
+                engine.set_action(state, "a", "attack")
+                engine.set_action(state, "b", "charge")
+                self.assertIsNotNone(engine.resolve(state))
+            engine.release("200001")
+            await engine.flush()
+            self.assertIsNone(engine.get("200001"))
+
+        async_to_sync(scenario)()
+        room = Room.objects.get(code="200001")
+        self.assertEqual((room.p1_hp, room.p2_hp, room.p2_tokens, room.turn), (40, 28, 2, 3))
+        self.assertEqual(
+            list(room.turns.values_list("number", "resolved", "p1_action", "p2_action")),
+            [(1, True, "attack", "charge"), (2, True, "attack", "charge"), (3, False, "none", "none")],
+        )
+        self.assertEqual(room.current_turn.number, 3)
+
+    def test_hot_paths_are_single_queries(self):
+        from .engine import _load_sync
+
+        room = Room.objects.create(code="200002", turn=2, p1_hp=30, deadline=timezone.now())
+        Turn.objects.create(room=room, number=1, deadline=room.deadline, resolved=True)
+        current = Turn.objects.create(room=room, number=2, deadline=room.deadline, p1_action="guard")
+        # 参照の無い古い行は最初の読み込みで付け替える
+        _load_sync("200002")
+        self.assertEqual(Room.objects.get(code="200002").current_turn_id, current.pk)
+
+        with self.assertNumQueries(1):
+            state = _load_sync("200002")
+        self.assertEqual((state.turn, state.p1_hp, state.p1_action), (2, 30, "guard"))
+
+        # 締切の来た未解決ターンの拾い出しは部分インデックスで引く
+        plan = Turn.objects.filter(resolved=False, deadline__lte=timezone.now()).order_by("deadline").explain()
+        self.assertIn("arena_turn_due_idx", plan)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class DeltaProtocolTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_deltas_and_resync(self):
+        async def scenario():
+            p1 = await _connect("300001")
+            first = await _drain(p1, "state")
+            self.assertNotIn("base", first)
+            self.assertEqual(first["you"], {"index": 1, "hp": 40, "tokens": 0})
+            p2 = await _connect("300001")
+            await _drain(p2, "joined")
+
+            await p1.send_json_to({"type": "action", "action": "charge"})
+            await p2.send_json_to({"type": "action", "action": "attack"})
+            delta = await _drain(p1, "state")
+            self.assertEqual(delta["base"], first["v"])
+            self.assertEqual(delta["delta"]["turn"], 2)
+            self.assertEqual(delta["delta"]["you"], {"hp": 34, "tokens": 1})
+            self.assertNotIn("op", delta["delta"])
+
+            # 最新版を持っていれば何も来ない / 古い版なら差分が来る
+            await p1.send_json_to({"type": "sync", "since": delta["v"]})
+            self.assertTrue(await p1.receive_nothing(0.1))
+            await p1.send_json_to({"type": "sync", "since": first["v"]})
+            again = await _drain(p1, "state")
+            self.assertEqual(again["delta"], delta["delta"])
+            await p1.disconnect()
+            await p2.disconnect()
+
+        async_to_sync(scenario)()
+
+
+class HashRingTests(TransactionTestCase):
+    def test_adding_a_worker_moves_only_its_share(self):
+        codes = [f"{i:06d}" for i in range(2000)]
+        before = HashRing(["w1", "w2", "w3"])
+        after = HashRing(["w1", "w2", "w3", "w4"])
+        moved = [c for c in codes if before.owner(c) != after.owner(c)]
+        # 移動するのは新ワーカーへの分だけ（おおよそ 1/4）
+        self.assertTrue(all(after.owner(c) == "w4" for c in moved))
+        self.assertLess(len(moved), len(codes) // 3)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ShardingTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_non_owner_forwards_to_owner_inbox(self):
+        code = next(f"{i:06d}" for i in range(400000, 401000)
+                    if HashRing([cluster.worker_id, "other"]).owner(f"{i:06d}") == "other")
+        forwarded = []
+
+        async def other_worker():
+            # 同じプロセス内で「別ワーカー」の inbox を処理する
+            layer = get_channel_layer()
+            while True:
+                message = await layer.receive(cluster.inbox_of("other"))
+                forwarded.append(message["type"])
+                await cluster._handlers[message["type"]](message)
+
+        async def scenario():
+            await cluster.registry.heartbeat("other")
+            await cluster.refresh()
+            worker = asyncio.ensure_future(other_worker())
+            try:
+                self.assertFalse(cluster.is_local(code))
+                p1 = await _connect(code)
+                first = await _drain(p1, "state")
+                self.assertEqual(first["you"]["index"], 1)
+                p2 = await _connect(code)
+                await _drain(p2, "joined")
+                await p1.send_json_to({"type": "action", "action": "attack"})
+                await p2.send_json_to({"type": "action", "action": "charge"})
+                delta = await _drain(p2, "state")
+                self.assertEqual(delta["delta"]["you"], {"hp": 34, "tokens": 1})
+                await p1.disconnect()
+                await p2.disconnect()
+            finally:
+                worker.cancel()
+                await cluster.registry.remove("other")
+                await cluster.refresh()
+
+        async_to_sync(scenario)()
+        self.assertEqual(forwarded.count("room.join"), 2)
+        self.assertEqual(forwarded.count("room.action"), 2)
+        self.assertEqual(forwarded.count("room.leave"), 2)
+
+    def test_sockets_of_a_vanished_worker_stop_counting(self):
+        from .consumers import _on_room_join
+
+        code = next(f"{i:06d}" for i in range(401000, 402000)
+                    if HashRing([cluster.worker_id, "other"]).owner(f"{i:06d}") == cluster.worker_id)
+
+        async def scenario():
+            await cluster.registry.heartbeat("other")
+            await cluster.refresh()
+            layer = get_channel_layer()
+            try:
+                # 「別ワーカー」のソケット2つがこのワーカー担当の部屋に入る
+                for pid in ("a", "b"):
+                    reply = await layer.new_channel()
+                    await _on_room_join({"room": code, "pid": pid, "reply": reply, "worker": "other"})
+                    self.assertEqual((await layer.receive(reply))["type"], "room.joined")
+                self.assertEqual(scheduler.members(code), 2)
+                self.assertTrue(scheduler.is_armed(code))
+            finally:
+                # leave を送らずに落ちる
+                await cluster.registry.remove("other")
+                await cluster.refresh()
+            await engine.flush()
+            return scheduler.members(code), scheduler.is_armed(code), engine.get(code)
+
+        # 締切タイマーは止まり、部屋は書き出されてメモリから外れる
+        self.assertEqual(async_to_sync(scenario)(), (0, False, None))
+        self.assertEqual(Room.objects.get(code=code).turn, 1)
+
+
+class SlowChannelLayer(InMemoryChannelLayer):
+    """Redis 相当の遅延を入れて、配信待ちの間に他の処理が割り込めるようにする"""
+
+    async def group_send(self, group, message):
+        await asyncio.sleep(random.random() * 0.002)
+        await super().group_send(group, message)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {
+    "BACKEND": "arena.tests.SlowChannelLayer", "CONFIG": {"capacity": 100000},
+}})
+class AtomicResolutionTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_concurrent_actions_resolve_each_turn_exactly_once(self):
+        code = "500001"
+        resolved = []
+
+        async def scenario():
+            layer = get_channel_layer()
+            probe = await layer.new_channel()
+            await layer.group_add(room_group_name(code), probe)
+            await owner_join(code, "a")
+            await owner_join(code, "b")
+
+            async def storm():
+                await asyncio.gather(
+                    *[owner_action(code, pid, random.choice(["guard", "charge"]))
+                      for pid in ("a", "b") for _ in range(4)],
+                    resolve_and_broadcast(code),
+                    asyncio.sleep(random.random() * 0.02),
+                )
+
+            # 1) 締切前: 両者入力による解決だけが同時に走る
+            for _ in range(20):
+                await storm()
+            by_input = engine.get(code).turn
+            # 2) 締切タイマーも同時に発火する
+            with mock.patch("arena.engine.TURN_SECONDS", 0.01):
+                for _ in range(20):
+                    await storm()
+            scheduler.forget(code)
+            await outbox.drain()
+
+            while True:
+                try:
+                    msg = await asyncio.wait_for(layer.receive(probe), 0.05)
+                except asyncio.TimeoutError:
+                    break
+                for ev in msg["events"]:
+                    m = re.match(r"Turn (\d+) resolved", ev.get("text", ""))
+                    if m:
+                        resolved.append(int(m.group(1)))
+            await engine.flush()
+            return by_input, engine.get(code).turn
+
+        by_input, current = async_to_sync(scenario)()
+        # 1..current-1 がちょうど1回ずつ、順番どおりに解決されている
+        self.assertEqual(resolved, list(range(1, current)))
+        room = Room.objects.get(code=code)
+        self.assertEqual(room.turn, current)
+        self.assertEqual(room.turns.filter(resolved=True).count(), current - 1)
+        self.assertFalse(room.turns.get(number=current).resolved)
+        # 締切前に解決されたターンはどちらの入力も失われていない
+        early = room.turns.filter(number__lt=by_input)
+        self.assertEqual(early.count(), by_input - 1)
+        self.assertFalse(early.filter(p1_action="none").exists() or early.filter(p2_action="none").exists())
+
+    def test_stale_flush_never_overwrites(self):
+        room = Room.objects.create(code="500002", version=5, p1_hp=10)
+        Turn.objects.create(room=room, number=1, deadline=room.deadline, resolved=True, p1_action="attack")
+
+        row = {"pk": room.pk, "code": room.code, "p1_id": None, "p2_id": None, "p1_hp": 40, "p2_hp": 40,
+               "p1_tokens": 0, "p2_tokens": 0, "turn": 1, "deadline": room.deadline, "version": 3,
+               "finished": False, "winner": None}
+        turn = {"room_id": room.pk, "number": 1, "deadline": room.deadline,
+                "resolved": False, "p1_action": "guard", "p2_action": "none"}
+        _flush_sync([row], [turn])
+
+        room.refresh_from_db()
+        self.assertEqual((room.version, room.p1_hp), (5, 10))
+        t = room.turns.get(number=1)
+        self.assertEqual((t.resolved, t.p1_action), (True, "attack"))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class LoadHarnessTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    @mock.patch("arena.engine.FLUSH_INTERVAL", 60)     # 途中のフラッシュを挟まない
+    def test_small_run_reports_metrics(self):
+        from .loadtest import LoadClient, run
+
+        # ランダムな行動だと対戦の長さが毎回変わるので、ガード4回に攻撃1回で打ち合わせる
+        # （40 / 6 で7回当たって決着 = 35 ターン / 対戦）。待ち時間なしで打つのでレート制限は外す
+        def pick(client):
+            client.plan = getattr(client, "plan", 0) + 1
+            return "attack" if client.plan % 5 == 0 else "guard"
+
+        with mock.patch.object(LoadClient, "pick", pick), \
+                mock.patch("arena.throttle.TokenBucket.allow", return_value=True):
+            result = async_to_sync(run)(matches=3, concurrency=3)
+        self.assertEqual((result["matches_finished"], result["errors"]), (3, 0))
+        self.assertEqual(result["turns"], 3 * 35)
+        self.assertGreater(result["latency_ms"]["p99"], 0)
+        # DBは部屋ごとの読み込みと最後のフラッシュ（とスイーパの確認）だけで、ターン数に比例しない。
+        # エンジン側のクエリ計測と重なっても数え漏れない
+        self.assertGreater(result["db_queries"], 0)
+        self.assertLessEqual(result["db_queries"], 15 * 3)
+        self.assertLess(result["db_queries_per_turn"], 0.5)
+        self.assertFalse(Room.objects.exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class WireFormatTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_msgpack_subprotocol(self):
+        import msgpack
+
+        from .wire import ACTION_CODES, MSGPACK_SUBPROTOCOL
+
+        async def scenario():
+            p1 = WsClient("/ws/arena/600001/", [MSGPACK_SUBPROTOCOL, "arena.json.v1"])
+            accepted = await p1.connect()
+            self.assertEqual(accepted["subprotocol"], MSGPACK_SUBPROTOCOL)
+            first = await _drain(p1, "state")
+            self.assertIsInstance(first["deadline"], int)
+
+            # JSON のクライアントと同じ部屋で対戦できる
+            p2 = await _connect("600001")
+            await _drain(p2, "joined")
+            await p1.send_input({"type": "websocket.receive", "bytes": msgpack.packb(
+                {"type": "action", "action": ACTION_CODES["charge"]})})
+            await p2.send_json_to({"type": "action", "action": "attack"})
+            delta = await _drain(p1, "state")
+            self.assertEqual(delta["delta"]["you"], {"hp": 34, "tokens": 1})
+            self.assertIsInstance(delta["delta"]["deadline"], int)
+            await p1.disconnect()
+            await p2.disconnect()
+
+        async_to_sync(scenario)()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class CoalescingTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_window_sends_one_batch_with_latest_state(self):
+        from .outbox import _collapse
+
+        events = [{"type": "log_msg", "text": "a"}, {"type": "state_msg", "v": 1},
+                  {"type": "log_msg", "text": "b"}, {"type": "state_msg", "v": 2}]
+        self.assertEqual(_collapse(events), [events[0], events[2], events[3]])
+
+        async def scenario():
+            layer = get_channel_layer()
+            probe = await layer.new_channel()
+            await layer.group_add(room_group_name("700001"), probe)
+            await owner_join("700001", "a")
+            await owner_join("700001", "b")
+            await owner_action("700001", "a", "attack")
+            await owner_action("700001", "b", "guard")
+            await outbox.drain()
+            msg = await asyncio.wait_for(layer.receive(probe), 1)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(probe), 0.05)
+            scheduler.forget("700001")
+            return msg
+
+        msg = async_to_sync(scenario)()
+        self.assertEqual(msg["type"], "room_batch")
+        self.assertEqual([ev["type"] for ev in msg["events"]].count("state_msg"), 1)
+        self.assertIn("Turn 1 resolved: P1=attack / P2=guard", [ev.get("text") for ev in msg["events"]])
+
+    def test_inbound_flood_is_dropped(self):
+        async def scenario():
+            p1 = await _connect("700002")
+            await _drain(p1, "joined")
+            for _ in range(40):
+                await p1.send_json_to({"type": "sync"})
+            error = await _drain(p1, "error")
+            await p1.disconnect()
+            return error
+
+        self.assertEqual(async_to_sync(scenario)()["reason"], "rate_limited")
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class RoomRegistryTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_concurrent_allocations_are_unique(self):
+        async def scenario():
+            return await asyncio.gather(*[rooms.allocate() for _ in range(2000)])
+
+        codes = async_to_sync(scenario)()
+        self.assertEqual(len(set(codes)), 2000)
+        self.assertTrue(all(len(c) == 6 and c.isdigit() for c in codes))
+        self.assertEqual(async_to_sync(rooms.live_count)(), 2000)
+
+    def test_allocate_skips_codes_that_still_have_rows(self):
+        old = Room.objects.create(code="111111", p1_id="a", p2_id="b")
+        Turn.objects.create(room=old, number=1, deadline=timezone.now())
+        codes = iter(["111111", "222222"])
+        with mock.patch("arena.rooms._random_code", lambda: next(codes)):
+            self.assertEqual(async_to_sync(rooms.allocate)(), "222222")
+        self.assertFalse(async_to_sync(rooms.exists)("111111"))
+        self.assertTrue(Turn.objects.filter(room__code="111111").exists())
+
+    def test_flush_never_deletes_existing_rows(self):
+        from .engine import _insert_rooms_sync
+
+        old = Room.objects.create(code="111111", p1_id="a", p2_id="b")
+        Turn.objects.create(room=old, number=1, deadline=timezone.now())
+        pks = _insert_rooms_sync(["111111", "222222"])
+        self.assertEqual(set(pks), {"222222"})
+        self.assertEqual(Room.objects.get(code="111111").pk, old.pk)
+        self.assertEqual(old.turns.count(), 1)
+
+    def test_lobby_joins_room_known_only_to_database(self):
+        Room.objects.create(code="333333")
+        self.assertFalse(async_to_sync(rooms.exists)("333333"))
+        self.assertEqual(self.client.post("/", {"code": "333333"}).status_code, 302)
+
+    def test_create_and_join_without_writing_room_table(self):
+        from .loadtest import QueryCounter
+
+        res = self.client.post("/", {"create": "1"})
+        code = res.url.rstrip("/").rsplit("/", 1)[-1]
+        self.assertFalse(Room.objects.filter(code=code).exists())
+        self.assertEqual(self.client.post("/", {"code": code}).status_code, 302)
+        self.assertEqual(self.client.post("/", {"code": "999999"}).status_code, 200)
+
+        counter = QueryCounter()
+
+        async def scenario():
+            counter.install()
+            try:
+                p1 = await _connect(code)
+                await _drain(p1, "joined")
+                p2 = await _connect(code)
+                await _drain(p2, "joined")
+                queries = counter.count
+                await p1.disconnect()
+                await p2.disconnect()
+            finally:
+                counter.uninstall()
+            await engine.flush()
+            return queries
+
+        # 接続・着席までDBは使わない（Room 行は最初のフラッシュで作られる）
+        self.assertEqual(async_to_sync(scenario)(), 0)
+        room = Room.objects.get(code=code)
+        self.assertTrue(room.p1_id and room.p2_id)
+        self.assertTrue(room.turns.filter(number=1).exists())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class MatchmakingTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_pairs_close_ratings_and_widens_with_wait(self):
+        def t(i, rating, since):
+            return {"id": str(i), "rating": rating, "since": since}
+
+        now = 1000.0
+        pairs, rest = pair_tickets([t(1, 1500, now), t(2, 1900, now), t(3, 1550, now)], now)
+        self.assertEqual([(a["id"], b["id"]) for a, b in pairs], [("1", "3")])
+        self.assertEqual([r["id"] for r in rest], ["2"])
+        # 待つほど許容幅が広がり、上限を過ぎれば誰とでも組む
+        pairs, _ = pair_tickets([t(1, 1500, now - 5), t(2, 1800, now)], now)
+        self.assertEqual(len(pairs), 1)
+        pairs, _ = pair_tickets([t(1, 0, now - 60), t(2, 3000, now)], now)
+        self.assertEqual(len(pairs), 1)
+
+    def test_queue_sockets_are_paired_into_one_room(self):
+        async def scenario():
+            a = WsClient("/ws/arena/queue/")
+            b = WsClient("/ws/arena/queue/")
+            c = WsClient("/ws/arena/queue/")
+            for comm in (a, b, c):
+                await comm.connect()
+            await a.send_json_to({"type": "enqueue", "rating": 1500})
+            await b.send_json_to({"type": "enqueue", "rating": 1520})
+            await c.send_json_to({"type": "enqueue", "rating": 1500, "region": "eu"})
+            for comm in (a, b, c):
+                self.assertEqual((await comm.receive_json_from())["type"], "queued")
+            ma = await a.receive_json_from()
+            mb = await b.receive_json_from()
+            self.assertEqual(ma["type"], "matched")
+            self.assertEqual(ma["room"], mb["room"])
+            self.assertTrue(await rooms.exists(ma["room"]))
+            # 別地域の1人は残り、切断で待ち行列から外れる
+            self.assertEqual(matchmaker.metrics()["queue_depth_by_region"], {"eu": 1})
+            await c.disconnect()
+            self.assertEqual(matchmaker.depth(), 0)
+
+        before = metrics.time_to_match_seconds.count
+        async_to_sync(scenario)()
+        m = matchmaker.metrics()
+        self.assertEqual((m["enqueued_total"], m["matched_total"]), (3, 2))
+        self.assertEqual(metrics.time_to_match_seconds.count - before, 2)
+        text = metrics.registry.render()
+        self.assertIn("# TYPE arena_matchmaking_queue_depth gauge", text)
+        self.assertIn('arena_matchmaking_queue_depth{region="eu"} 0', text)
+        self.assertIn("# TYPE arena_time_to_match_seconds histogram", text)
+
+    def test_large_batch_matches_in_one_round(self):
+        async def scenario():
+            layer = get_channel_layer()
+            replies = [await layer.new_channel() for _ in range(2000)]
+            now = time.time()
+            for reply in replies:
+                matchmaker.enqueue({"id": reply, "reply": reply, "rating": random.randint(1400, 1600),
+                                    "region": "any", "since": now})
+            started = time.perf_counter()
+            await matchmaker.run_once()
+            return time.perf_counter() - started
+
+        elapsed = async_to_sync(scenario)()
+        self.assertEqual(matchmaker.metrics()["matched_total"], 2000)
+        self.assertLess(elapsed, 2.0)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class SpectatorTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    @mock.patch("arena.outbox.SPECTATOR_WINDOW", 0.01)
+    def test_watchers_share_one_group_member_and_skip_player_path(self):
+        from .loadtest import QueryCounter
+        from .outbox import watch_group_name
+
+        code = "800001"
+        counter = QueryCounter()
+
+        async def scenario():
+            p1 = await _connect(code)
+            await _drain(p1, "joined")
+            p2 = await _connect(code)
+            await _drain(p2, "joined")
+            # 満室での3人目は観戦に切り替わる
+            full = await _connect(code)
+            self.assertTrue((await _drain(full, "joined"))["spectator"])
+
+            counter.install()
+            watchers = [WsClient(f"/ws/arena/{code}/", ()) for _ in range(50)]
+            for w in watchers:
+                w.scope["query_string"] = b"watch=1"
+                await w.connect()
+                await _drain(w, "joined")
+            # 観戦者は締切タイマーの接続数に入らず、観戦グループの中身はワーカーの inbox 1つだけ
+            self.assertEqual(scheduler.members(code), 2)
+            self.assertEqual(len(get_channel_layer().groups[watch_group_name(code)]), 1)
+
+            await p1.send_json_to({"type": "action", "action": "attack"})
+            await p2.send_json_to({"type": "action", "action": "charge"})
+            for w in watchers + [full]:
+                turn = 1
+                while turn < 2:
+                    state = await _drain(w, "state")
+                    turn = state.get("delta", state).get("turn", turn)
+                self.assertEqual(turn, 2)
+            queries = counter.count
+            counter.uninstall()
+            for comm in watchers + [full, p1, p2]:
+                await comm.disconnect()
+            self.assertEqual(outbox.watched, {})
+            return queries
+
+        self.assertEqual(async_to_sync(scenario)(), 0)
+
+
+class _Session(dict):
+    def save(self):
+        pass
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ResumeTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def _client(self, code: str, pid: str, query: str = ""):
+        comm = WsClient(f"/ws/arena/{code}/")
+        comm.scope["session"] = _Session(pid=pid)
+        comm.scope["query_string"] = query.encode()
+        return comm
+
+    def test_reconnect_restores_seat_and_replays_missed_logs(self):
+        code = "900001"
+
+        async def scenario():
+            a = self._client(code, "alice")
+            await a.connect()
+            state = await _drain(a, "state")
+            b = self._client(code, "bob")
+            await b.connect()
+            await _drain(b, "joined")
+            await a.disconnect()
+
+            await b.send_json_to({"type": "action", "action": "guard"})
+            await _drain(b, "log")
+
+            a2 = self._client(code, "alice", f"since={state['v']}")
+            await a2.connect()
+            frame = json.loads((await a2.receive_output(2))["text"])
+            # 取りこぼしたログと再開の合図が1フレームで届き、席はそのまま
+            self.assertEqual(frame["type"], "batch")
+            logs = [i["text"] for i in frame["items"] if i["type"] == "log"]
+            self.assertEqual(logs, ["Player2 joined.", "Action received."])
+            self.assertEqual(frame["items"][-1], {"type": "joined", "room": code, "resumed": True})
+            self.assertEqual(engine.get(code).seat_of("alice"), 1)
+            self.assertEqual(state["you"]["index"], 1)
+            # 相手には「入室」の告知が出ない
+            await outbox.drain()
+            self.assertTrue(await b.receive_nothing(0.1))
+            self.assertEqual(scheduler.members(code), 2)
+            await a2.disconnect()
+            await b.disconnect()
+            self.assertFalse(scheduler.is_armed(code))
+
+        async_to_sync(scenario)()
+
+    def test_leave_racing_a_slow_join_does_not_leak_the_timer(self):
+        code = "900002"
+
+        async def scenario():
+            real_acquire = engine.acquire
+
+            async def slow_acquire(room_code):
+                await asyncio.sleep(0.05)
+                return await real_acquire(room_code)
+
+            with mock.patch.object(engine, "acquire", slow_acquire):
+                join = asyncio.ensure_future(owner_join(code, "a"))
+                await asyncio.sleep(0)
+                owner_leave(code)
+                await join
+            return scheduler.members(code), scheduler.is_armed(code)
+
+        self.assertEqual(async_to_sync(scenario)(), (0, False))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class MetricsTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_endpoint_reports_hot_path_metrics(self):
+        before = metrics.turns_resolved.value
+        passthrough = []
+
+        async def django_app(scope, receive, send):
+            passthrough.append(scope["path"])
+            await send({"type": "http.response.start", "status": 204, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+
+        async def get(path):
+            comm = ApplicationCommunicator(metrics.MetricsEndpoint(django_app), {
+                "type": "http", "method": "GET", "path": path, "headers": [], "query_string": b"",
+            })
+            await comm.send_input({"type": "http.request", "body": b""})
+            start = await comm.receive_output(2)
+            body = await comm.receive_output(2)
+            return start["status"], body["body"].decode()
+
+        async def scenario():
+            p1 = await _connect("910001")
+            await _drain(p1, "joined")
+            p2 = await _connect("910001")
+            await _drain(p2, "joined")
+            await p1.send_json_to({"type": "action", "action": "attack"})
+            await p2.send_json_to({"type": "action", "action": "guard"})
+            await _drain(p1, "state")
+            scraped = await get("/metrics")
+            await p1.disconnect()
+            await p2.disconnect()
+            return scraped, await get("/")
+
+        (status, text), (other, _) = async_to_sync(scenario)()
+        self.assertEqual((status, other, passthrough), (200, 204, ["/"]))
+        self.assertEqual(metrics.turns_resolved.value, before + 1)
+        self.assertIn("# TYPE arena_action_to_state_seconds histogram", text)
+        self.assertIn('arena_connect_seconds_bucket{le="+Inf"}', text)
+        self.assertIn("arena_active_sockets 2", text)
+        self.assertIn("arena_active_rooms 1", text)
+        self.assertIn("arena_db_pool_queue_depth 0", text)
+        self.assertIn('arena_db_queries_total{op="load"}', text)
+
+
+class ArchiveTests(TransactionTestCase):
+    def test_finished_matches_move_to_archive_and_replay(self):
+        import gzip
+        import tempfile
+
+        from .archive import archive_finished
+        from .models import ArchivedMatch
+
+        old = timezone.now() - timedelta(hours=1)
+        for i in range(3):
+            room = Room.objects.create(code=f"95000{i}", finished=True, winner=1, turn=3, deadline=old)
+            for n in (1, 2, 3):
+                Turn.objects.create(room=room, number=n, deadline=old, resolved=True,
+                                    p1_action="attack", p2_action="guard" if n < 3 else "none")
+        Room.objects.create(code="950010", finished=True, deadline=timezone.now())  # 決着直後
+        Room.objects.create(code="950011", deadline=old)                             # 対戦中
+
+        with tempfile.TemporaryDirectory() as tmp:
+            stats = archive_finished(batch_size=2, directory=tmp)
+            self.assertEqual((stats["matches"], stats["turns"]), (3, 9))
+            self.assertEqual(sorted(Room.objects.values_list("code", flat=True)), ["950010", "950011"])
+            self.assertFalse(Turn.objects.filter(room__code__startswith="95000").exists())
+
+            # セグメントはそのまま .jsonl.gz として読める
+            with gzip.open(stats["segment"], "rt") as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual([m["code"] for m in lines], ["950000", "950001", "950002"])
+            self.assertEqual(ArchivedMatch.objects.count(), 3)
+
+            with mock.patch("arena.archive.ARCHIVE_DIR", tmp):
+                res = self.client.get("/api/matches/950001/")
+                self.assertEqual(res.status_code, 200)
+                match = res.json()
+                self.assertEqual(match["room"]["winner"], 1)
+                self.assertEqual(match["turns"][2][:3], [3, "attack", "none"])
+                self.assertEqual(self.client.get("/api/matches/950011/").status_code, 404)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class SweeperTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def _room(self, code, ago, p1_action="none"):
+        deadline = timezone.now() - ago
+        room = Room.objects.create(code=code, p1_id="a", p2_id="b", deadline=deadline)
+        room.current_turn = Turn.objects.create(room=room, number=1, deadline=deadline, p1_action=p1_action)
+        room.save(update_fields=["current_turn"])
+
+    def test_overdue_turns_resolve_without_sockets(self):
+        from . import sweeper
+        from .engine import _load_many_sync
+
+        self._room("960001", timedelta(minutes=1), p1_action="attack")   # 片方だけ入力して離脱
+        self._room("960002", timedelta(minutes=10))                      # 放置
+        self._room("960003", timedelta(minutes=1))                       # 入力なし・まだ待つ
+        self._room("960004", timedelta(minutes=1), p1_action="attack")   # 接続中（タイマーの担当）
+
+        with self.assertNumQueries(1):
+            due = sweeper._due_sync(timezone.now(), 100)
+        self.assertEqual(sorted(due), ["960001", "960002", "960004"])
+        with self.assertNumQueries(1):
+            self.assertEqual(len(_load_many_sync(due)), 3)
+
+        async def scenario():
+            await engine.acquire("960004")
+            scheduler.attach("960004")
+            self.assertEqual(await sweeper.run_once(), 3)
+            await engine.flush()
+            # 書き出した部屋はメモリから外れる
+            self.assertIsNone(engine.get("960001"))
+            scheduler.detach("960004")
+
+        async_to_sync(scenario)()
+        rows = {r.code: r for r in Room.objects.select_related("current_turn")}
+        self.assertEqual((rows["960001"].turn, rows["960001"].p2_hp), (2, 34))
+        self.assertEqual(rows["960001"].current_turn.number, 2)
+        self.assertEqual((rows["960002"].finished, rows["960002"].winner), (True, None))
+        self.assertTrue(Turn.objects.get(room__code="960002", number=1).resolved)
+        self.assertEqual(rows["960003"].turn, 1)
+        self.assertEqual(rows["960004"].turn, 1)
+
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    @mock.patch("arena.sweeper.SWEEP_INTERVAL", 0.05)
+    def test_worker_startup_sweeps_without_sockets(self):
+        from rtbattle.asgi import application
+
+        from .db import db_async
+
+        self._room("960011", timedelta(minutes=1), p1_action="attack")
+
+        def turn():
+            return Room.objects.get(code="960011").turn
+
+        async def scenario():
+            # ソケットは開かず、サーバの起動（lifespan）だけ
+            lifespan = ApplicationCommunicator(application, {"type": "lifespan"})
+            await lifespan.send_input({"type": "lifespan.startup"})
+            self.assertEqual((await lifespan.receive_output(1))["type"], "lifespan.startup.complete")
+            for _ in range(100):
+                await asyncio.sleep(0.05)
+                await engine.flush()
+                if await db_async(turn)() == 2:
+                    break
+            await lifespan.send_input({"type": "lifespan.shutdown"})
+            self.assertEqual((await lifespan.receive_output(1))["type"], "lifespan.shutdown.complete")
+
+        async_to_sync(scenario)()
+        self.assertEqual(turn(), 2)
+
+
+class RulesTests(TransactionTestCase):
+    CASES = [("attack", "guard"), ("charge", "attack"), ("charged_attack", "none"), ("attack", "attack")]
+
+    def test_resolve_is_pure_and_batch_matches(self):
+        from . import rules
+
+        start = rules.Fighters(p1_tokens=1)
+        after = rules.resolve(start, "charged_attack", "guard")
+        self.assertEqual(after, rules.Fighters(40, 40, 0, 0))
+        self.assertEqual(start.p1_tokens, 1)
+        self.assertEqual(rules.resolve(rules.Fighters(p2_hp=6), "attack", "charge"),
+                         rules.Fighters(40, 0, 0, 1, True, 1))
+        self.assertEqual(rules.resolve(rules.Fighters(6, 6), "attack", "attack"),
+                         rules.Fighters(0, 0, 0, 0, True, None))
+
+        batch = [rules.Fighters(p1_tokens=1, p2_hp=15)] * len(self.CASES)
+        a1, a2 = zip(*self.CASES)
+        self.assertEqual(rules.resolve_batch(batch, list(a1), list(a2)),
+                         [rules.resolve(f, x, y) for f, x, y in zip(batch, a1, a2)])
+
+    def test_numpy_path_matches_resolve(self):
+        try:
+            import numpy as np
+        except ImportError:
+            self.skipTest("numpy not installed")
+        import itertools
+
+        from . import rules
+
+        # トークン 0（空撃ちのチャージ攻撃）/ 1 / 2、HP はダメージちょうど・それ未満（0 で止まる）・
+        # 1 つ上・満タン。両者が同時に倒れる（相打ち）組み合わせも含む
+        hps = [1, 6, 7, 14, 15, 16, rules.START_HP]
+        states = [rules.Fighters(h1, h2, t1, t2) for h1, h2 in itertools.product(hps, hps)
+                  for t1, t2 in itertools.product(range(3), range(3))]
+        pairs = list(itertools.product(rules.ACTION_CODES, rules.ACTION_CODES))
+        fighters = [f for f in states for _ in pairs]
+        a1 = [x for _ in states for x, _ in pairs]
+        a2 = [y for _ in states for _, y in pairs]
+
+        expected = [rules.resolve(f, x, y) for f, x, y in zip(fighters, a1, a2)]
+        self.assertEqual(rules.resolve_batch(fighters, a1, a2), expected)
+        self.assertTrue(any(f.finished and f.winner is None for f in expected))
+
+        # ダメージ値を差し替えても同じ
+        cols = np.array([f[:4] for f in fighters], dtype=np.int64).T
+        codes1 = np.array([rules.ACTION_CODES[a] for a in a1])
+        codes2 = np.array([rules.ACTION_CODES[a] for a in a2])
+        for dmg in ((rules.DMG_ATTACK, rules.DMG_CHARGED), (7, 16), (40, 1)):
+            got = rules.resolve_arrays(*cols, codes1, codes2, *dmg)
+            want = [rules.resolve(f, x, y, *dmg) for f, x, y in zip(fighters, a1, a2)]
+            self.assertEqual([
+                rules.Fighters(int(h1), int(h2), int(t1), int(t2), bool(fin), int(w) or None)
+                for h1, h2, t1, t2, fin, w in zip(*got)
+            ], want)
+
+    def test_simulation(self):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            self.skipTest("numpy not installed")
+        from . import rules
+
+        stats = rules.simulate(2000, seed=1)
+        self.assertEqual(stats["p1_wins"] + stats["p2_wins"] + stats["draws"] + stats["unfinished"], 2000)
+        self.assertLess(abs(stats["p1_wins"] - stats["p2_wins"]), 200)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class SignedIdentityTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def test_room_page_token_identifies_socket_without_session(self):
+        from . import identity
+
+        with mock.patch("arena.identity.SIGNED_IDENTITY", True):
+            token = self.client.get("/room/970001/").context["player_token"]
+            # 同じブラウザには同じID（Cookie）で発行し直す
+            again = self.client.get("/room/970001/").context["player_token"]
+            pid = identity.verify(token)
+            self.assertEqual(identity.verify(again), pid)
+            self.assertIsNone(identity.verify(token + "x"))
+
+            async def scenario():
+                comm = WsClient("/ws/arena/970001/")
+                comm.scope["query_string"] = f"token={token}".encode()
+                await comm.connect()
+                await _drain(comm, "joined")
+                self.assertEqual(engine.get("970001").p1_id, pid)
+                await comm.disconnect()
+
+            async_to_sync(scenario)()
+
+
+class _FakeRedis:
+    """HybridChannelLayer のテスト用: グループの sorted set・書き込み・受信キューだけを覚える"""
+
+    def __init__(self):
+        self.groups: dict[bytes, set[str]] = {}
+        self.evals: list[tuple] = []
+        self.queued: dict[str, list[bytes]] = {}
+
+    async def zadd(self, key, mapping):
+        self.groups.setdefault(key, set()).update(mapping)
+
+    async def zrem(self, key, member):
+        self.groups.get(key, set()).discard(member)
+
+    async def expire(self, key, seconds):
+        pass
+
+    async def eval(self, script, numkeys, *args):
+        # キーの無いもの（受信前のバックアップの掃除）は数えない
+        if numkeys:
+            self.evals.append(args[:numkeys])
+        return 0
+
+    async def bzpopmin(self, key, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.queued.get(key):
+            if time.monotonic() >= deadline:
+                return None
+            await asyncio.sleep(0.005)
+        return key, self.queued[key].pop(0), time.time()
+
+    async def zpopmin(self, key):
+        pass
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, redis):
+        self.redis, self.results = redis, []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def zremrangebyscore(self, key, min, max):
+        self.results.append(0)
+
+    def zrange(self, key, start, end):
+        self.results.append([c.encode() for c in sorted(self.redis.groups.get(key, ()))])
+
+    async def execute(self):
+        results, self.results = self.results, []
+        return results
+
+
+class HybridLayerTests(TransactionTestCase):
+    def test_local_members_skip_redis_and_remote_ones_do_not(self):
+        from .layers import HybridChannelLayer
+
+        async def scenario():
+            layer = HybridChannelLayer(hosts=["redis://unused:6379/0"])
+            fake = _FakeRedis()
+            layer.connection = lambda index: fake
+            a, b = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add("arena_980001", a)
+            await layer.group_add("arena_980001", b)
+
+            await layer.group_send("arena_980001", {"type": "room_batch", "events": []})
+            self.assertEqual((await layer.receive(a))["type"], "room_batch")
+            self.assertEqual((await layer.receive(b))["type"], "room_batch")
+            self.assertEqual(fake.evals, [])
+
+            # 他ワーカーのチャンネルが加わると、その分だけ Redis に書く
+            await layer.group_add("arena_980001", "specific.otherworker!abc")
+            await layer.group_discard("arena_980001", b)
+            await layer.group_send("arena_980001", {"type": "room_batch", "events": []})
+            self.assertEqual(len(fake.evals), 1)
+            self.assertEqual((await layer.receive(a))["type"], "room_batch")
+            self.assertTrue(layer.receive_buffer[b].empty())
+
+        async_to_sync(scenario)()
+
+    def test_pending_receives_wake_on_local_and_redis_messages(self):
+        from .layers import HybridChannelLayer
+
+        async def scenario():
+            layer = HybridChannelLayer(hosts=["redis://unused:6379/0"])
+            layer.brpop_timeout = 0.05
+            fake = _FakeRedis()
+            layer.connection = lambda index: fake
+            a, b = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add("arena_980002", a)
+            await layer.group_add("arena_980002", b)
+
+            # 2つの receive が同時に待っている（Redis の BRPOP も待っている）ところへ手元から届ける
+            pending = [asyncio.ensure_future(layer.receive(c)) for c in (a, b)]
+            await asyncio.sleep(0.1)
+            await layer.group_send("arena_980002", {"type": "room_batch", "events": []})
+            got = await asyncio.wait_for(asyncio.gather(*pending), 1)
+            self.assertEqual([m["type"] for m in got], ["room_batch", "room_batch"])
+
+            # 他ワーカーから Redis 経由で来たものも、待っている receive に届く
+            pending = asyncio.ensure_future(layer.receive(b))
+            key = layer.prefix + layer.non_local_name(b)
+            fake.queued.setdefault(key, []).append(layer.serialize({"type": "remote", "__asgi_channel__": b}))
+            self.assertEqual((await asyncio.wait_for(pending, 1))["type"], "remote")
+
+            # 待っている receive が無くなれば Redis の受信も止まる
+            await asyncio.wait_for(asyncio.gather(*layer._pulls.values()), 1)
+            await layer.wait_received()
+
+        async_to_sync(scenario)()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class DrainTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def tearDown(self):
+        _reset()
+
+    def test_drain_flushes_rooms_and_sends_jittered_reconnects(self):
+        async def scenario():
+            p1 = await _connect("990001")
+            await _drain(p1, "joined")
+            p2 = await _connect("990001")
+            await _drain(p2, "joined")
+            await p1.send_json_to({"type": "action", "action": "charge"})
+            await _drain(p1, "log")
+
+            async def closed(comm):
+                hint = await _drain(comm, "reconnect")
+                self.assertTrue(250 <= hint["after_ms"] <= 5000)
+                while True:
+                    msg = await comm.receive_output(1)
+                    if msg["type"] == "websocket.close":
+                        return msg["code"]
+
+            drained = asyncio.ensure_future(drainer.drain(timeout=2))
+            self.assertEqual(await closed(p1), 1012)
+            self.assertEqual(await closed(p2), 1012)
+            await p1.disconnect()
+            await p2.disconnect()
+            self.assertTrue(await drained)
+            self.assertEqual(engine.rooms, {})
+
+            # drain 中の新しい接続はすぐ再接続の案内で閉じる
+            late = WsClient("/ws/arena/990001/")
+            await late.connect()
+            self.assertEqual(await closed(late), 1012)
+            await late.disconnect()
+
+        async_to_sync(scenario)()
+        turn = Turn.objects.get(room__code="990001", number=1)
+        self.assertEqual(turn.p1_action, "charge")
+
+
+class SendQueueTests(TransactionTestCase):
+    def test_slow_socket_keeps_latest_state_and_capped_logs(self):
+        written = []
+
+        async def scenario():
+            gate = asyncio.Event()
+
+            async def send(text_data):
+                written.append(json.loads(text_data))
+                await gate.wait()
+
+            def render(logs, state):
+                return {"text_data": json.dumps({"logs": len(logs), "v": state and state["version"]})}
+
+            queue = SendQueue(send, render)
+            queue.put_state({"version": 1})
+            await asyncio.sleep(0)
+            # 1フレーム目の書き込みが終わらない間に届いた分
+            for v in (2, 3, 2):
+                queue.put_state({"version": v})
+            for i in range(SEND_QUEUE_LOGS + 10):
+                queue.put_log({"type": "log", "text": str(i)})
+            self.assertEqual(len(queue.logs), SEND_QUEUE_LOGS)
+            self.assertEqual(queue.logs[0]["text"], "10")
+            self.assertFalse(queue.stalled())
+            with mock.patch("arena.sendqueue.SEND_STALL_SECONDS", 0):
+                self.assertTrue(queue.stalled())
+
+            gate.set()
+            while queue.pending or queue._task is not None:
+                await asyncio.sleep(0)
+            queue.close()
+
+        async_to_sync(scenario)()
+        self.assertEqual(written, [{"logs": 0, "v": 1}, {"logs": SEND_QUEUE_LOGS, "v": 3}])
+
+
+@mock.patch("arena.pages.STATIC_PAGES", True)
+class StaticPageTests(TransactionTestCase):
+    def setUp(self):
+        pages.clear()
+
+    def test_room_page_is_shared_precompressed_and_revalidated(self):
+        client = Client()
+        first = client.get("/room/123456/", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first["Content-Encoding"], "gzip")
+        self.assertEqual(first["Vary"], "Accept-Encoding")
+        html = gzip.decompress(first.content).decode()
+        self.assertIn("location.pathname", html)
+        self.assertNotIn("123456", html)
+
+        # 別の部屋でも本文（ETag）は同じ。手元の版があれば 304
+        other = client.get("/room/654321/", HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(other.status_code, 304)
+        self.assertEqual(other.content, b"")
+        plain = client.get("/room/654321/", HTTP_ACCEPT_ENCODING="gzip;q=0")
+        self.assertNotIn("Content-Encoding", plain)
+        self.assertEqual(plain.content.decode(), html)
+        self.assertNotEqual(plain["ETag"], first["ETag"])
+
+    def test_lobby_page_sets_csrf_cookie(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.get("/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("csrftoken", response.cookies)
+        self.assertIn(b'id="csrf"', response.content)
+        self.assertEqual(client.get("/api/rooms/live/").json(), {"live_rooms": 0})
+
+
+class StrategyTests(TransactionTestCase):
+    def test_matrix_solver_and_shipped_table(self):
+        # じゃんけん型は一様に混ぜる
+        value, mix = strategy.solve_matrix([[0.5, 0, 1], [1, 0.5, 0], [0, 1, 0.5]])
+        self.assertAlmostEqual(value, 0.5)
+        for p in mix:
+            self.assertAlmostEqual(p, 1 / 3)
+
+        table = strategy.Table.load()
+        self.assertEqual({k: table.params[k] for k in strategy.current_params()}, strategy.current_params())
+        hps = [hp for hp in table.params["hp"] if hp]
+        for a in hps:
+            for b in hps:
+                # トークンが無ければチャージ攻撃は選ばない
+                self.assertEqual(table.mix(a, b, 0, 2)["charged_attack"], 0)
+                self.assertAlmostEqual(table.value(a, b, 1, 2) + table.value(b, a, 2, 1), 1, places=3)
+        self.assertGreater(table.value(40, 34, 0, 0), 0.5)
+        self.assertIn(table.choose(40, 40, 0, 0), strategy.ACTIONS)
+
+    def test_stale_table_disables_bots_without_solving(self):
+        import tempfile
+        from pathlib import Path
+
+        from django.core.management import CommandError, call_command
+
+        loaded = strategy.table()
+        self.assertIsNotNone(loaded)
+        stale = strategy.Table(dict(loaded.params, dmg_attack=loaded.params["dmg_attack"] + 1),
+                               loaded.policy, loaded.values)
+        try:
+            with tempfile.TemporaryDirectory() as tmp, mock.patch("arena.strategy.solve") as solve, \
+                    self.assertLogs("arena.strategy", "ERROR"):
+                path = Path(tmp) / "strategy.bin"
+                stale.save(path)
+                self.assertIsNone(strategy.load_table(path))
+                self.assertIsNone(strategy.load_table(path.with_name("missing.bin")))
+                solve.assert_not_called()
+            self.assertIsNone(strategy.table())
+
+            async def scenario():
+                bots.offer("995002", mock.AsyncMock())
+                return bots._handles
+            self.assertEqual(async_to_sync(scenario)(), {})
+        finally:
+            self.assertIsNotNone(strategy.load_table())
+
+        # 今のルールと違う値では strategy.bin を書かない（解く前に断る）
+        with mock.patch("arena.strategy.solve") as solve:
+            with self.assertRaises(CommandError):
+                call_command("solve_strategy", "--write", "--attack", "7")
+            solve.assert_not_called()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class BotTests(TransactionTestCase):
+    def setUp(self):
+        _reset()
+
+    def tearDown(self):
+        _reset()
+
+    @mock.patch("arena.bot.BOT_AFTER", 0.05)
+    def test_bot_takes_empty_seat_and_answers_each_turn(self):
+        async def scenario():
+            p1 = await _connect("995001")
+            await _drain(p1, "joined")
+            log = await _drain(p1, "log")
+            while log["text"] != "Player2 (bot) joined.":
+                log = await _drain(p1, "log")
+            for turn in (1, 2):
+                await p1.send_json_to({"type": "action", "action": "guard"})
+                state = await _drain(p1, "state")
+                self.assertEqual(state["delta"]["turn"], turn + 1)
+            await engine.flush()
+            await p1.disconnect()
+
+        async_to_sync(scenario)()
+        turns = Turn.objects.filter(room__code="995001", resolved=True).order_by("number")
+        self.assertEqual([t.p1_action for t in turns], ["guard", "guard"])
+        self.assertTrue(all(t.p2_action in strategy.ACTIONS for t in turns))
+        self.assertEqual(Room.objects.get(code="995001").p2_id, "bot")
@@ -0,0 +1,32 @@
+"""
+受信メッセージのレート制限（ソケットごとのトークンバケット）。
+
+連打するクライアントが部屋グループにメッセージを撒き散らさないよう、
+consumer の receive の入口で数える。超過分は捨て、超過が続くソケットは切断する。
+"""
+import time
+
+from django.conf import settings
+
+INBOUND_RATE = getattr(settings, "ARENA_INBOUND_RATE", 10.0)       # 1秒あたりに補充する件数
+INBOUND_BURST = getattr(settings, "ARENA_INBOUND_BURST", 20)       # 瞬間的に許す件数
+INBOUND_MAX_DROPS = getattr(settings, "ARENA_INBOUND_MAX_DROPS", 200)  # これだけ捨てたら切断
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float = INBOUND_RATE, burst: float = INBOUND_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
@@ -1,19 +1,49 @@
+from django.http import Http404, JsonResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import render, redirect
-from django.utils.crypto import get_random_string
-from .models import Room
+from . import identity, pages
+from .archive import load_match
+from .rooms import in_database, rooms
 
-def index(request):
+async def index(request):
+    # 部屋コードの払い出し・存在確認は台帳で（Room テーブルは存在確認だけ。書き込まない）
     if request.method == "POST":
         if "create" in request.POST:
-            code = get_random_string(6, allowed_chars="0123456789")
-            Room.objects.create(code=code)
+            code = await rooms.allocate()
             return redirect("room", room_code=code)
         code = request.POST.get("code", "").strip()
-        if len(code) == 6 and Room.objects.filter(code=code).exists():
+        # 台帳に無くても Room 行があれば入れる（台帳より古い部屋・再起動後）
+        if len(code) == 6 and (await rooms.exists(code) or await in_database(code)):
             return redirect("room", room_code=code)
-    return render(request, "arena/index.html")
+    if pages.STATIC_PAGES:
+        # フォームの CSRF トークンは Cookie から JS で入れる（本文は全員同じ）
+        get_token(request)
+        return pages.respond(request, pages.page("arena/index.html"))
+    return render(request, "arena/index.html", {"live_rooms": await rooms.live_count()})
+
+async def live(request):
+    return JsonResponse({"live_rooms": await rooms.live_count()})
 
 def room(request, room_code):
-    return render(request, "arena/room.html", {"room_code": room_code})
+    if not identity.SIGNED_IDENTITY:
+        if pages.STATIC_PAGES:
+            return pages.respond(request, pages.page("arena/room.html"))
+        return render(request, "arena/room.html", {"room_code": room_code})
+    # ソケット用の署名つきトークン（セッションには触れない）
+    pid = identity.player_of(request) or identity.new_pid()
+    if pages.STATIC_PAGES:
+        response = pages.respond(request, pages.page("arena/room.html"))
+        identity.hand_token(response, pid)
+    else:
+        response = render(request, "arena/room.html", {"room_code": room_code, "player_token": identity.issue(pid)})
+    identity.remember(response, pid)
+    return response
+
+def replay(request, room_code):
+    # アーカイブ済みの対戦（同じコードが再利用されていれば最後のもの）
+    match = load_match(room_code)
+    if match is None:
+        raise Http404("match not archived")
+    return JsonResponse(match, json_dumps_params={"ensure_ascii": False})
 
 # Create your views here.
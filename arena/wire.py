@@ -0,0 +1,115 @@
+"""
+WebSocket のワイヤ形式。
+
+接続時にクライアントが提示したサブプロトコルから選ぶ:
+    - arena.msgpack.v1 : MessagePack（バイナリ）。行動は整数コード、
+                         締切は epoch ミリ秒で送る。回線の悪いモバイル向け
+    - arena.json.v1    : JSON テキスト（従来どおり。サブプロトコル無しも同じ）
+
+msgpack が入っていない環境では MessagePack を提示されても JSON を選ぶ。
+"""
+import functools
+import json
+from datetime import datetime
+
+from .models import ACTIONS
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - channels_redis 経由で通常は入っている
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "arena.msgpack.v1"
+JSON_SUBPROTOCOL = "arena.json.v1"
+
+# 行動の整数コード（ACTIONS の並び順）
+ACTION_CODES = {name: i for i, (name, _) in enumerate(ACTIONS)}
+ACTION_NAMES = {i: name for name, i in ACTION_CODES.items()}
+
+
+def choose_subprotocol(offered) -> str | None:
+    """クライアントの提示順に、使えるものを選ぶ（何も提示されなければ None = JSON）"""
+    for proto in offered or ():
+        if proto == MSGPACK_SUBPROTOCOL and msgpack is not None:
+            return proto
+        if proto == JSON_SUBPROTOCOL:
+            return proto
+    return None
+
+
+def action_name(value) -> str:
+    """受信した行動（名前 or 整数コード）を名前にする"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return ACTION_NAMES.get(value, "none")
+    return value if isinstance(value, str) else "none"
+
+
+# ===== 状態の見え方と差分 =====
+def project_state(room_state: dict, seat: int) -> dict:
+    """部屋共通の状態から、席 seat から見た you / op を組み立てる（DBアクセスなし）"""
+    # 観戦者（seat 0）は P1 側から見る
+    me = room_state["p2"] if seat == 2 else room_state["p1"]
+    op = room_state["p1"] if seat == 2 else room_state["p2"]
+    return {
+        "turn": room_state["turn"],
+        "deadline": room_state["deadline"],
+        "finished": room_state["finished"],
+        "winner": room_state["winner"],
+        "you": {"index": seat, "hp": me["hp"], "tokens": me["tokens"]},
+        "op":  {"hp": op["hp"], "tokens": op["tokens"]},
+    }
+
+
+def diff_state(old: dict, new: dict) -> dict:
+    """変わったフィールドだけを返す（you / op は中身も差分にする）"""
+    delta = {}
+    for key, value in new.items():
+        prev = old.get(key)
+        if isinstance(value, dict) and isinstance(prev, dict):
+            sub = {k: v for k, v in value.items() if prev.get(k) != v}
+            if sub:
+                delta[key] = sub
+        elif key not in old or prev != value:
+            delta[key] = value
+    return delta
+
+
+@functools.lru_cache(maxsize=4096)
+def _epoch_ms(iso: str) -> int:
+    # 同じ締切は部屋の全員に何度も送るので、変換結果を使い回す
+    return int(datetime.fromisoformat(iso).timestamp() * 1000)
+
+
+def _compact_state(fields: dict) -> dict:
+    if isinstance(fields.get("deadline"), str):
+        fields = {**fields, "deadline": _epoch_ms(fields["deadline"])}
+    return fields
+
+
+def to_compact(content: dict) -> dict:
+    """MessagePack 向けに締切を epoch ミリ秒へ置き換える"""
+    if content.get("type") == "batch":
+        return {**content, "items": [to_compact(item) for item in content["items"]]}
+    if content.get("type") == "state":
+        if "delta" in content:
+            return {**content, "delta": _compact_state(content["delta"])}
+        return _compact_state(content)
+    return content
+
+
+def encode_msgpack(content: dict) -> bytes:
+    return msgpack.packb(to_compact(content), use_bin_type=True)
+
+
+def encode(content: dict, binary: bool) -> dict:
+    """consumer.send に渡す形（MessagePack ならバイナリ、でなければ詰めた JSON テキスト）"""
+    if binary:
+        return {"bytes_data": encode_msgpack(content)}
+    return {"text_data": json.dumps(content, separators=(",", ":"), ensure_ascii=False)}
+
+
+def decode_msgpack(data: bytes) -> dict:
+    content = msgpack.unpackb(data, raw=False)
+    if not isinstance(content, dict):
+        raise ValueError("message must be a map")
+    return content
@@ -9,11 +9,18 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "rtbattle.settings")
 django.setup()  # ← これが routing を import するより先！
 
-from arena import routing as arena_routing  # ← ここで初めて import する
+from arena import identity, routing as arena_routing  # ← ここで初めて import する
+from arena.metrics import MetricsEndpoint
+from arena.sharding import WorkerStartup
 
-application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
-        URLRouter(arena_routing.websocket_urlpatterns)
-    ),
-})
+websocket = URLRouter(arena_routing.websocket_urlpatterns)
+if not identity.SIGNED_IDENTITY:
+    # 署名つきIDを使わないときはセッション（DB）からプレイヤーIDを読む
+    websocket = AuthMiddlewareStack(websocket)
+
+# ハートビート・掃除役などはソケットを待たずにワーカーの起動時（lifespan）に始める
+application = WorkerStartup(ProtocolTypeRouter({
+    # GET /metrics は計測値（Prometheus 形式）。それ以外は Django へ
+    "http": MetricsEndpoint(get_asgi_application()),
+    "websocket": websocket,
+}))
@@ -1,9 +1,10 @@
 from pathlib import Path
 import os, urllib.parse as up, re
+import django
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-key")
-DEBUG = True
+DEBUG = os.getenv("DEBUG", "1") == "1"
 ALLOWED_HOSTS = ["*"]
 
 INSTALLED_APPS = [
@@ -15,12 +16,44 @@ INSTALLED_APPS = [
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# DB: DATABASE_URL があればそれを使う（本番は PostgreSQL + 永続接続）。無ければ SQLite
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+
+def _database_from_url(url: str) -> dict:
+    u = up.urlparse(url)
+    if u.scheme not in ("postgres", "postgresql"):
+        raise ValueError(f"unsupported DATABASE_URL scheme: {u.scheme}")
+    db = {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": u.path.lstrip("/"),
+        "USER": up.unquote(u.username or ""),
+        "PASSWORD": up.unquote(u.password or ""),
+        "HOST": u.hostname or "",
+        "PORT": str(u.port or ""),
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "60")),   # 接続を使い回す秒数
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": dict(up.parse_qsl(u.query)),                    # 例: ?sslmode=require
     }
-}
+    # Django 5.1+ なら psycopg のコネクションプールを使える（CONN_MAX_AGE とは併用不可）
+    if os.getenv("DB_POOL") and django.VERSION >= (5, 1):
+        db["OPTIONS"]["pool"] = {"min_size": 2, "max_size": int(os.getenv("DB_POOL_MAX", "20"))}
+        db["CONN_MAX_AGE"] = 0
+    return db
+
+if DATABASE_URL:
+    DATABASES = {"default": _database_from_url(DATABASE_URL)}
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "db.sqlite3",
+            "CONN_MAX_AGE": 60,
+            "OPTIONS": {"timeout": 20},   # 書き込み待ち（database is locked 対策）
+        }
+    }
+
+# 部屋の読み込み・フラッシュ用DBスレッド数（0 = 自動: SQLite は1、それ以外は8）
+ARENA_DB_POOL_SIZE = int(os.getenv("ARENA_DB_POOL_SIZE", "0"))
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
@@ -65,10 +98,14 @@ def _host_entry(url: str):
         pass
     return entry
 
+# 同じワーカー内の宛先へはメモリで直接届ける（Redis 経由だけにするなら
+# channels_redis.core.RedisChannelLayer を指定）
+CHANNEL_LAYER_BACKEND = os.getenv("CHANNEL_LAYER_BACKEND", "arena.layers.HybridChannelLayer")
+
 if REDIS_URL:
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "BACKEND": CHANNEL_LAYER_BACKEND,
             "CONFIG": {
                 "hosts": [_host_entry(REDIS_URL)],  # ← dictで渡す
                 # "capacity": 1500,   # 必要なら調整
@@ -79,11 +116,61 @@ if REDIS_URL:
 else:
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "BACKEND": CHANNEL_LAYER_BACKEND,
             "CONFIG": {"hosts": ["redis://127.0.0.1:6379/0"]},
         }
     }
 
+# 対戦状態はメモリが正。DBへはこの間隔(秒)でまとめて書き出す
+# （= クラッシュ時に失われうる状態の上限）
+ARENA_FLUSH_INTERVAL = float(os.getenv("ARENA_FLUSH_INTERVAL", "1.0"))
+
+# ルーム担当ワーカーの登録先。複数ワーカー/ノードで動かす場合は必須
+# （未設定ならこのプロセスが全ルームを担当する）
+ARENA_REGISTRY_URL = os.getenv("ARENA_REGISTRY_URL", REDIS_URL)
+ARENA_HEARTBEAT_INTERVAL = 2.0   # 秒
+ARENA_WORKER_TTL = 6.0           # ハートビートがこの秒数途切れたら担当を引き継ぐ
+
+# 停止（SIGTERM）前の drain: 部屋を引き渡して書き出すまで待つ上限（秒）と、
+# クライアントに伝える再接続の待ち時間の上限（ミリ秒。これ以下でばらつかせる）
+ARENA_DRAIN_TIMEOUT = 20.0
+ARENA_RECONNECT_JITTER_MS = 5000
+
+# 部屋コードの台帳（払い出し・存在確認）。未設定ならプロセス内の台帳を使う
+ARENA_ROOM_REGISTRY_URL = os.getenv("ARENA_ROOM_REGISTRY_URL", ARENA_REGISTRY_URL)
+ARENA_ROOM_TTL = 6 * 3600        # 秒。この間使われなかったコードは再利用される
+
+# プレイヤーIDを署名つきトークンで渡す（ソケット接続でセッション・認証のDBを使わない）
+ARENA_SIGNED_IDENTITY = os.getenv("ARENA_SIGNED_IDENTITY", "") == "1"
+ARENA_PLAYER_TOKEN_TTL = 24 * 3600   # 秒
+
+# マッチメイキング: 組み合わせを作る間隔と、レーティングを問わず組むまでの待ち時間（秒）
+ARENA_MATCH_INTERVAL = 0.1
+ARENA_MATCH_MAX_WAIT = 10.0
+
+# 接続の無い部屋の締切を片づける全体の掃除役（秒）。入力の無いターンは
+# 締切から ABANDON_AFTER 過ぎたら放置とみなして勝敗なしで終わらせる
+ARENA_SWEEP_INTERVAL = 5.0
+ARENA_ABANDON_AFTER = 300.0
+# 2P の席がこの秒数埋まらない部屋にはボットが座る（0 で無効）
+ARENA_BOT_AFTER = float(os.getenv("ARENA_BOT_AFTER", "20"))
+
+# 決着した対戦のアーカイブ先（manage.py archive_matches）
+ARENA_ARCHIVE_DIR = Path(os.getenv("ARENA_ARCHIVE_DIR", BASE_DIR / "archive"))
+
+# 部屋ごとの送信まとめの窓（ミリ秒）。この間のログ・状態を1メッセージにする
+ARENA_BATCH_WINDOW_MS = int(os.getenv("ARENA_BATCH_WINDOW_MS", "15"))
+# 観戦者向けの配信間隔（ミリ秒）。この間の状態は最新の1つにまとめる
+ARENA_SPECTATOR_WINDOW_MS = int(os.getenv("ARENA_SPECTATOR_WINDOW_MS", "500"))
+# ソケットごとの受信レート制限（件/秒・瞬間最大）
+ARENA_INBOUND_RATE = 10.0
+ARENA_INBOUND_BURST = 20
+# ソケットごとの送信待ち（ログ行の上限）と、書き込みがこの秒数終わらないソケットの切断
+ARENA_SEND_QUEUE_LOGS = 50
+ARENA_SEND_STALL_SECONDS = 10.0
+# ロビー・部屋のページを1回だけ描画して圧縮済みで配る（ETag / 304）。既定は DEBUG でないとき
+ARENA_STATIC_PAGES = os.getenv("ARENA_STATIC_PAGES", "0" if DEBUG else "1") == "1"
+
 # 起動ログ（マスク）
 def _mask(u: str) -> str:
     return re.sub(r':([^:@/]{6,})@', r':******@', u)
@@ -95,4 +182,5 @@ USE_TZ = True
 
 STATIC_URL = "static/"
 STATICFILES_DIRS = [BASE_DIR / "static"]
+STATIC_ROOT = Path(os.getenv("STATIC_ROOT", BASE_DIR / "staticfiles"))   # collectstatic の出力先
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
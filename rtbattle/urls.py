@@ -6,4 +6,6 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("", views.index, name="index"),
     path("room/<str:room_code>/", views.room, name="room"),
+    path("api/rooms/live/", views.live, name="live"),
+    path("api/matches/<str:room_code>/", views.replay, name="replay"),
 ]
\ No newline at end of file